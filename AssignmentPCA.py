@@ -4,19 +4,43 @@ An example on how to use them can be found in the Main.py module
 
 The methods in this module: 
     load_RMAExp_to_CellLines: creating a list of CellLineRMAExpression classes and filling them with the right information 
+    align_RMAExp: matches the cell lines in the metadata with the rows of the RMA expression in one index join
+    load_RMAExp_to_CellLines_bulk: the same as load_RMAExp_to_CellLines, but aligning all cell lines at once with one index join,
+                                   also returning the aligned matrix and the unmatched and duplicated cell lines
     load_RMAExp_to_matrix: extracts the RMAExpression information and stores it in a matrix
     normalize_list: z-score normalizes a given list
+    gather_rows_inplace: moves the given rows of a matrix to its first rows, in place
     normalize_matrix: z-score normalizes a given matrix per column
+    normalize_matrix_inplace: z-score normalizes a given matrix per column in place, with vectorized column statistics
     covariance_of_two_lists: calculates the covariance of two lists
-    covariance_matrix: calculates the covariance of the features in a matrix 
+    covariance_matrix: calculates the covariance of the features in a matrix, with a BLAS, blocked (memory-mapped) or loop method
+    gram_matrix: calculates the MxM Gram matrix of the instances in a matrix
+    covariance_eigh: calculates the eigenvalues and eigenvectors of the covariance matrix, using the Gram matrix when M is much smaller than N
     calcMaxIdx: gets the index of the maximum value in a list
     getMaxIdxs: gets the indexes of the N maximum values in a list                    
+    top_k_indexes: gets the indexes of the K maximum values in a list, by vectorized partial selection
+    top_k_indexes_batched: gets the indexes of the K maximum values in every row of a matrix at once
+
+The classes in this module:
+    StreamingTopK: gets the indexes of the K maximum values of a vector that is given in chunks
+    PCA: fits the leading principal components of a matrix with a symmetric eigen, SVD, randomized or Lanczos solver,
+         projects data onto them, and saves and loads the fitted model
+    PCAProjector: projects batches of new samples onto the components of a fitted (or saved) PCA model, reordering their genes by name
+    RunningStats: keeps the mean and variance of every variable up to date while batches of instances arrive
+    IncrementalPCA: updates the leading principal components with every new batch of instances, without refitting all data
 """
 
+import copy
+import json
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from CellLineRMAExpressionModule import initclassvars, CellLineRMAExpression
+import pandas as pd
+from CellLineRMAExpressionModule import initclassvars, CellLineRMAExpression, RMAExpressionStore
+from instrumentation import instrumented
 
+@instrumented
 def load_RMAExp_to_CellLines(metadata, rma_expr, ListOfCellLineNumbers = None, metadata_labels = ["name", "COSMIC_ID", "TCGA_label"], lookup_variable = "name"):
     """
     Create a list of instances of class 'CellLineRMAExpression' per cell line given in ListOfCellLineNumbers, 
@@ -33,43 +57,162 @@ def load_RMAExp_to_CellLines(metadata, rma_expr, ListOfCellLineNumbers = None, m
         lookup_variable, string containing one of: "name", "cosmic_id", "tcga_label", 
                          representing the variable to which to match metadata and rma_expr
         
-    Returns: a list of instances of the CellLineRMAExpression class, filled with the corresponding information and RMAExpression
+    Returns: a list of instances of the CellLineRMAExpression class, filled with the corresponding information and RMAExpression,
+             all sharing one RMAExpressionStore in which row i holds the RMAExpression of instance i
     """
     initclassvars(rma_expr.columns) #assign gene names to class variable 'allparskeys'
 
     if ListOfCellLineNumbers is None: ListOfCellLineNumbers = metadata.index #if no indexes are specified, use all indexes
     nr_instances = len(ListOfCellLineNumbers) #Get the number of instances to create
     List_of_cellline_classes = [None]*nr_instances #Initialize shape size to prevent reallocation of memory
+    store = RMAExpressionStore(nr_instances, rma_expr.columns) #Initialize one contiguous array holding the RMAExpression of all instances
     
     for i, idx in enumerate(ListOfCellLineNumbers):  #Iterate over every cell line index, with idx the correct index and i the iteration
         name, cosmic_id, tcga_label = metadata.loc[idx, metadata_labels] #Get the name, cosmic_id and tcga_label of the cell line with index idx
         values = rma_expr.loc[str(eval(lookup_variable))].values #Get the RMA Expression values of the cell line with an index corresponding to 'name', the name of cell line i
     
         instance = CellLineRMAExpression(CellLineName=name, CosmicID=cosmic_id, CancerType=tcga_label) #load the cell line information into the instance
-        instance.load_RMAExpression(values) #load the RMAExpression values into the instance
+        instance.load_RMAExpression(values, store, i) #load the RMAExpression values into row i of the shared store
         List_of_cellline_classes[i] = instance #save the instance to the list which will be used as output 
 
     return List_of_cellline_classes
 
+LOOKUP_VARIABLES = {"name": 0, "cosmic_id": 1, "tcga_label": 2} #position of each lookup_variable in metadata_labels
+
+@instrumented
+def align_RMAExp(metadata, expr_index, ListOfCellLineNumbers = None, metadata_labels = ["name", "COSMIC_ID", "TCGA_label"], lookup_variable = "name"):
+    """
+    Given the metadata of the cell lines and the index of the RMA expression, 
+    align them in one vectorized index join on the lookup_variable, like load_RMAExp_to_CellLines_bulk, without copying any RMA expression
+    
+    Parameters: 
+        metadata, non-empty pandas dataframe containing the name, cosmic ID and TCGA label (columns) of the cell lines (rows)
+        expr_index, the index (or list) of the lookup_variable of every row of the RMA expression
+        ListOfCellLineNumbers, non-empty list of indexes corresponding to dataframe metadata
+        metadata_labels, list of three strings, representing the names of the columns in metadata with the name, 
+                         cosmid_ID and TCGA_label information (in that order)
+        lookup_variable, string containing one of: "name", "cosmic_id", "tcga_label", 
+                         representing the variable to which to match metadata and the RMA expression
+        
+    Returns: a tuple of three elements:
+             a numpy array with per matched cell line the position of its row in the RMA expression,
+             a Mx3 numpy array with the name, cosmic ID and TCGA label of the M matched cell lines, 
+             a dictionary with the lists of "unmatched" and "duplicated" lookup values
+    """
+    if lookup_variable not in LOOKUP_VARIABLES:
+        raise ValueError(f"lookup_variable should be one of {list(LOOKUP_VARIABLES)}, not {lookup_variable!r}")
+
+    if ListOfCellLineNumbers is not None: metadata = metadata.loc[ListOfCellLineNumbers] #select the requested cell lines
+    keys = metadata[metadata_labels[LOOKUP_VARIABLES[lookup_variable]]].astype(str) #get the lookup value of every cell line as string
+    expr_keys = pd.Index(expr_index).astype(str) #get the lookup values of the RMA expression as string
+
+    duplicated_metadata = keys.duplicated(keep='first').to_numpy() #mark all but the first occurrence of every lookup value in metadata
+    duplicated_expr = expr_keys.duplicated(keep='first') #mark all but the first occurrence of every lookup value in the RMA expression
+    first_expr_positions = np.flatnonzero(~duplicated_expr) #the positions in the RMA expression of the first occurrences
+
+    positions = expr_keys[first_expr_positions].get_indexer(keys) #join: the position of every lookup value among the first occurrences, -1 if absent
+    unmatched = positions < 0
+    keep = ~unmatched & ~duplicated_metadata #only use cell lines found in the RMA expression, and only once
+    positions = first_expr_positions[positions[keep]] #translate the join result to row positions in the RMA expression
+
+    duplicated_expr_keys = expr_keys[duplicated_expr] #the lookup values occurring more than once in the RMA expression
+    duplicated = keys[duplicated_metadata | keys.isin(duplicated_expr_keys).to_numpy()].unique() #the requested lookup values that are duplicated anywhere
+    report = {"unmatched": list(keys[unmatched]), "duplicated": list(duplicated)}
+
+    metadata_values = metadata[metadata_labels].to_numpy()[keep] #get the name, cosmic_id and tcga_label of the kept cell lines at once
+    return positions, metadata_values, report
+
+@instrumented
+def load_RMAExp_to_CellLines_bulk(metadata, rma_expr, ListOfCellLineNumbers = None, metadata_labels = ["name", "COSMIC_ID", "TCGA_label"], lookup_variable = "name", dtype = float):
+    """
+    Create a list of instances of class 'CellLineRMAExpression' per cell line given in ListOfCellLineNumbers, 
+    like load_RMAExp_to_CellLines, but align metadata and rma_expr in one vectorized index join on the lookup_variable
+    instead of looking up every cell line separately. 
+    
+    Cell lines of which the lookup_variable is not found in rma_expr are left out and reported as unmatched. 
+    Lookup values occurring more than once in metadata or rma_expr are reported as duplicated, and only their first occurrence is used.
+        
+    Parameters: 
+        metadata, non-empty pandas dataframe containing the name, cosmic ID and TCGA label (columns) of the cell lines (rows)
+        rma_expr, non-empty pandas dataframe containing the RMAExpression per gene (columns) of each cell line (rows), 
+                  indexed with the lookup_variable of the cell line
+        ListOfCellLineNumbers, non-empty list of indexes corresponding to dataframe metadata
+        metadata_labels, list of three strings, representing the names of the columns in metadata with the name, 
+                         cosmid_ID and TCGA_label information (in that order)
+        lookup_variable, string containing one of: "name", "cosmic_id", "tcga_label", 
+                         representing the variable to which to match metadata and rma_expr
+        dtype, the numpy float type of the array holding the RMAExpression
+        
+    Returns: a tuple of three elements:
+             a list of M instances of the CellLineRMAExpression class, filled with the corresponding information and RMAExpression,
+             the MxN numpy array backing the instances, with row i the RMAExpression of instance i, 
+             a dictionary with the lists of "unmatched" and "duplicated" lookup values
+    """
+    positions, metadata_values, report = align_RMAExp(metadata, rma_expr.index, ListOfCellLineNumbers, metadata_labels, lookup_variable) #join metadata and rma_expr at once
+    initclassvars(rma_expr.columns) #assign gene names to class variable 'allparskeys'
+
+    nr_instances = len(positions) #Get the number of instances to create
+    store = RMAExpressionStore(nr_instances, rma_expr.columns, dtype) #Initialize one contiguous array holding the RMAExpression of all instances
+    values = rma_expr.to_numpy() #a view of the data if rma_expr holds floats only
+    if values.dtype == store.matrix.dtype: np.take(values, positions, axis=0, out=store.matrix) #gather the aligned rows of rma_expr in one call
+    else: store.matrix[:] = values[positions] #rma_expr holds another type (e.g. also the gene symbols), so convert after gathering
+
+    List_of_cellline_classes = [None]*nr_instances #Initialize shape size to prevent reallocation of memory
+    for i, (name, cosmic_id, tcga_label) in enumerate(metadata_values): #Iterate over every kept cell line, with i its row in the store
+        instance = CellLineRMAExpression(CellLineName=name, CosmicID=cosmic_id, CancerType=tcga_label) #load the cell line information into the instance
+        instance.load_RMAExpression(None, store, i) #point the instance to its row of the already filled store
+        List_of_cellline_classes[i] = instance
+
+    return List_of_cellline_classes, store.matrix, report
+
+@instrumented
 def load_RMAExp_to_matrix(data):
     """
     Given a list of CellLineRMAExpression class instances,
     Create an MxN matrix containing the RMA Expression values, with M the number of instances and N the number of genes
         
+    When the instances are exactly the rows of one RMAExpressionStore, in order, as created by load_RMAExp_to_CellLines,
+    the backing array of that store is returned without copying. Modifying it thus modifies the values of the instances.
+        
     Parameters: 
         data, non-empty list of CellLineRMAExpression class instances filled with the RMA Expression values 
-              stored in the RMAExp_dict attribute of the instance
+              stored in the RMAExpressionStore of the instance
         
     Returns: a MxN numpy array containing the RMA Expression values, with M the number of instances and N the number of genes
     """
-    nr_instances = len(data) #get the number of instances
-    nr_variables = len(data[0].RMAExp_dict) #get the number of genes 
-    rma_exp_matrix = np.empty((nr_instances, nr_variables)) #Initialize empty numpy array to prevent reallocation of memory
+    store = data[0].store #get the store of the first instance
+    if store is not None and len(store) == len(data) and all(instance.store is store and instance.row == i for i, instance in enumerate(data)):
+        return store.matrix #all instances are the rows of the same store in order, so its array is the matrix
     
-    for i, instance in enumerate(data): #iterate over every instance, with i the iteration
-        rma_exp_matrix[i] = list(instance.RMAExp_dict.values()) #extract the values of the RMAExp_dict of the instance, containing the RMAExpression values, and store them in the matrix
+    return np.stack([instance.RMAExp_values for instance in data]) #the instances have their own stores, e.g. loaded row by row, so copy their rows
     
-    return rma_exp_matrix
+def gather_rows_inplace(matrix, positions):
+    """
+    Given a MxN numpy array and K distinct row positions,
+    move row positions[i] of the array to row i for every i, in place, instead of gathering the rows into a new array.
+    The rows are moved along the cycles of the permutation, so only one row is copied to temporary memory at a time.
+        
+    Parameters: 
+        matrix, a writeable MxN numpy array
+        positions, a list of K distinct integers between 0 and M
+        
+    Returns: a KxN numpy view of the first K rows of matrix, holding the gathered rows
+    """
+    nr_rows = len(matrix)
+    positions = np.asarray(positions, dtype=np.intp)
+    source = np.concatenate([positions, np.setdiff1d(np.arange(nr_rows), positions)]) #a permutation: row i receives row source[i]
+    done = source == np.arange(nr_rows) #rows that are already in place
+    for start in np.flatnonzero(~done): #follow every cycle of the permutation once
+        if done[start]: continue
+        temporary = matrix[start].copy() #the row that is overwritten first
+        i = start
+        while source[i] != start:
+            matrix[i] = matrix[source[i]]
+            done[i] = True
+            i = source[i]
+        matrix[i] = temporary
+        done[i] = True
+    return matrix[:len(positions)]
 
 def normalize_list(variable_list):
     """
@@ -89,6 +232,7 @@ def normalize_list(variable_list):
    
     return normalized_list
  
+@instrumented
 def normalize_matrix(data_matrix):
     """
     Given a MxN numpy array,
@@ -107,6 +251,29 @@ def normalize_matrix(data_matrix):
    
     return data_matrix_norm
 
+def normalize_matrix_inplace(data_matrix, block_size=1024, scale=True, center=True):
+    """
+    Given a writeable MxN numpy array,
+    z-score normalize its values per column in place, like normalize_matrix but without copying the matrix.
+    The statistics of all columns are calculated at once, in blocks of rows with RunningStats, 
+    so the temporary memory stays at block_size rows of float64, whatever the type of data_matrix.
+        
+    Parameters: 
+        data_matrix, a non-empty, writeable MxN numpy array of floats (e.g. float32)
+        block_size, integer representing the number of rows per block
+        scale, boolean, if True the columns are divided by their standard deviation, if False they are only centered
+        center, boolean, if True the mean of every column is subtracted, if False it is not, 
+                so with scale and center False the statistics are calculated without writing to data_matrix
+        
+    Returns: a tuple of two float64 numpy arrays of length N, with the mean and standard deviation of every column before normalization
+    """
+    stats = RunningStats()
+    for start in range(0, len(data_matrix), block_size): stats.update(data_matrix[start:start+block_size]) #the column statistics in one pass
+    mean, std = stats.mean, stats.std()
+    if center: data_matrix -= mean.astype(data_matrix.dtype) #subtract the mean of every column at once
+    if scale: data_matrix /= np.where(std > 0, std, 1.0).astype(data_matrix.dtype) #leave constant columns at zero instead of dividing by zero
+    return mean, std
+
 def covariance_of_two_lists(x, y):
     """
     Given two lists of numbers of equal length,
@@ -124,17 +291,58 @@ def covariance_of_two_lists(x, y):
     
     return covariance
 
-def covariance_matrix(data):
+def _as_float(data):
+    """
+    Given an array of numbers, return it as a numpy array of floats, without copying arrays of float32 or float64
+    """
+    data = np.asarray(data)
+    return data if data.dtype in (np.float32, np.float64) else data.astype(float)
+
+COVARIANCE_METHODS = ("blas", "blocked", "loop")
+GRAM_RATIO = 2 #use the MxM Gram matrix instead of the NxN covariance matrix when N is at least GRAM_RATIO times M
+RANDOMIZED_RATIO = 4 #the "auto" solver uses "randomized" when the directions it multiplies with the data are RANDOMIZED_RATIO times fewer than min(M, N)
+
+@instrumented
+def covariance_matrix(data, method="blas", block_size=1024, filename=None):
     """
     Given a MxN numpy array of numbers, with M the number of instances and N the number of variables
     Calculate the NxN covariance matrix 
         
+    Three methods give the same result: 
+        "blas" calculates the whole matrix with one matrix product
+        "blocked" calculates the matrix in tiles of block_size x block_size variables, 
+                  so the intermediate memory stays small and the result can be written to a memory-mapped file
+        "loop" calculates every covariance separately with covariance_of_two_lists, which is very slow
+        
     Parameters: 
         data, a non-empty MxN numpy array of normalized numbers, with M observations and N featueres
+        method, string containing one of "blas", "blocked", "loop"
+        block_size, integer representing the number of variables per tile of the "blocked" method
+        filename, optional path of a .npy file to which the "blocked" method writes the matrix as a memory map
         
-    Returns: a NxN numpy array containing the covariance matrix of the data
+    Returns: a NxN numpy array (or numpy memmap if filename is given) containing the covariance matrix of the data
     """
-    nr_variables = data.shape[1] #get the number of variables N
+    if method not in COVARIANCE_METHODS:
+        raise ValueError(f"method should be one of {COVARIANCE_METHODS}, not {method!r}")
+    nr_instances, nr_variables = data.shape #get the number of instances M and variables N
+
+    if method == "blas":
+        data = _as_float(data)
+        return data.T @ data / (nr_instances-1) #all element wise multiplications and sums at once, by one matrix product
+
+    if method == "blocked":
+        data = _as_float(data)
+        if filename is None: covMatrix = np.empty((nr_variables, nr_variables), dtype=data.dtype) #Initialize empty numpy array to prevent reallocation of memory
+        else: covMatrix = np.lib.format.open_memmap(filename, mode='w+', dtype=data.dtype, shape=(nr_variables, nr_variables)) #write the matrix to disk instead
+        for x in range(0, nr_variables, block_size): #iterate over the blocks of variables
+            block_x = data[:, x:x+block_size]
+            for y in range(x, nr_variables, block_size): #only the upper triangle of blocks, because the matrix is symmetrical
+                tile = block_x.T @ data[:, y:y+block_size] / (nr_instances-1) #Calculate the covariances of the variables in blocks X and Y
+                covMatrix[x:x+block_size, y:y+block_size] = tile
+                covMatrix[y:y+block_size, x:x+block_size] = tile.T #Assign the known covariances of Y, X to X, Y 
+        if filename is not None: covMatrix.flush() #make sure all tiles are written to the file
+        return covMatrix
+
     covMatrix = np.zeros((nr_variables, nr_variables)) #Initialize empty numpy array to prevent reallocation of memory
 
     for x in range(nr_variables): #iterate over the number of variables 
@@ -143,6 +351,54 @@ def covariance_matrix(data):
             covMatrix[y, x] = covMatrix[x, y] #Assign the known covariance of Y, X to X, Y position in the covariance matrix
     return covMatrix
 
+@instrumented
+def gram_matrix(data):
+    """
+    Given a MxN numpy array of numbers, with M the number of instances and N the number of variables
+    Calculate the MxM Gram matrix of the instances, scaled like the covariance matrix.
+    It has the same non-zero eigenvalues as the NxN covariance matrix, but is much smaller when M is much smaller than N.
+        
+    Parameters: 
+        data, a non-empty MxN numpy array of normalized numbers, with M observations and N featueres
+        
+    Returns: a MxM numpy array containing the scaled inner products of the instances
+    """
+    data = _as_float(data)
+    return data @ data.T / (data.shape[0]-1)
+
+@instrumented
+def covariance_eigh(data, method="auto", block_size=1024):
+    """
+    Given a MxN numpy array of numbers, with M the number of instances and N the number of variables
+    Calculate the eigenvalues and eigenvectors of the NxN covariance matrix, in order from highest to lowest eigenvalue
+    
+    With method "gram", the eigenvectors u of the MxM Gram matrix are computed, and turned into the eigenvectors 
+    of the covariance matrix by v = data.T u / sqrt((M-1) * eigenvalue). Only the at most M non-zero eigenvalues are returned.
+    With method "auto", "gram" is used when N is at least GRAM_RATIO times M, and "blas" otherwise.
+        
+    Parameters: 
+        data, a non-empty MxN numpy array of normalized numbers, with M observations and N featueres
+        method, string containing one of "auto", "gram" or one of the methods of covariance_matrix
+        block_size, integer representing the number of variables per tile of the "blocked" method
+        
+    Returns: a tuple of a numpy array containing the K real eigenvalues in order from highest to lowest, 
+             and a NxK numpy array with in column i the eigenvector belonging to eigenvalue i
+    """
+    nr_instances, nr_variables = data.shape
+    if method == "auto": method = "gram" if nr_variables >= GRAM_RATIO * nr_instances else "blas"
+
+    if method == "gram":
+        data = _as_float(data)
+        eig_vals, eig_vecs = np.linalg.eigh(gram_matrix(data)) #symmetric eigendecomposition of the small MxM matrix
+        eig_vals, eig_vecs = eig_vals[::-1], eig_vecs[:, ::-1] #order from highest to lowest
+        nonzero = eig_vals > eig_vals[0] * min(data.shape) * np.finfo(data.dtype).eps #eigenvalues that are zero up to rounding have no eigenvector
+        eig_vals, eig_vecs = eig_vals[nonzero], eig_vecs[:, nonzero]
+        eig_vecs = data.T @ eig_vecs / np.sqrt((nr_instances-1) * eig_vals) #map to unit eigenvectors of the covariance matrix
+        return eig_vals, eig_vecs
+
+    eig_vals, eig_vecs = np.linalg.eigh(covariance_matrix(data, method, block_size)) #symmetric eigendecomposition, so all values are real
+    return eig_vals[::-1], eig_vecs[:, ::-1]
+
 def calcMaxIdx(l=[1]):
     """
     Given a list
@@ -182,6 +438,7 @@ def calcMaxIdx(l=[1]):
     
     return nx
 
+@instrumented
 def getMaxIdxs(l=[1], number_idxs=1):
     """
     Given a list
@@ -193,13 +450,628 @@ def getMaxIdxs(l=[1], number_idxs=1):
     
     Returns: a list containing the indexes of the maximum values of list l, in order of highest value
     """
-    max_idxs = [None]*number_idxs #Initialize empty list to prevent reallocation of memory when saving results
-    control_list = np.asarray(l.copy()).real.astype(float) #Copy the original list to prevent overwriting, and make sure the numbers are all real numbers of float type
+    return top_k_indexes(l, number_idxs) #same result as calling calcMaxIdx number_idxs times, but without scanning the list number_idxs times
+    
+@instrumented
+def top_k_indexes_batched(matrix, k):
+    """
+    Given a RxN matrix of numbers or nan's, 
+    find the indexes of the k maximum values in every row, in order from highest to lowest
+        
+    The k maximum values are found by partial selection (numpy.argpartition) in O(N) steps per row, and only those are sorted. 
+    Nan's are skipped and complex numbers are reduced to their real part. Equal values are ordered by their index, 
+    so the result is the same as calling getMaxIdxs on every row.
+
+    Parameters: 
+        matrix, a RxN numpy array of numbers or nan's, with at least k numbers per row
+        k, integer representing the amount of indexes to find per row
+
+    Returns: a Rxk numpy array containing in row r the indexes of the maximum values of row r of matrix, in order of highest value
+    """
+    values = np.array(np.asarray(matrix).real, dtype=float, ndmin=2) #copy the values, so the original is not overwritten, as real floats
+    nr_rows = values.shape[0]
+    if k == 0: return np.empty((nr_rows, 0), dtype=np.intp)
+    numbers = ~np.isnan(values)
+    if (numbers.sum(axis=1) < k).any():
+        raise ValueError(f"every row should contain at least {k} numbers that are not nan")
+    values[~numbers] = -np.inf #nan's are never larger than a number
+    
+    threshold = -np.partition(-values, k-1, axis=1)[:, k-1:k] #the k-th largest value of every row, found without sorting
+    larger = values > threshold #all values above the threshold are selected
+    equal = (values == threshold) & numbers #values equal to the threshold are selected by lowest index, till k are selected
+    selected = larger | (equal & (np.cumsum(equal, axis=1) <= k - larger.sum(axis=1, keepdims=True)))
+    
+    idxs = np.nonzero(selected)[1].reshape(nr_rows, k) #exactly k indexes per row, in increasing order
+    order = np.argsort(-np.take_along_axis(values, idxs, axis=1), axis=1, kind='stable') #sort only the selected values, keeping equal values in index order
+    return np.take_along_axis(idxs, order, axis=1)
+
+def top_k_indexes(l=[1], k=1):
+    """
+    Given a list
+    find the indexes of the k maximum values, in order from highest to lowest, with top_k_indexes_batched
+    
+    Parameters: 
+        l, non-empty list of numbers or nan's, with at least k numbers
+        k, integer representing the amount of indexes to find
+    
+    Returns: a list containing the indexes of the maximum values of list l, in order of highest value
+    """
+    return top_k_indexes_batched(np.ravel(l), k)[0].tolist()
+
+class StreamingTopK:
+    """
+    Class used to find the indexes of the k maximum values of a vector that is too large to hold in memory, 
+    by merging the k maximum values of every chunk of the vector with the k maximum values found so far.
+    The result is the same as top_k_indexes of the whole vector.
+    """
+    
+    def __init__(self, k=1):
+        """
+        Initiate an instance of class StreamingTopK
+        
+        Parameters:
+            k, integer representing the amount of indexes to find
+        """
+        self.k = k
+        self.values = np.empty(0) #the k maximum values found so far
+        self.idxs = np.empty(0, dtype=np.intp) #their indexes in the whole vector
+        self.length = 0 #the number of values seen so far
     
-    for i in range(number_idxs): #find the max index 'number_idxs' times
-        idx = calcMaxIdx(control_list) #find the max index
-        max_idxs[i] = idx #save the max index to the result list
-        control_list[idx] = np.nan #change the value at the max index to nan so it won't be found again, thus the next max index can be found
+    def update(self, chunk, offset=None):
+        """
+        Given the next chunk of the vector, merge its maximum values with the ones found so far
         
-    return max_idxs
+        Parameters:
+            chunk, a list or 1D numpy array of numbers or nan's
+            offset, integer representing the index of the first element of chunk in the whole vector, 
+                    or None if the chunk directly follows the previous one
+        
+        Returns: this instance of class StreamingTopK
+        """
+        chunk = np.asarray(chunk).real.astype(float).ravel()
+        if offset is None: offset = self.length
+        self.length = max(self.length, offset + len(chunk))
+        
+        nr_numbers = int((~np.isnan(chunk)).sum())
+        k = min(self.k, nr_numbers) #a chunk may hold fewer than k numbers
+        if k == 0: return self
+        chunk_idxs = np.asarray(top_k_indexes(chunk, k)) #only the k maximum values of the chunk can be in the result
+        
+        values = np.concatenate([self.values, chunk[chunk_idxs]])
+        idxs = np.concatenate([self.idxs, chunk_idxs + offset])
+        order = np.lexsort((idxs, -values))[:self.k] #highest value first, equal values in index order
+        self.values, self.idxs = values[order], idxs[order]
+        return self
+    
+    def result(self):
+        """
+        Returns: a list containing the indexes of the maximum values of the whole vector, in order of highest value
+        """
+        if len(self.idxs) < self.k:
+            raise ValueError(f"the vector should contain at least {self.k} numbers that are not nan")
+        return self.idxs.tolist()
+
+def _variable_names(genes, nr_variables):
+    """
+    Given an optional list of names and the number of variables, return the names as a list, 
+    CellLineRMAExpression.allparskeys if no names are given and it has the right length, or None
+    """
+    if genes is None and len(CellLineRMAExpression.allparskeys) == nr_variables: genes = CellLineRMAExpression.allparskeys
+    return None if genes is None else [str(gene) for gene in genes]
+
+def orient_components(components):
+    """
+    Given a KxN numpy array with a unit eigenvector in every row,
+    flip the sign of every eigenvector so that its largest absolute element is positive, so results are reproducible
+    
+    Parameters:
+        components, a KxN numpy array of numbers
+    
+    Returns: a KxN numpy array containing the oriented eigenvectors
+    """
+    signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)]) #sign of the largest absolute element of every component
+    return components * np.where(signs == 0, 1, signs)[:, None]
+
+PCA_SOLVERS = ("auto", "eigh", "svd", "randomized", "lanczos")
 
+class PCA:
+    """
+    Class used to fit the principal components of a MxN matrix, with M the number of instances and N the number of variables, 
+    and to project data onto them.
+    
+    The data is z-score normalized per variable before the components are computed, like normalize_matrix does. 
+    The solvers give the same components up to rounding:
+        "eigh" uses covariance_eigh, a symmetric eigendecomposition of the covariance matrix (or of the Gram matrix for wide data)
+        "svd" uses the singular value decomposition of the normalized data
+        "randomized" computes only the first n_components with a randomized range finder, in about O(M*N*n_components) steps
+        "lanczos" computes only the first n_components with the Lanczos method of scipy.sparse.linalg.svds 
+        "auto" uses "randomized" when all directions it multiplies with the data, (n_components + n_oversamples) * (2 * n_iter + 2),
+               are few compared to M and N, and "eigh" otherwise
+    The components are stored as rows, and their signs are chosen so that the largest absolute element of every component is positive.
+    
+    With copy=False the data is normalized in place with normalize_matrix_inplace and keeps its float type (e.g. float32) 
+    through the decomposition, so fit needs no memory for copies of the data.
+    """
+    
+    def __init__(self, n_components=None, solver="auto", normalize=True, n_oversamples=10, n_iter=7, seed=0, copy=True, center=True):
+        """
+        Initiate the settings of an instance of class PCA
+        
+        Parameters:
+            n_components, integer representing the number of principal components to compute, or None for all of them
+            solver, string containing one of "auto", "eigh", "svd", "randomized", "lanczos"
+            normalize, boolean, if True the variables are z-score normalized, if False they are only centered
+            n_oversamples, integer representing the number of extra random directions used by the "randomized" solver
+            n_iter, integer representing the number of power iterations of the "randomized" solver
+            seed, integer used to seed the random generator of the "randomized" solver
+            copy, boolean, if True fit works on a float64 copy of the data, if False it normalizes the data in place, in its own float type
+            center, boolean, if False the data is taken as already centered, e.g. the normalized matrix of data_preparation.prepare_dataset, 
+                    so with normalize False too fit does not write to the data at all (a copy-on-write memory map stays shared)
+        """
+        if solver not in PCA_SOLVERS:
+            raise ValueError(f"solver should be one of {PCA_SOLVERS}, not {solver!r}")
+        self.n_components = n_components
+        self.solver = solver
+        self.normalize = normalize
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.seed = seed
+        self.copy = copy
+        self.center = center
+        self.selection = None #optional dictionary describing how the variables were selected before fit, which is saved with the model
+    
+    def _prepare(self, data_matrix):
+        """
+        Given a MxN numpy array, return it centered (and normalized) with the mean and std of this instance
+        """
+        return (np.asarray(data_matrix, dtype=float) - self.mean) / self.std
+    
+    @instrumented
+    def fit(self, data_matrix, genes=None):
+        """
+        Given a MxN numpy array, data_matrix, 
+        compute its mean and standard deviation per variable and its leading principal components
+        
+        Parameters:
+            data_matrix, a non-empty MxN numpy array of numbers, with M instances and N variables
+            genes, optional list of the N variable names, by default CellLineRMAExpression.allparskeys if it has length N
+        
+        Returns: this instance of class PCA, with the attributes
+                 genes, the list of N variable names, or None if they are unknown,
+                 mean and std, numpy arrays of length N with the mean and standard deviation of every variable,
+                 components, a KxN numpy array with in row i the unit eigenvector of principal component i,
+                 eigenvalues, a numpy array of length K with the variance along every principal component,
+                 total_variance, the sum of the variances of all normalized variables
+        """
+        data_matrix = np.asarray(data_matrix, dtype=float) if self.copy else _as_float(data_matrix)
+        nr_instances, nr_variables = data_matrix.shape
+        self.nr_instances, self.nr_variables = nr_instances, nr_variables
+        self.genes = _variable_names(genes, nr_variables)
+        if self.copy:
+            self.mean = data_matrix.mean(axis=0) if self.center else np.zeros(nr_variables) #get the mean of every variable at once
+            std = data_matrix.std(axis=0) if self.normalize else np.ones(nr_variables) #get the standard deviation of every variable, like normalize_list
+            self.std = np.where(std > 0, std, 1.0) #leave constant variables at zero instead of dividing by zero
+            data = self._prepare(data_matrix)
+            self.total_variance = np.einsum('ij,ij->', data, data) / (nr_instances-1) #the trace of the covariance matrix, without computing it
+        else:
+            if (self.center or self.normalize) and not data_matrix.flags.writeable:
+                raise ValueError("PCA with copy=False normalizes data_matrix in place, so it should be writeable")
+            mean, std = normalize_matrix_inplace(data_matrix, scale=self.normalize, center=self.center)
+            self.mean = mean if self.center else np.zeros(nr_variables)
+            self.std = np.where(std > 0, std, 1.0) if self.normalize else np.ones(nr_variables)
+            data = data_matrix
+            self.total_variance = float((std**2 / self.std**2).sum()) * nr_instances / (nr_instances-1) #the trace of the covariance matrix, from the statistics
+        
+        max_components = min(nr_instances, nr_variables)
+        n_components = max_components if self.n_components is None else min(self.n_components, max_components)
+        solver = self.solver
+        if solver == "auto": #the truncated solver only pays off when its products with the data, including oversamples and power iterations, are few
+            nr_products = (n_components + self.n_oversamples) * (2 * self.n_iter + 2)
+            solver = "randomized" if nr_products * RANDOMIZED_RATIO <= max_components else "eigh"
+        
+        if solver == "eigh":
+            eig_vals, eig_vecs = covariance_eigh(data) #all eigenvalues, from highest to lowest
+            eigenvalues, components = eig_vals[:n_components], eig_vecs[:, :n_components].T
+        elif solver == "svd":
+            _, singular_values, vt = np.linalg.svd(data, full_matrices=False) #the right singular vectors are the eigenvectors of the covariance matrix
+            eigenvalues, components = singular_values[:n_components]**2 / (nr_instances-1), vt[:n_components]
+        elif solver == "randomized":
+            singular_values, components = self._randomized_svd(data, n_components)
+            eigenvalues = singular_values**2 / (nr_instances-1)
+        else:
+            singular_values, components = self._lanczos_svd(data, n_components)
+            eigenvalues = singular_values**2 / (nr_instances-1)
+        
+        self.components = orient_components(components)
+        self.eigenvalues = np.maximum(eigenvalues, 0).astype(float) #eigenvalues of a covariance matrix are never negative, except by rounding
+        return self
+    
+    def _randomized_svd(self, data, n_components):
+        """
+        Given a normalized MxN numpy array and an integer K, 
+        compute its K largest singular values and right singular vectors with a randomized range finder (Halko et al., 2011)
+        
+        Returns: a tuple of a numpy array with the K singular values and a KxN numpy array with the right singular vectors as rows
+        """
+        rng = np.random.default_rng(self.seed)
+        nr_directions = min(n_components + self.n_oversamples, min(data.shape)) #sample some extra directions for accuracy
+        basis = data @ rng.standard_normal((data.shape[1], nr_directions), dtype=data.dtype) #random sample of the range of the data, MxK, in the float type of the data
+        basis, _ = np.linalg.qr(basis)
+        for _ in range(self.n_iter): #power iterations, so the basis concentrates on the leading components
+            basis, _ = np.linalg.qr(data.T @ basis)
+            basis, _ = np.linalg.qr(data @ basis)
+        _, singular_values, vt = np.linalg.svd(basis.T @ data, full_matrices=False) #exact SVD of the small projected matrix
+        return singular_values[:n_components], vt[:n_components]
+    
+    def _lanczos_svd(self, data, n_components):
+        """
+        Given a normalized MxN numpy array and an integer K, 
+        compute its K largest singular values and right singular vectors with the Lanczos method of scipy
+        
+        Returns: a tuple of a numpy array with the K singular values and a KxN numpy array with the right singular vectors as rows
+        """
+        try:
+            from scipy.sparse.linalg import svds
+        except ImportError as error:
+            raise ImportError("the 'lanczos' solver of PCA requires scipy, install it or use the 'randomized' solver") from error
+        n_components = min(n_components, min(data.shape) - 1) #svds can not compute all singular values
+        _, singular_values, vt = svds(data, k=n_components, random_state=self.seed)
+        order = np.argsort(singular_values)[::-1] #svds returns the singular values from lowest to highest
+        return singular_values[order], vt[order]
+    
+    @instrumented
+    def transform(self, data_matrix, n_components=None):
+        """
+        Given a MxN numpy array, data_matrix, 
+        project its instances onto the first n_components principal components
+        
+        Parameters:
+            data_matrix, a non-empty MxN numpy array of numbers, with the same N variables as the fitted data
+            n_components, integer representing the number of principal components to project onto, or None for all fitted ones
+        
+        Returns: a Mxn_components numpy array with the coordinates of the instances in the new subspace
+        """
+        return self._prepare(data_matrix) @ self.components[:n_components].T
+    
+    def fit_transform(self, data_matrix, n_components=None):
+        """
+        Fit the principal components of data_matrix and project it onto the first n_components of them
+        """
+        return self.fit(data_matrix).transform(data_matrix, n_components)
+    
+    def explained_variance(self):
+        """
+        Returns: a numpy array with the fraction of the total variance explained by every principal component
+        """
+        return self.eigenvalues / self.total_variance
+    
+    def loadings(self):
+        """
+        Returns: a KxN numpy array with in row i the loadings of principal component i: its eigenvector times the square root of its eigenvalue
+        """
+        return self.components * np.sqrt(self.eigenvalues)[:, None]
+    
+    def prepend_normalization(self, mean, std):
+        """
+        Given the mean and standard deviation with which the fitted data was normalized before calling fit, 
+        create a copy of this instance that projects the original, unnormalized data
+        
+        Parameters:
+            mean, a numpy array of length N with the mean that was subtracted from every variable
+            std, a numpy array of length N with the standard deviation by which every variable was divided (0 for constant ones)
+        
+        Returns: a new instance of class PCA
+        """
+        std = np.where(np.asarray(std) > 0, std, 1.0) #constant variables were not divided, like in prepare_dataset
+        model = copy.copy(self)
+        model.mean = np.asarray(mean) + std * self.mean #(x - mean - std * self.mean) / (std * self.std) is the combined normalization
+        model.std = std * self.std
+        return model
+    
+    def save(self, path):
+        """
+        Save the fitted model to an uncompressed .npz file, which can be loaded with PCA.load
+        
+        Parameters:
+            path, string containing the path of the file
+        """
+        genes = np.array(self.genes if self.genes is not None else [], dtype=str)
+        np.savez(path, mean=self.mean, std=self.std, components=self.components, eigenvalues=self.eigenvalues, genes=genes,
+                 total_variance=self.total_variance, nr_instances=self.nr_instances, normalize=self.normalize,
+                 selection=json.dumps(self.selection)) #as text, so the file can be loaded without pickle
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Load a fitted model saved with PCA.save
+        
+        Parameters:
+            path, string containing the path of the file
+        
+        Returns: a fitted instance of this class
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            model = cls(n_components=len(arrays["components"]), normalize=bool(arrays["normalize"]))
+            model.mean, model.std = arrays["mean"], arrays["std"]
+            model.components, model.eigenvalues = arrays["components"], arrays["eigenvalues"]
+            model.total_variance, model.nr_instances = float(arrays["total_variance"]), int(arrays["nr_instances"])
+            model.nr_variables = len(model.mean)
+            model.genes = list(arrays["genes"]) if len(arrays["genes"]) else None
+            model.selection = json.loads(str(arrays["selection"])) if "selection" in arrays.files else None #not saved by older versions
+        return model
+
+class PCAProjector:
+    """
+    Class used to project new samples onto the principal components of a fitted PCA model, with low latency.
+    
+    The normalization and projection are folded into one NxK matrix and one offset, so projecting a batch is a single matrix product. 
+    Samples can be given as CellLineRMAExpression instances, pandas dataframes or numpy arrays, 
+    and their genes are reordered by name to the gene order of the model. 
+    Large batches are split in micro-batches, which are projected in parallel by a pool of threads.
+    """
+    
+    def __init__(self, model, n_components=None, batch_size=1024, max_workers=None):
+        """
+        Initiate an instance of class PCAProjector
+        
+        Parameters:
+            model, a fitted instance of class PCA, or the path of a model saved with PCA.save
+            n_components, integer representing the number of principal components to project onto, or None for all of them
+            batch_size, integer representing the number of samples per micro-batch
+            max_workers, integer representing the number of threads, or None for the default of ThreadPoolExecutor
+        """
+        if isinstance(model, (str, os.PathLike)): model = PCA.load(model)
+        self.model = model
+        self.genes = model.genes
+        self.gene_index = None if model.genes is None else {gene: i for i, gene in enumerate(model.genes)}
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._orders = {} #the reordering of previously seen gene lists, so it is computed only once per gene list
+        
+        components = model.components[:n_components]
+        self.weights = np.ascontiguousarray((components / model.std).T) #NxK: normalization and projection in one matrix
+        self.offset = (model.mean / model.std) @ components.T #the projection of the mean, subtracted after the product
+    
+    def _order(self, genes):
+        """
+        Given a list of gene names, return the index array that reorders them to the gene order of the model, 
+        or None if they already are in that order
+        """
+        key = tuple(genes)
+        if key not in self._orders:
+            if self.gene_index is None:
+                raise ValueError("the model has no gene names, so samples can not be reordered by gene name")
+            if list(key) == self.genes: self._orders[key] = None
+            else:
+                position = {gene: i for i, gene in enumerate(key)}
+                missing = [gene for gene in self.genes if gene not in position]
+                if missing: raise KeyError(f"{len(missing)} genes of the model are missing, e.g. {missing[:5]}")
+                self._orders[key] = np.array([position[gene] for gene in self.genes])
+        return self._orders[key]
+    
+    def _as_matrix(self, batch, genes=None):
+        """
+        Given samples in one of the accepted formats, return a BxN numpy array in the gene order of the model
+        """
+        if isinstance(batch, CellLineRMAExpression): batch = [batch]
+        if isinstance(batch, pd.DataFrame): batch, genes = batch.to_numpy(dtype=float), list(batch.columns)
+        elif isinstance(batch, (list, tuple)) and len(batch) and isinstance(batch[0], CellLineRMAExpression):
+            genes = batch[0].store.genes
+            batch = load_RMAExp_to_matrix(batch) #without copying if the instances are the rows of one store
+        matrix = np.asarray(batch, dtype=float)
+        if matrix.ndim == 1: matrix = matrix[None, :]
+        if genes is not None:
+            order = self._order(genes)
+            if order is not None: matrix = matrix[:, order]
+        if matrix.shape[1] != len(self.weights):
+            raise ValueError(f"samples should have {len(self.weights)} genes, not {matrix.shape[1]}")
+        return matrix
+    
+    def _project(self, matrix):
+        return matrix @ self.weights - self.offset
+    
+    @instrumented
+    def project(self, batch, genes=None):
+        """
+        Given a batch of samples, project them onto the principal components of the model
+        
+        Parameters:
+            batch, one of: a list of CellLineRMAExpression instances, a pandas dataframe with the genes as columns,
+                   or a BxN (or length N) numpy array of numbers
+            genes, optional list of the gene names of the columns of a numpy array batch, 
+                   if not given the columns should be in the gene order of the model
+        
+        Returns: a BxK numpy array with the coordinates of the samples in the principal component subspace
+        """
+        matrix = self._as_matrix(batch, genes)
+        if len(matrix) <= self.batch_size: return self._project(matrix)
+        
+        starts = range(0, len(matrix), self.batch_size)
+        result = np.empty((len(matrix), self.weights.shape[1]))
+        with ThreadPoolExecutor(self.max_workers) as pool: #numpy releases the GIL during the matrix products
+            for start, projected in zip(starts, pool.map(lambda start: self._project(matrix[start:start+self.batch_size]), starts)):
+                result[start:start+len(projected)] = projected
+        return result
+
+class RunningStats:
+    """
+    Class used to keep the number of instances, the mean and the sum of squared deviations of every variable up to date
+    while batches of instances arrive, in one pass over the data. 
+    Batches are merged with the pairwise form of Welford's algorithm (Chan et al., 1979), 
+    which is numerically stable and gives the same mean and variance as normalize_list on all data at once.
+    """
+    
+    def __init__(self):
+        """
+        Initiate an empty instance of class RunningStats
+        """
+        self.count = 0 #the number of instances seen so far
+        self.mean = None #the mean of every variable
+        self.m2 = None #the sum of squared deviations from the mean of every variable
+    
+    def update(self, batch):
+        """
+        Given a BxN numpy array, batch, merge its instances into the statistics
+        
+        Parameters:
+            batch, a non-empty BxN numpy array of numbers, with B instances of the N variables
+        
+        Returns: a tuple of the difference between the batch mean and the previous mean, and the previous count,
+                 which are needed to update a running covariance in the same way
+        """
+        batch = np.asarray(batch, dtype=float)
+        batch_count = batch.shape[0]
+        batch_mean = batch.mean(axis=0)
+        batch_m2 = ((batch - batch_mean)**2).sum(axis=0)
+        previous_count = self.count
+        if self.count == 0:
+            self.count, self.mean, self.m2 = batch_count, batch_mean, batch_m2
+            return np.zeros_like(batch_mean), previous_count
+        
+        delta = batch_mean - self.mean
+        self.count += batch_count
+        self.mean = self.mean + delta * batch_count / self.count
+        self.m2 = self.m2 + batch_m2 + delta**2 * previous_count * batch_count / self.count
+        return delta, previous_count
+    
+    def variance(self, ddof=0):
+        """
+        Returns: a numpy array with the variance of every variable, dividing by count - ddof
+        """
+        return self.m2 / (self.count - ddof)
+    
+    def std(self, ddof=0):
+        """
+        Returns: a numpy array with the standard deviation of every variable, dividing by count - ddof
+        """
+        return np.sqrt(self.variance(ddof))
+
+INCREMENTAL_MODES = ("covariance", "sketch")
+
+class IncrementalPCA(PCA):
+    """
+    Class used to fit the principal components of instances that arrive in batches, with partial_fit, 
+    without refitting the data that was already seen. The data is z-score normalized with the running statistics of RunningStats.
+    
+    Two modes are available:
+        "covariance" keeps the running NxN co-moment matrix, and gives exactly the same components as PCA on all data,
+                     but every update costs O(B*N^2) steps and the eigendecomposition O(N^3)
+        "sketch" keeps only the n_components leading singular values and vectors (Ross et al., 2008), 
+                 so every update costs O((n_components+B)^2 * N) steps, proportional to the batch size.
+                 The sketch is an approximation, which can be compared with a full refit with drift
+    The fitted attributes and the transform, explained_variance and loadings methods are the same as of class PCA.
+    """
+    
+    def __init__(self, n_components=10, mode="sketch", normalize=True):
+        """
+        Initiate the settings of an instance of class IncrementalPCA
+        
+        Parameters:
+            n_components, integer representing the number of principal components to keep
+            mode, string containing one of "covariance", "sketch"
+            normalize, boolean, if True the variables are z-score normalized, if False they are only centered
+        """
+        if mode not in INCREMENTAL_MODES:
+            raise ValueError(f"mode should be one of {INCREMENTAL_MODES}, not {mode!r}")
+        super().__init__(n_components, solver="eigh", normalize=normalize)
+        self.mode = mode
+        self.reset()
+    
+    def reset(self):
+        """
+        Forget all data seen so far
+        """
+        self.stats = RunningStats()
+        self.comoment = None #the running sum of cross products of the centered variables, in "covariance" mode
+        self.sketch = None #the singular values times the right singular vectors of the normalized data, in "sketch" mode
+        self.nr_instances = 0
+        self.genes = None
+    
+    def _scale(self):
+        """
+        Returns: a numpy array with the current standard deviation of every variable, 1 for constant ones
+        """
+        if not self.normalize: return np.ones_like(self.stats.mean)
+        std = self.stats.std()
+        return np.where(std > 0, std, 1.0)
+    
+    @instrumented
+    def partial_fit(self, batch, genes=None):
+        """
+        Given a BxN numpy array, batch, with new instances, 
+        update the running statistics and the leading principal components
+        
+        Parameters:
+            batch, a non-empty BxN numpy array of numbers, with the same N variables as the previous batches
+            genes, optional list of the N variable names, by default the names of the previous batches, 
+                   or CellLineRMAExpression.allparskeys if it has length N
+        
+        Returns: this instance of class IncrementalPCA
+        """
+        batch = np.asarray(batch, dtype=float)
+        previous_scale = None if self.stats.count == 0 else self._scale()
+        delta, previous_count = self.stats.update(batch)
+        count, nr_variables = self.stats.count, batch.shape[1]
+        self.nr_instances, self.nr_variables = count, nr_variables
+        if genes is not None or self.genes is None: self.genes = _variable_names(genes, nr_variables)
+        self.mean, self.std = self.stats.mean, self._scale()
+        correction = np.sqrt(previous_count * batch.shape[0] / count) * delta #accounts for the shift of the mean, like in RunningStats
+        
+        if self.mode == "covariance":
+            centered = batch - batch.mean(axis=0)
+            if self.comoment is None: self.comoment = np.zeros((nr_variables, nr_variables))
+            self.comoment += centered.T @ centered + np.outer(correction, correction) #the pairwise update of the co-moments
+            covariance = self.comoment / np.outer(self.std, self.std) / (count-1) #covariance of the normalized variables
+            eig_vals, eig_vecs = np.linalg.eigh(covariance)
+            eigenvalues, components = eig_vals[::-1][:self.n_components], eig_vecs[:, ::-1][:, :self.n_components].T
+        else:
+            rows = [(batch - batch.mean(axis=0)) / self.std, correction[None, :] / self.std] #the new batch and the mean shift, in normalized units
+            if self.sketch is not None: rows.insert(0, self.sketch * (previous_scale / self.std)) #rescale the sketch to the updated standard deviations
+            _, singular_values, vt = np.linalg.svd(np.vstack(rows), full_matrices=False)
+            singular_values, vt = singular_values[:self.n_components], vt[:self.n_components]
+            self.sketch = singular_values[:, None] * vt
+            eigenvalues, components = singular_values**2 / max(count-1, 1), vt
+        
+        self.components = orient_components(components)
+        self.eigenvalues = np.maximum(eigenvalues, 0)
+        self.total_variance = (self.stats.m2 / self.std**2).sum() / max(count-1, 1) #the trace of the covariance matrix of the normalized data
+        return self
+    
+    @instrumented
+    def fit(self, data_matrix, genes=None, batch_size=256):
+        """
+        Given a MxN numpy array, data_matrix, forget all data seen so far and fit it in batches of batch_size instances
+        
+        Parameters:
+            data_matrix, a non-empty MxN numpy array of numbers
+            genes, optional list of the N variable names, see PCA.fit
+            batch_size, integer representing the number of instances per batch
+        
+        Returns: this instance of class IncrementalPCA
+        """
+        self.reset()
+        for start in range(0, len(data_matrix), batch_size):
+            self.partial_fit(data_matrix[start:start+batch_size], genes)
+        return self
+    
+    def drift(self, data_matrix):
+        """
+        Given a MxN numpy array, data_matrix, containing all instances seen so far, 
+        compare the incrementally fitted components with a full refit of PCA
+        
+        Parameters:
+            data_matrix, a non-empty MxN numpy array of numbers
+        
+        Returns: a dictionary with
+                 "eigenvalues", the relative difference of every eigenvalue with the refit,
+                 "angles", the angle in degrees between every component and the corresponding refitted component,
+                 "subspace_angles", the principal angles in degrees between the spanned subspaces,
+                 "mean", the largest absolute difference of the running mean with the mean of data_matrix
+        """
+        full = PCA(len(self.components), solver="eigh", normalize=self.normalize).fit(data_matrix)
+        cosines = np.abs((self.components * full.components).sum(axis=1)) #eigenvectors are only defined up to their sign
+        singular_values = np.linalg.svd(self.components @ full.components.T, compute_uv=False)
+        return {"eigenvalues": (self.eigenvalues - full.eigenvalues) / full.eigenvalues,
+                "angles": np.degrees(np.arccos(np.clip(cosines, 0, 1))),
+                "subspace_angles": np.degrees(np.arccos(np.clip(singular_values, 0, 1))),
+                "mean": np.abs(self.mean - full.mean).max()}
@@ -1,14 +1,93 @@
 """
 This module holds the CellLineRMAExpression class, used to store the RMA expression information of cell lines
 
+The classes in this module:
+    RMAExpressionStore: a shared, contiguous MxN float array owning the RMA expression values of M cell lines
+    RMAExpressionRow: a dictionary-like view of one row of an RMAExpressionStore, keyed by gene name
+    CellLineRMAExpression: the information of one cell line, with its RMA expression stored as a row of an RMAExpressionStore
+    CellLineCollection: a collection of cell lines sharing one RMAExpressionStore, with indexes on their genes and metadata
+                        for fast subset queries
+
 The methods in this module: 
     initclassvars: used to initialize the class variable allparskeys                  
+    group_indexes: groups the indexes of the instances per label at once
 """
 
+from collections.abc import Mapping
+import numpy as np
+
+class RMAExpressionStore:
+    """
+    Class used to store the RMA expression values of many cell lines in one contiguous MxN float array,
+    with M the number of cell lines (rows) and N the number of genes (columns).
+    """
+    __slots__ = ("matrix", "genes", "gene_index")
+
+    def __init__(self, nr_instances, genes, dtype=float):
+        """
+        Initiate an empty store for nr_instances cell lines and the given genes
+
+        Parameters:
+            nr_instances, integer representing the number of cell lines (rows) to store
+            genes, list of strings containing the gene names (columns) to store
+            dtype, the numpy float type of the stored values
+        """
+        self.genes = list(genes) #store the gene names in column order
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)} #map every gene name to its column for constant time lookup
+        self.matrix = np.empty((nr_instances, len(self.genes)), dtype=dtype) #preallocate the contiguous array owning all values
+
+    @classmethod
+    def wrap(cls, matrix, genes):
+        """
+        Given a MxN numpy array and N gene names, create a store owning the array, without copying it
+
+        Parameters:
+            matrix, a MxN numpy array of numbers, with the RMA expression of M cell lines (rows) and N genes (columns)
+            genes, list of strings containing the N gene names
+
+        Returns: an instance of class RMAExpressionStore
+        """
+        store = cls(0, genes) #create the gene index, with an empty array
+        store.matrix = matrix
+        return store
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+class RMAExpressionRow(Mapping):
+    """
+    Class used as a read-only, dictionary-like view of the RMA expression values of one cell line in an RMAExpressionStore.
+    No values are copied: every lookup reads directly from the store.
+    """
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store, row):
+        """
+        Parameters:
+            store, the RMAExpressionStore holding the values
+            row, integer representing the row of the cell line in the store
+        """
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, gene):
+        return self._store.matrix[self._row, self._store.gene_index[gene]] #look up the column of the gene and read the value
+
+    def __iter__(self):
+        return iter(self._store.genes)
+
+    def __len__(self):
+        return len(self._store.genes)
+
+    def __contains__(self, gene):
+        return gene in self._store.gene_index
+
 class CellLineRMAExpression:
     """
     Class used to store the RMA expression values of a cell line.
+    The values themselves are owned by an RMAExpressionStore, of which this instance is a light row view.
     """
+    __slots__ = ("CellLineName", "CosmicID", "CancerType", "store", "row")
     allparskeys = []
     
     def __init__(self, CellLineName = 'AU565', CosmicID = '910704', CancerType='BRCA'):
@@ -23,19 +102,41 @@ class CellLineRMAExpression:
         self.CellLineName = CellLineName #assign given name to instance
         self.CosmicID = CosmicID #assign given cosmic ID to instance
         self.CancerType = CancerType #assign given cancer type to instance 
+        self.store = None #no RMAExpression values are loaded yet
+        self.row = None
         
-    def load_RMAExpression(self, values = [0]*len(allparskeys)):
+    def load_RMAExpression(self, values = [0]*len(allparskeys), store = None, row = None):
         """
         Given a list of numbers with the same length as allparskeys, values,
-        assign the given values to the corresponding genes in this instance, 
-        and store it in a dictionary with the gene names as keys. 
+        assign the given values to the corresponding genes in this instance.
+        If a store and row are given, the values are written into that row of the shared store,
+        otherwise a store of a single row is created for this instance.
         
         Parameters:
-            values, list of 244 numbers representing the RMAExpression of the genes defined in allparskeys of this instance
+            values, list of numbers representing the RMAExpression of the genes defined in allparskeys of this instance,
+                    or None if the values were already written in row of store
+            store, optional RMAExpressionStore with the genes of allparskeys, in which the values are stored
+            row, integer representing the row of this instance in store, required when store is given
+        """
+        if store is None: #no shared store given, so create one holding only this instance
+            store, row = RMAExpressionStore(1, CellLineRMAExpression.allparskeys), 0
+        if values is not None: store.matrix[row] = values #write the values into the row of this instance
+        self.store = store
+        self.row = row
+
+    @property
+    def RMAExp_dict(self):
+        """
+        Returns: a dictionary-like view of the RMAExpression values of this instance, with the gene names as keys
+        """
+        return RMAExpressionRow(self.store, self.row)
+
+    @property
+    def RMAExp_values(self):
         """
-        self.RMAExp_dict={} #create empty dictionary to store RMAExpression values in for this instance
-        for i in range(len(CellLineRMAExpression.allparskeys)): #loop over all genes specified in allparskeys
-            self.RMAExp_dict[CellLineRMAExpression.allparskeys[i]]=values[i] #assign corresponding values to the genes
+        Returns: a 1D numpy view of the RMAExpression values of this instance, in the order of allparskeys
+        """
+        return self.store.matrix[self.row]
         
 def initclassvars(l):
     """
@@ -46,4 +147,149 @@ def initclassvars(l):
     """
     CellLineRMAExpression.allparskeys=l
     
-    
\ No newline at end of file
+def group_indexes(labels, min_size=1):
+    """
+    Given a list of M labels, group the indexes of the instances per label at once, with a stable sort
+    
+    Parameters:
+        labels, a list (or numpy array) of M labels
+        min_size, integer representing the minimal number of instances of a group, smaller groups are left out
+
+    Returns: a dictionary with per label a numpy array of the indexes of its instances, in order of appearance of the labels
+    """
+    labels = np.asarray(labels)
+    unique_labels, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind='stable') #the indexes of the instances, grouped per label
+    groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(unique_labels)))[:-1])
+    return {unique_labels[i].item(): groups[i] for i in np.argsort(first) if len(groups[i]) >= min_size}
+
+class CellLineCollection:
+    """
+    Class used to query a collection of CellLineRMAExpression instances, whose RMA expression is stored in one RMAExpressionStore.
+
+    The gene names are looked up in the hash index of the store, and every metadata field has an inverted index from its
+    values to the positions of the cell lines, so a query takes one lookup per requested gene and value, and one gather
+    of the selected rows and columns from the store.
+    """
+    FIELDS = {"name": "CellLineName", "cosmic_id": "CosmicID", "tcga_label": "CancerType"} #the metadata fields, like the lookup_variables of AssignmentPCA
+
+    def __init__(self, instances):
+        """
+        Initiate an instance of class CellLineCollection, and index the genes and metadata of the given cell lines
+
+        Parameters:
+            instances, non-empty list of CellLineRMAExpression instances, with their RMA expression loaded in the same RMAExpressionStore,
+                       e.g. the list returned by AssignmentPCA.load_RMAExp_to_CellLines_bulk
+        """
+        self.instances = list(instances)
+        self.store = self.instances[0].store
+        if any(instance.store is not self.store for instance in self.instances):
+            raise ValueError("all instances of a CellLineCollection should share the same RMAExpressionStore")
+        self.rows = np.array([instance.row for instance in self.instances], dtype=np.intp) #the row of every cell line in the store
+        self.indexes = {field: group_indexes(np.asarray([getattr(instance, attribute) for instance in self.instances], dtype=str))
+                        for field, attribute in self.FIELDS.items()}
+
+    @classmethod
+    def from_matrix(cls, matrix, genes, names, cosmic_ids, labels):
+        """
+        Given the MxN RMA expression of M cell lines, and their N genes, names, cosmic IDs and labels,
+        create a collection of CellLineRMAExpression instances viewing the rows of matrix, without copying it
+
+        Parameters:
+            matrix, a MxN numpy array of numbers, e.g. the "matrix" of data_preparation.prepare_dataset
+            genes, list of strings containing the N gene names
+            names, cosmic_ids, labels, lists of M strings containing the name, cosmic ID and label (e.g. cancer type) of every cell line
+
+        Returns: an instance of class CellLineCollection
+        """
+        store = RMAExpressionStore.wrap(matrix, genes)
+        instances = [CellLineRMAExpression(CellLineName=name, CosmicID=cosmic_id, CancerType=label)
+                     for name, cosmic_id, label in zip(names, cosmic_ids, labels)]
+        for i, instance in enumerate(instances): instance.load_RMAExpression(None, store, i) #point every instance to its row
+        return cls(instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    @property
+    def genes(self):
+        """
+        Returns: the list of gene names, in the order of the columns of the store
+        """
+        return self.store.genes
+
+    def gene_columns(self, genes):
+        """
+        Given a list of gene names, return the columns of the genes in the store
+
+        Parameters:
+            genes, list of strings containing gene names
+
+        Returns: a numpy array of integers with the column of every gene
+        """
+        try:
+            return np.fromiter((self.store.gene_index[gene] for gene in genes), dtype=np.intp, count=len(genes))
+        except KeyError as error:
+            raise KeyError(f"gene {error.args[0]!r} is not in the RMA expression of this collection") from None
+
+    def where(self, **filters):
+        """
+        Given filters on the metadata fields, find the positions of the cell lines that pass all filters
+
+        Parameters:
+            filters, per field ("name", "cosmic_id" or "tcga_label") a value or a list of values, of which a cell line should have one
+
+        Returns: a sorted numpy array with the positions of the selected cell lines in this collection
+        """
+        selected = None #a bitmap of the selected cell lines, None while all are selected
+        for field, values in filters.items():
+            if field not in self.indexes:
+                raise ValueError(f"filters should be on one of {list(self.indexes)}, not {field!r}")
+            if isinstance(values, str) or not hasattr(values, "__iter__"): values = [values]
+            bitmap = np.zeros(len(self), dtype=bool)
+            for value in values: bitmap[self.indexes[field].get(str(value), [])] = True #the union of the positions of the values
+            selected = bitmap if selected is None else selected & bitmap #the intersection of the fields
+        return np.arange(len(self)) if selected is None else np.flatnonzero(selected)
+
+    def select(self, genes=None, **filters):
+        """
+        Given a list of genes and filters on the metadata fields,
+        get the RMA expression of the selected genes of the cell lines that pass all filters, with at most one gather
+
+        Parameters:
+            genes, optional list of strings containing the gene names, in the order of the columns to return, by default all genes
+            filters, per field ("name", "cosmic_id" or "tcga_label") a value or a list of values, see where
+
+        Returns: a numpy array with the RMA expression of the selected cell lines (rows) and genes (columns),
+                 a view of the store (no copy) if all genes and a consecutive range of rows are selected
+        """
+        rows = self.rows[self.where(**filters)] if filters else self.rows
+        if genes is None:
+            if len(rows) and np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))): #consecutive rows, so a slice suffices
+                return self.store.matrix[rows[0]:rows[0] + len(rows)]
+            return self.store.matrix[rows]
+        return self.store.matrix[np.ix_(rows, self.gene_columns(genes))] #gather the rows and columns at once
+
+    def subset(self, **filters):
+        """
+        Given filters on the metadata fields, get the cell lines that pass all filters
+
+        Parameters:
+            filters, per field ("name", "cosmic_id" or "tcga_label") a value or a list of values, see where
+
+        Returns: a list of CellLineRMAExpression instances
+        """
+        return [self.instances[i] for i in self.where(**filters)]
+
+    def values(self, field, **filters):
+        """
+        Given a metadata field and filters on the metadata fields, get the values of the field of the cell lines that pass all filters
+
+        Parameters:
+            field, string containing one of "name", "cosmic_id", "tcga_label"
+            filters, per field a value or a list of values, see where
+
+        Returns: a list with the value of field of every selected cell line
+        """
+        attribute = self.FIELDS[field]
+        return [getattr(self.instances[i], attribute) for i in self.where(**filters)]
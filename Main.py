@@ -2,6 +2,11 @@
 This module contains the PCA of the RMA expression in cancer cells
 It uses the methods from AssignmentPCA.py and plot_funcs.py, as well as the class from CellLineRMAExpressionModule.py
 
+Run it as a script, e.g.
+    python Main.py
+    python Main.py --compute-only --output pca_output --format tsv
+and 'python Main.py --help' for all options. The plot methods, and thereby matplotlib, are only imported when plots are made.
+
 First the data is loaded and formatted in the right way, with the following demands: 
     * The features of the data should be in the columns, with each row being an instance
     * The indexes of metadata and rma_expr should be corresponding in attribute and format
@@ -9,74 +14,227 @@ First the data is loaded and formatted in the right way, with the following dema
 
 Then PCA is executed: 
     * The data is prepared 
-    * Covariance, eigenvalues and eigenvectors are calculated
-    * Principal components are identified and visualized in plots
-    * Loadings of the principal components are visualized
-    * The explained variance is calculated and visualized
+    * The data is normalized and the leading eigenvalues and eigenvectors of its covariance are calculated
+    * Principal components are identified and visualized in plots, or written to files
+    * Loadings of the principal components are visualized, or written to files
+    * The explained variance is calculated and visualized, optionally with its confidence intervals and permutation threshold
+    * Optionally, the nearest cell lines of every cell line in the subspace of the first principal components are found and written to files
+
+The methods in this module:
+    parse_arguments: parses the command line arguments
+    write_results: writes the coordinates of the cell lines, the loadings, the explained variance and the nearest cell lines to files
+    main: runs the PCA analysis
 """
 
-from AssignmentPCA import getMaxIdxs, load_RMAExp_to_CellLines, load_RMAExp_to_matrix, normalize_matrix
-from plot_funcs import PCA_plot_3d, PCA_plot_2d, PCA_plot_loadings, PCA_plot_cumulative_explained_variance, PCA_plot_scree
-
+import argparse
+import logging
+import os
 import numpy as np
 import pandas as pd
-
-##### Data Preperation #####
-
-# Load the data from the tsv files
-metadata = pd.read_csv("Cell_lines and COSMIC_ID.tsv", sep='\t') 
-rma_expr = pd.read_csv("Cell_line_RMA_proc_basalExp.tsv", sep='\t')
-
-# Prepare the RMA_expression data
-rma_expr = rma_expr.T #transform the data so that the columns represent the features and the rows the instances
-rma_expr.columns = rma_expr.loc['GENE_SYMBOLS'] #set the names of the features as the column names
-rma_expr.dropna(axis=1, inplace=True) #drop all genes with nan values in the data
-
-# Prepare the metadata
-metadata.index = metadata['COSMIC_ID'].astype(str) #set the cosmic_id of the cell lines as the index
-metadata = metadata[~metadata.index.duplicated(keep='first')] #remove duplicated notations of the same cell line
-metadata = metadata[metadata['Tissue sub-type']!='UNCLASSIFIED'] #remove cell lines which are unclassified
-metadata = metadata[metadata.index.isin(rma_expr.index)] #remove cell lines of which no RMA_expression data is present in rma_expr
-metadata.dropna(axis=0, inplace=True) #drop all cell lines with nan values in the data
-
-##### PCA #####
-
-# Preparing the data for PCA 
-data = load_RMAExp_to_CellLines(metadata, rma_expr, metadata_labels=["Name", "COSMIC_ID", "Tissue sub-type"], lookup_variable="cosmic_id") #load the list of instances of class CellLineRMAExpression, and fill them with the RMA expression data
-data_matrix = load_RMAExp_to_matrix(data) #load the RMA Expression data of all instances in the data list to a numpy array
-data_matrix_norm = normalize_matrix(data_matrix) #normalize the RMA Expression data per gene
-
-# Execute PCA
-cov_matrix = np.cov(data_matrix_norm, rowvar=False) #covariance_matrix(data_matrix_norm) #calculate the covariance matrix for the normalized RMA expression data using the covariance_matrix method
-eig_vals, eig_vecs = np.linalg.eig(cov_matrix) #calculate the eigenvalues and eigenvectors of the covariance matrix
-
-nr_PC = 3 #determine how many principle components to investigate (normally no more then 3)
-idxs = getMaxIdxs(eig_vals, nr_PC) #get the indexes of the 3 maximal eigenvalues 
-loadings = [vec * val**0.5 for vec, val in zip(eig_vecs[idxs], eig_vals[idxs])] #calculate the loadings for the 3 principal components
-
-# Read in the labels for the plots 
-labels = [instance.CancerType for instance in data] #load the labels (e.g. cancer types) of the instances, by iterating over all instances and loading their CancerType attribute
-targets = list(set(labels)) #extract all unique options occurring in labels, and store them in a list
-
-# 2D plot
-matrix_w_2d = np.vstack([eig_vecs[idxs[:2]]]).T #get the eigenvectors corresponding to the 2 maximal eigenvalues, and store them in a matrix 
-new_2d_subspace = data_matrix_norm.dot(matrix_w_2d).real #calculate the new subspace, based on the two principal components
-PCA_plot_2d(labels, targets, new_2d_subspace) #plot the cell lines in the new subspace, coloured by their label
-
-# 3D plot
-matrix_w_3d = np.vstack([eig_vecs[idxs[:3]]]).T #get the eigenvectors corresponding to the 3 maximal eigenvalues, and store them in a matrix 
-new_3d_subspace = data_matrix_norm.dot(matrix_w_3d).real #calculate the new subspace, based on the two principal components
-PCA_plot_3d(labels, targets, new_3d_subspace) #plot the cell lines in the new 3D subspace, coloured by their label
-
-# Loading plot
-PCA_plot_loadings(loadings, 50) #make a loading plot for each of the principal components
-
-# Analysis of the results by an explained variance plot and a scree plot 
-nr_PC = 200 #for evaluation, check more principal components
-idxs = getMaxIdxs(eig_vals, nr_PC) #get the indexes of the 200 maximal eigenvalues 
-
-explained_variance = eig_vals[idxs] / sum(eig_vals)
-PCA_plot_cumulative_explained_variance(explained_variance.real, len(eig_vals))
-PCA_plot_scree(explained_variance.real)
-
-
+from AssignmentPCA import PCA
+from CellLineRMAExpressionModule import initclassvars, CellLineCollection
+from data_preparation import prepare_dataset
+from dataset_cache import DatasetCache
+from parallel_pca import min_permutations, stability_analysis, grouped_pca
+from neighbours import NeighbourIndex
+from instrumentation import enable, disable, stage, summary, peak_resident_bytes, LogSink, ChromeTraceSink
+
+OUTPUT_FORMATS = ("csv", "tsv", "npz")
+
+def parse_arguments(argv=None):
+    """
+    Given a list of command line arguments, parse them
+
+    Parameters:
+        argv, optional list of strings, by default the arguments of the script
+
+    Returns: an argparse.Namespace with the options of the PCA analysis
+    """
+    parser = argparse.ArgumentParser(description="PCA of the RMA expression of cancer cell lines")
+    parser.add_argument("--metadata", default="Cell_lines and COSMIC_ID.tsv", help="the metadata tsv file")
+    parser.add_argument("--expression", default="Cell_line_RMA_proc_basalExp.tsv", help="the RMA expression tsv file")
+    parser.add_argument("--name-column", default="Name", help="the column of the metadata with the names of the cell lines")
+    parser.add_argument("--id-column", default="COSMIC_ID", help="the column of the metadata with the cosmic IDs of the cell lines")
+    parser.add_argument("--label-column", default="Tissue sub-type", help="the column of the metadata with the labels (e.g. cancer types) of the cell lines")
+    parser.add_argument("--lookup", default="cosmic_id", choices=["name", "cosmic_id", "tcga_label"], help="the variable to align the metadata and RMA expression on")
+    parser.add_argument("--exclude-labels", nargs="*", default=["UNCLASSIFIED"], help="the labels of the cell lines to remove")
+    parser.add_argument("--components", type=int, default=200, help="the number of principal components to calculate")
+    parser.add_argument("--pcs", type=int, default=3, help="the number of principal components to plot and write the coordinates and loadings of")
+    parser.add_argument("--loading-genes", type=int, default=50, help="the number of genes per loading plot")
+    parser.add_argument("--top-genes", type=int, help="keep only this number of genes with the highest variance before the PCA")
+    parser.add_argument("--lean", action="store_true", help="keep the RMA expression in one float32 array, normalize it in place and report the peak memory")
+    parser.add_argument("--no-cache", action="store_true", help="prepare the data again, instead of loading it from the cache")
+    parser.add_argument("--cache-directory", default=".dataset_cache", help="the directory of the cache of prepared data")
+    parser.add_argument("--model", help="the file to save the PCA model to, for projecting new cell lines with PCAProjector, 'pca_model.npz' in the output directory by default")
+    parser.add_argument("--compute-only", action="store_true", help="do not make plots, only write the results to the output directory")
+    parser.add_argument("--output", help="the directory to write the coordinates, loadings and explained variance to, 'pca_output' with --compute-only")
+    parser.add_argument("--format", default="csv", choices=OUTPUT_FORMATS, help="the format of the written results")
+    parser.add_argument("--plot-directory", help="write the plots to files in this directory, instead of showing them")
+    parser.add_argument("--resamples", type=int, default=0, help=f"the number of bootstrap resamples and permutations of the stability analysis, 0 to skip it, at least {min_permutations()} permutations are used")
+    parser.add_argument("--per-label", action="store_true", help="fit a PCA model on the cell lines of every label, and compare their first principal components")
+    parser.add_argument("--neighbours", type=int, default=0, help="the number of nearest cell lines to find for every cell line, 0 to skip it")
+    parser.add_argument("--neighbour-pcs", type=int, default=10, help="the number of principal components of the subspace in which the nearest cell lines are found")
+    parser.add_argument("--neighbour-index", help="the file to save the index of the nearest cell lines to, for loading it with NeighbourIndex.load, 'neighbour_index.npz' in the output directory by default")
+    parser.add_argument("--trace", help="record every stage, and write a Chrome trace to this file")
+    arguments = parser.parse_args(argv)
+    if arguments.compute_only and arguments.output is None: arguments.output = "pca_output"
+    if arguments.model is None and arguments.output is not None: arguments.model = os.path.join(arguments.output, "pca_model.npz") #without an output directory the model is only saved when asked
+    if arguments.neighbour_index is None and arguments.output is not None: arguments.neighbour_index = os.path.join(arguments.output, "neighbour_index.npz")
+    return arguments
+
+def write_results(directory, output_format, cell_lines, coordinates, loadings, genes, explained_variance, neighbours=None):
+    """
+    Given the cell lines and the results of the PCA,
+    write the coordinates of the cell lines, the loadings of the genes and the explained variance to files in directory
+
+    Parameters:
+        directory, string containing the path of the directory, which is created if it does not exist
+        output_format, string containing one of "csv", "tsv" (one file per table) or "npz" (one file with all arrays)
+        cell_lines, the CellLineCollection of the M cell lines
+        coordinates, a MxK numpy array with the coordinates of the cell lines on the first K principal components
+        loadings, a KxN numpy array with the loadings of the N genes on the first K principal components
+        genes, a list of the N gene names
+        explained_variance, a numpy array with the explained variance of every calculated principal component
+        neighbours, optional tuple of two Mxk numpy arrays, the rows of the k nearest cell lines of every cell line and their distances
+
+    Returns: a list of the paths of the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    names, cosmic_ids, labels = cell_lines.values("name"), cell_lines.values("cosmic_id"), cell_lines.values("tcga_label")
+    if output_format == "npz":
+        path = os.path.join(directory, "pca_results.npz")
+        arrays = {} if neighbours is None else {"neighbour_rows": neighbours[0], "neighbour_distances": neighbours[1]}
+        np.savez(path, coordinates=coordinates, loadings=loadings, explained_variance=explained_variance, genes=np.asarray(genes, dtype=str),
+                 names=np.asarray(names, dtype=str), cosmic_ids=np.asarray(cosmic_ids, dtype=str), labels=np.asarray(labels, dtype=str), **arrays)
+        return [path]
+
+    pcs = [f"PC{i+1}" for i in range(coordinates.shape[1])]
+    tables = {"coordinates": pd.DataFrame(coordinates, columns=pcs).assign(name=names, cosmic_id=cosmic_ids, label=labels)[["name", "cosmic_id", "label"] + pcs],
+              "loadings": pd.DataFrame(loadings.T, index=pd.Index(genes, name="gene"), columns=pcs).reset_index(),
+              "explained_variance": pd.DataFrame({"PC": np.arange(1, len(explained_variance)+1), "explained_variance": explained_variance,
+                                                  "cumulative": np.cumsum(explained_variance)})}
+    if neighbours is not None:
+        rows, distances = neighbours
+        k = rows.shape[1]
+        tables["neighbours"] = pd.DataFrame({"name": np.repeat(names, k), "rank": np.tile(np.arange(1, k+1), len(rows)),
+                                             "neighbour": np.asarray(names, dtype=object)[rows.ravel()], "neighbour_cosmic_id": np.asarray(cosmic_ids, dtype=object)[rows.ravel()],
+                                             "distance": distances.ravel()})
+    paths = []
+    for name, table in tables.items():
+        paths.append(os.path.join(directory, f"{name}.{output_format}"))
+        table.to_csv(paths[-1], sep="\t" if output_format == "tsv" else ",", index=False)
+    return paths
+
+def main(argv=None):
+    """
+    Run the PCA analysis with the given command line arguments, see parse_arguments
+    """
+    arguments = parse_arguments(argv)
+    if arguments.trace is not None:
+        logging.basicConfig(level=logging.INFO, format="%(message)s") #show the log line of every stage on the console
+        enable(LogSink(), ChromeTraceSink(arguments.trace)) #record the time, calls, bytes and shapes of every stage
+
+    ##### Data Preperation #####
+
+    input_files = [arguments.metadata, arguments.expression] #the metadata and RMA expression tsv files
+    options = dict(metadata_labels=[arguments.name_column, arguments.id_column, arguments.label_column], lookup_variable=arguments.lookup, #the columns and lookup variable to align the data on
+                   exclude_labels=arguments.exclude_labels, #remove cell lines which are unclassified
+                   use_chunked_reader=True, #read the RMA expression in chunks directly into a cell-line-major array, instead of reading and transposing it whole
+                   dtype="float32" if arguments.lean else "float64", #the float type of the RMA expression
+                   top_genes=arguments.top_genes) #keep only the genes with the highest variance before the PCA, or all genes
+
+    # Load the data from the tsv files, remove duplicated, unclassified and unmeasured cell lines,
+    # align the metadata with the RMA expression and normalize the RMA expression per gene
+    with stage("data preparation"):
+        if arguments.no_cache: dataset = prepare_dataset(*input_files, **options)
+        else: dataset = DatasetCache(arguments.cache_directory).get_or_prepare(prepare_dataset, input_files, **options) #read-only memory maps, the PCA does not write to the normalized matrix
+
+    ##### PCA #####
+
+    # Preparing the data for PCA
+    data_matrix = dataset["matrix"] #the normalized RMA expression of all cell lines
+    genes = list(dataset["genes"])
+    initclassvars(genes) #assign gene names to class variable 'allparskeys'
+    cell_lines = CellLineCollection.from_matrix(data_matrix, genes, dataset["names"], dataset["cosmic_ids"], dataset["labels"]) #index the cell lines by gene and metadata, e.g. cell_lines.select(genes, tcga_label=["BRCA", "LUAD"])
+
+    # Execute PCA
+    nr_PC = arguments.pcs #determine how many principle components to investigate (normally no more then 3)
+    with stage("PCA", data_matrix=data_matrix):
+        pca = PCA(n_components=arguments.components, copy=not arguments.lean, normalize=False, center=False).fit(data_matrix) #calculate the maximal eigenvalues and their eigenvectors, of the already normalized data without writing to it
+        loadings = pca.loadings()[:nr_PC] #calculate the loadings for the first principal components
+        pca.selection = {"top_genes": arguments.top_genes, "nr_candidate_genes": int(dataset["nr_candidate_genes"])} #record the gene selection with the model
+        if arguments.model is not None:
+            os.makedirs(os.path.dirname(arguments.model) or ".", exist_ok=True)
+            pca.prepend_normalization(dataset["mean"], dataset["std"]).save(arguments.model) #save the model, so new cell lines can be projected with PCAProjector
+            print(f"written {arguments.model}")
+
+    # Read in the labels for the plots
+    labels = cell_lines.values("tcga_label") #load the labels (e.g. cancer types) of the cell lines
+    targets = list(set(labels)) #extract all unique options occurring in labels, and store them in a list
+
+    explained_variance = pca.explained_variance() #the fraction of the total variance explained by each of the calculated principal components
+    coordinates = pca.transform(data_matrix, nr_PC) #calculate the new subspace, based on the first principal components
+
+    # Analysis of the stability of the first principal components, by bootstrap resampling and permutation in parallel processes
+    stability = None
+    if arguments.resamples > 0:
+        with stage("stability analysis"):
+            n_permutations = max(arguments.resamples, min_permutations()) #with fewer permutations the p-values can not reach the significance level
+            stability = stability_analysis(data_matrix, n_components=10, n_bootstraps=arguments.resamples, n_permutations=n_permutations, nr_genes=arguments.loading_genes)
+        print(f"{stability['nr_significant']} significant principal components, by {n_permutations} permutations") #the number of principal components explaining more variance than by chance
+
+    # PCA of the cell lines of every label separately, in parallel processes
+    if arguments.per_label:
+        with stage("PCA per label"):
+            grouped = grouped_pca(data_matrix, labels, n_components=10, min_size=10, n_compare=3)
+        for label, similarity in zip(grouped["labels"], grouped["subspace_similarity"]):
+            others = [value for other, value in zip(grouped["labels"], similarity) if other != label] #the overlap with the subspaces of the other labels
+            print(f"{label}: {len(grouped['indexes'][label])} cell lines, PC1 explains {grouped['models'][label].explained_variance()[0]:.1%}, overlap with the other labels {np.mean(others) if others else float('nan'):.2f}")
+
+    # The nearest cell lines of every cell line in the subspace of the first principal components
+    neighbours = None
+    if arguments.neighbours > 0:
+        with stage("neighbours"):
+            index = NeighbourIndex.from_pca(pca, data_matrix, cell_lines, n_components=min(arguments.neighbour_pcs, len(pca.components))) #a KD-tree for few principal components
+            neighbours = index.knn_rows(np.arange(len(index)), arguments.neighbours) #all cell lines as one batch
+            if arguments.neighbour_index is not None:
+                os.makedirs(os.path.dirname(arguments.neighbour_index) or ".", exist_ok=True)
+                index.save(arguments.neighbour_index) #query it later with NeighbourIndex.load(path).similar("name or cosmic ID")
+                print(f"written {arguments.neighbour_index}")
+
+    if arguments.output is not None:
+        with stage("write results"):
+            for path in write_results(arguments.output, arguments.format, cell_lines, coordinates, loadings, genes, explained_variance, neighbours): print(f"written {path}")
+
+    if not arguments.compute_only:
+        with stage("plots"):
+            from plot_funcs import PCA_plot_3d, PCA_plot_2d, PCA_plot_loadings, PCA_plot_cumulative_explained_variance, PCA_plot_scree, render_PCA_plots #import matplotlib only when plotting
+            if arguments.plot_directory is not None:
+                # Write all plots to files, rendered in parallel without a display
+                render_PCA_plots(arguments.plot_directory, labels, coordinates, loadings, arguments.loading_genes, explained_variance=explained_variance, nr_pcs=pca.nr_variables, stability=stability)
+            else:
+                ci = None if stability is None else (stability["ci_low"], stability["ci_high"])
+                cumulative_ci = None if stability is None else (stability["cumulative_ci_low"], stability["cumulative_ci_high"])
+                null = None if stability is None else stability["null_threshold"]
+
+                # 2D plot
+                PCA_plot_2d(labels, targets, coordinates[:, :2]) #plot the cell lines in the subspace of the first two principal components, coloured by their label
+
+                # 3D plot
+                if nr_PC >= 3: PCA_plot_3d(labels, targets, coordinates[:, :3]) #plot the cell lines in the 3D subspace of the first three principal components
+
+                # Loading plot
+                PCA_plot_loadings(loadings, arguments.loading_genes) #make a loading plot for each of the principal components
+
+                # Analysis of the results by an explained variance plot and a scree plot
+                PCA_plot_cumulative_explained_variance(explained_variance, pca.nr_variables, ci=cumulative_ci)
+                PCA_plot_scree(explained_variance, ci=ci, null=null)
+
+    if arguments.lean and peak_resident_bytes() is not None: print(f"peak memory: {peak_resident_bytes() / 2**20:.0f} MiB") #the peak footprint of the whole run
+
+    if arguments.trace is not None:
+        disable() #write the trace file
+        for name, stats in summary().items(): print(f"{name}: {stats['calls']} calls, {stats['seconds']:.3f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+"""
+This module contains benchmarks of the methods used in the PCA analysis of the RMA expression in cancer cells
+Run it as a script to benchmark every stage of the Main.py pipeline on synthetic data, e.g.
+    python benchmarks.py --sizes 148x244 1000x2000 --history benchmark_history.json
+and 'python benchmarks.py --help' for all options.
+
+Every stage is timed (best of repeat runs) and its peak memory is measured with tracemalloc in a separate run.
+The results are appended to a JSON history file, and compared with the previous run in that file to detect regressions.
+Stages that would take far too long for a size (e.g. the pure Python covariance loop on 20000 genes) are skipped, and make no inputs.
+The tsv readers used by Main.py are timed on a synthetic tsv file with the layout of Cell_line_RMA_proc_basalExp.tsv.
+The cold start of the command line entry point (imports and argument parsing in a new process) is tracked in the same history.
+
+The methods in this module:
+    make_synthetic_data: creates metadata and RMA expression dataframes with the same layout as the GDSC files
+    write_synthetic_files: writes synthetic metadata and RMA expression csv files with the same layout as the GDSC files
+    write_synthetic_tsv: writes a synthetic RMA expression tsv file with the same layout as Cell_line_RMA_proc_basalExp.tsv
+    time_call: measures the best wall time of repeated calls of a function
+    peak_memory: measures the peak memory allocated during one call of a function
+    benchmark_lean: compares the time, peak memory and accuracy of the float32 in-place PCA with the float64 PCA
+    benchmark_neighbours: measures the time per query of the KD-tree and batched distance methods of NeighbourIndex for growing numbers of cell lines
+    benchmark_loaders: compares load_RMAExp_to_CellLines with load_RMAExp_to_CellLines_bulk for growing numbers of cell lines
+    pipeline_stages: creates the benchmark stages of the Main.py pipeline for one dataset
+    benchmark_pipeline: runs the benchmark stages for every size
+    benchmark_cold_start: measures the wall time of importing the modules and starting Main.py in a new python process
+    append_history: appends the results of a run to the JSON history file
+    find_regressions: compares the results of a run with the previous run in the history
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from AssignmentPCA import (load_RMAExp_to_CellLines, load_RMAExp_to_CellLines_bulk, load_RMAExp_to_matrix, normalize_matrix,
+                           covariance_matrix, calcMaxIdx, getMaxIdxs, PCA, PCAProjector)
+from data_preparation import read_RMAExp_tsv_chunked, read_RMAExp_tsv_transposed
+from neighbours import NeighbourIndex
+
+def make_synthetic_data(nr_celllines=148, nr_genes=244, nr_cancertypes=5, seed=0):
+    """
+    Given a number of cell lines, genes and cancer types,
+    create random metadata and RMA expression dataframes with the same layout as GDSC_metadata.csv and GDSC_RNA_expression.csv
+
+    Parameters:
+        nr_celllines, integer representing the number of cell lines (M)
+        nr_genes, integer representing the number of genes (N)
+        nr_cancertypes, integer representing the number of different TCGA labels
+        seed, integer used to seed the random generator
+
+    Returns: a tuple of the metadata dataframe, with columns name, COSMIC_ID and TCGA_label,
+             and the MxN RMA expression dataframe, indexed by the cell line names
+    """
+    rng = np.random.default_rng(seed)
+    names = [f"CL-{i}" for i in range(nr_celllines)] #create a unique name per cell line
+    metadata = pd.DataFrame({"name": names,
+                             "COSMIC_ID": 900000 + np.arange(nr_celllines), #create a unique cosmic id per cell line
+                             "TCGA_label": rng.choice([f"TYPE{i}" for i in range(nr_cancertypes)], nr_celllines)},
+                            index=np.arange(1, nr_celllines + 1))
+    rma_expr = pd.DataFrame(rng.normal(6, 2, (nr_celllines, nr_genes)), #RMA expression values are roughly normal around 6
+                            index=rng.permutation(names), #shuffle the rows, so the loaders actually need to align them
+                            columns=[f"GENE{i}" for i in range(nr_genes)])
+    return metadata, rma_expr
+
+def write_synthetic_files(directory, nr_celllines=148, nr_genes=244, **kwargs):
+    """
+    Given a directory and a number of cell lines and genes,
+    write synthetic GDSC_metadata.csv and GDSC_RNA_expression.csv files, made with make_synthetic_data, to that directory
+
+    Parameters:
+        directory, string containing the path of the directory, which is created if it does not exist
+        nr_celllines, integer representing the number of cell lines (M)
+        nr_genes, integer representing the number of genes (N)
+        kwargs, the other parameters of make_synthetic_data
+
+    Returns: a tuple of the paths of the metadata and RMA expression files
+    """
+    os.makedirs(directory, exist_ok=True)
+    metadata, rma_expr = make_synthetic_data(nr_celllines, nr_genes, **kwargs)
+    paths = os.path.join(directory, "GDSC_metadata.csv"), os.path.join(directory, "GDSC_RNA_expression.csv")
+    metadata.to_csv(paths[0])
+    rma_expr.to_csv(paths[1])
+    return paths
+
+def write_synthetic_tsv(path, metadata, rma_expr):
+    """
+    Given a path and the synthetic metadata and RMA expression dataframes of make_synthetic_data,
+    write the RMA expression as a tsv file with one gene per row and one cell line per column, named 'DATA.' + cosmic id,
+    with the same layout as Cell_line_RMA_proc_basalExp.tsv read by Main.py
+
+    Parameters:
+        path, string containing the path of the tsv file
+        metadata, the metadata dataframe of make_synthetic_data
+        rma_expr, the RMA expression dataframe of make_synthetic_data
+
+    Returns: the path of the tsv file
+    """
+    cosmic_ids = metadata.set_index("name")["COSMIC_ID"].loc[rma_expr.index] #the cosmic id of every row of rma_expr
+    genes = rma_expr.T
+    genes.columns = [f"DATA.{cosmic_id}" for cosmic_id in cosmic_ids]
+    genes.insert(0, "GENE_title", [f"title of {gene}" for gene in genes.index])
+    genes.insert(0, "GENE_SYMBOLS", genes.index)
+    genes.to_csv(path, sep='\t', index=False, float_format="%.5f")
+    return path
+
+def time_call(function, *args, repeat=3, **kwargs):
+    """
+    Given a function and its arguments,
+    measure the best wall time of repeat calls
+
+    Parameters:
+        function, the function to time
+        repeat, integer representing the number of times to call the function
+
+    Returns: the best wall time in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start) #keep the fastest run, which is the least disturbed by other processes
+    return best
+
+def peak_memory(function, *args, **kwargs):
+    """
+    Given a function and its arguments,
+    measure the peak memory allocated by Python and numpy during one call, with tracemalloc
+
+    Parameters:
+        function, the function to measure
+
+    Returns: the peak memory in bytes, above the memory allocated before the call
+    """
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+def benchmark_loaders(sizes=(100, 1000, 10000), nr_genes=244, repeat=3):
+    """
+    Given a list of numbers of cell lines,
+    compare the wall time of load_RMAExp_to_CellLines followed by load_RMAExp_to_matrix
+    with the wall time of load_RMAExp_to_CellLines_bulk
+
+    Parameters:
+        sizes, list of integers representing the numbers of cell lines to benchmark
+        nr_genes, integer representing the number of genes
+        repeat, integer representing the number of times every loader is timed
+
+    Returns: a list of dictionaries with the number of cell lines and the wall times of both loaders
+    """
+    results = []
+    for nr_celllines in sizes:
+        metadata, rma_expr = make_synthetic_data(nr_celllines, nr_genes)
+        rowwise = time_call(lambda: load_RMAExp_to_matrix(load_RMAExp_to_CellLines(metadata, rma_expr)), repeat=repeat)
+        bulk = time_call(load_RMAExp_to_CellLines_bulk, metadata, rma_expr, repeat=repeat)
+        results.append({"nr_celllines": nr_celllines, "rowwise": rowwise, "bulk": bulk})
+    return results
+
+def benchmark_lean(nr_celllines=1000, nr_genes=2000, n_components=50, solver="eigh", repeat=3):
+    """
+    Given a size, compare the PCA of a float64 copy of the data (the default) with the PCA of float32 data normalized in place
+    (copy=False), in wall time, peak memory and accuracy of the eigenvalues and components
+
+    Parameters:
+        nr_celllines, integer representing the number of cell lines
+        nr_genes, integer representing the number of genes
+        n_components, integer representing the number of principal components
+        solver, string containing the solver of the PCA models
+        repeat, integer representing the number of times every mode is timed
+
+    Returns: a dictionary with the wall time and peak memory of both modes, the largest relative error of the float32 eigenvalues,
+             and the smallest absolute cosine between a float32 component and the same float64 component
+    """
+    _, rma_expr = make_synthetic_data(nr_celllines, nr_genes)
+    data_matrix = rma_expr.to_numpy(dtype=float)
+    n_components = min(n_components, nr_celllines, nr_genes)
+    default = PCA(n_components, solver=solver).fit(data_matrix)
+    lean_matrix = data_matrix.astype(np.float32)
+    lean = PCA(n_components, solver=solver, copy=False).fit(lean_matrix.copy())
+    return {"nr_celllines": nr_celllines, "nr_genes": nr_genes,
+            "float64_seconds": time_call(lambda: PCA(n_components, solver=solver).fit(data_matrix), repeat=repeat),
+            "float32_seconds": time_call(lambda: PCA(n_components, solver=solver, copy=False).fit(lean_matrix), repeat=repeat), #normalizing normalized data costs the same
+            "float64_peak_bytes": peak_memory(lambda: PCA(n_components, solver=solver).fit(data_matrix)),
+            "float32_peak_bytes": peak_memory(lambda: PCA(n_components, solver=solver, copy=False).fit(lean_matrix)),
+            "eigenvalue_error": float(np.max(np.abs(lean.eigenvalues / default.eigenvalues - 1))),
+            "component_cosine": float(np.min(np.abs(np.einsum('ij,ij->i', lean.components, default.components))))}
+
+def benchmark_neighbours(sizes=(1000, 10000, 50000), dimensions=(3, 10, 50), k=5, nr_queries=1000, repeat=3):
+    """
+    Given numbers of cell lines and of principal components, measure the time per query of the k nearest cell lines
+    with both methods of NeighbourIndex, for one cell line at a time and for all queries as one batch,
+    on coordinates with a decreasing variance per principal component, like projected cell lines
+
+    Parameters:
+        sizes, list of integers representing the numbers of cell lines
+        dimensions, list of integers representing the numbers of principal components
+        k, integer representing the number of neighbours
+        nr_queries, integer representing the number of cell lines queried
+        repeat, integer representing the number of times every query is timed
+
+    Returns: a list of dictionaries with the size, the method, and the time per query in seconds of single and batched queries
+    """
+    rng = np.random.default_rng(0)
+    results = []
+    for nr_celllines in sizes:
+        for nr_components in dimensions:
+            coordinates = rng.standard_normal((nr_celllines, nr_components)) / np.sqrt(np.arange(1, nr_components + 1)) #a decaying spectrum
+            keys = [str(i) for i in range(min(nr_queries, nr_celllines))]
+            for method in ("kdtree", "brute"):
+                index = NeighbourIndex(coordinates, method=method)
+                single = time_call(lambda: [index.knn(key, k) for key in keys[:100]], repeat=repeat) / len(keys[:100])
+                batched = time_call(index.knn, keys, k, repeat=repeat) / len(keys)
+                results.append({"nr_celllines": nr_celllines, "nr_components": nr_components, "method": method, "single": single, "batched": batched})
+    return results
+
+def _getMaxIdxs_scan(l, number_idxs):
+    """
+    The original getMaxIdxs, calling calcMaxIdx number_idxs times, kept as reference for the benchmark
+    """
+    max_idxs = [None]*number_idxs
+    control_list = np.asarray(l).real.astype(float)
+    for i in range(number_idxs):
+        idx = calcMaxIdx(control_list)
+        max_idxs[i] = idx
+        control_list[idx] = np.nan
+    return max_idxs
+
+def _render_2d(labels, subspace):
+    """
+    Render the 2d plot of subspace to an in-memory file with a non-interactive backend
+    """
+    import io
+    from plot_funcs import use_headless_backend, PCA_plot_2d
+    use_headless_backend()
+    PCA_plot_2d(labels, list(dict.fromkeys(labels)), subspace, filename=io.BytesIO())
+
+def _prepare(function, *inputs):
+    """
+    Returns: a function which makes the inputs of a stage, by calling every function in inputs, and returns the function of the stage
+    """
+    def prepare():
+        for make in inputs: make()
+        return function
+    return prepare
+
+def pipeline_stages(metadata, rma_expr, directory):
+    """
+    Given synthetic metadata and RMA expression dataframes,
+    create the benchmark stages of the Main.py pipeline, in the order in which they run
+
+    Every stage is a tuple of its name, a function without arguments which prepares the inputs of the stage and returns
+    the function running the stage, the largest amount of work for which the stage is run (None for no limit), and
+    the amount of work for this dataset, e.g. M*N for normalize_matrix.
+    The inputs are made when a stage is prepared and shared by the later stages, so skipped stages make no inputs.
+
+    Parameters:
+        metadata, the metadata dataframe of make_synthetic_data
+        rma_expr, the RMA expression dataframe of make_synthetic_data
+        directory, string containing the path of a directory to which the tsv file of the reader stages is written
+
+    Returns: a list of stages
+    """
+    nr_celllines, nr_genes = rma_expr.shape
+    tsv_path = functools.cache(lambda: write_synthetic_tsv(os.path.join(directory, "Cell_line_RMA_proc_basalExp.tsv"), metadata, rma_expr))
+    loaded = functools.cache(lambda: load_RMAExp_to_CellLines_bulk(metadata, rma_expr))
+    data_matrix = lambda: loaded()[1]
+    data_matrix_norm = functools.cache(lambda: (data_matrix() - data_matrix().mean(axis=0)) / data_matrix().std(axis=0))
+    projector = functools.cache(lambda: PCAProjector(PCA(3, solver="randomized").fit(data_matrix_norm()), n_components=3))
+    eigenvalues = functools.cache(lambda: np.abs(np.random.default_rng(0).normal(size=nr_genes))) #stand-in for the eigenvalues of the covariance matrix
+    labels = functools.cache(lambda: [instance.CancerType for instance in loaded()[0]])
+    gram_work = min(nr_celllines, nr_genes)**2 * max(nr_celllines, nr_genes) #the work of the eigh solver, on the smallest of the covariance and Gram matrix
+    return [("read_RMAExp_tsv_transposed", _prepare(lambda: read_RMAExp_tsv_transposed(tsv_path()), tsv_path), 2 * 10**7, nr_celllines * nr_genes),
+            ("read_RMAExp_tsv_chunked", _prepare(lambda: read_RMAExp_tsv_chunked(tsv_path()), tsv_path), 10**8, nr_celllines * nr_genes),
+            ("load_RMAExp_to_CellLines", _prepare(lambda: load_RMAExp_to_CellLines(metadata, rma_expr)), 5 * 10**7, nr_celllines * nr_genes),
+            ("load_RMAExp_to_CellLines_bulk", _prepare(lambda: load_RMAExp_to_CellLines_bulk(metadata, rma_expr)), None, None),
+            ("load_RMAExp_to_matrix", _prepare(lambda: load_RMAExp_to_matrix(loaded()[0]), loaded), None, None),
+            ("normalize_matrix", _prepare(lambda: normalize_matrix(data_matrix()), loaded), 2 * 10**7, nr_celllines * nr_genes),
+            ("covariance_matrix loop", _prepare(lambda: covariance_matrix(data_matrix_norm(), "loop"), data_matrix_norm), 10**7, nr_genes**2 * nr_celllines),
+            ("covariance_matrix blas", _prepare(lambda: covariance_matrix(data_matrix_norm()), data_matrix_norm), 10**8, nr_genes**2),
+            ("np.cov", _prepare(lambda: np.cov(data_matrix_norm(), rowvar=False), data_matrix_norm), 10**8, nr_genes**2),
+            ("np.linalg.eig", _prepare(lambda: np.linalg.eig(covariance_matrix(data_matrix_norm())), data_matrix_norm), 2 * 10**6, nr_genes**2),
+            ("PCA eigh", _prepare(lambda: PCA(solver="eigh").fit(data_matrix_norm()), data_matrix_norm), 2 * 10**11, gram_work),
+            ("PCA randomized k=3", _prepare(lambda: PCA(3, solver="randomized").fit(data_matrix_norm()), data_matrix_norm), None, None),
+            ("getMaxIdxs scan k=200", _prepare(lambda: _getMaxIdxs_scan(eigenvalues(), min(200, nr_genes)), eigenvalues), 2 * 10**6, nr_genes * 200),
+            ("getMaxIdxs k=200", _prepare(lambda: getMaxIdxs(eigenvalues(), min(200, nr_genes)), eigenvalues), None, None),
+            ("projection", _prepare(lambda: projector().project(data_matrix()), projector), None, None),
+            ("plot 2d", _prepare(lambda: _render_2d(labels(), projector().project(data_matrix())[:, :2]), projector, labels), None, None)]
+
+def benchmark_pipeline(sizes=((148, 244), (1000, 2000)), stages=None, repeat=3, measure_memory=True):
+    """
+    Given a list of sizes,
+    run the benchmark stages of pipeline_stages on synthetic data of every size
+
+    Parameters:
+        sizes, list of tuples of the number of cell lines (M) and genes (N)
+        stages, optional list of stage names to run, by default all stages
+        repeat, integer representing the number of times every stage is timed
+        measure_memory, boolean, if True the peak memory of every stage is measured in an extra run
+
+    Returns: a list of dictionaries with the size, stage name, wall time in seconds and peak memory in bytes,
+             with time and memory None for skipped stages
+    """
+    results = []
+    for nr_celllines, nr_genes in sizes:
+        metadata, rma_expr = make_synthetic_data(nr_celllines, nr_genes)
+        with tempfile.TemporaryDirectory() as directory: #the tsv file of the reader stages is removed after every size
+            for name, prepare, limit, elements in pipeline_stages(metadata, rma_expr, directory):
+                if stages is not None and name not in stages: continue
+                result = {"nr_celllines": nr_celllines, "nr_genes": nr_genes, "stage": name, "seconds": None, "peak_bytes": None}
+                if limit is None or elements <= limit: #skip stages that would take far too long
+                    function = prepare() #make the inputs of the stage outside of the measurements
+                    result["seconds"] = time_call(function, repeat=repeat)
+                    if measure_memory: result["peak_bytes"] = peak_memory(function)
+                results.append(result)
+    return results
+
+COLD_START_COMMANDS = {"import Main": ["-c", "import Main"],
+                       "Main.py --help": ["Main.py", "--help"],
+                       "import plot_funcs": ["-c", "import plot_funcs"]}
+
+def benchmark_cold_start(repeat=3):
+    """
+    Measure the wall time of importing Main.py (without the plot methods), of printing the help of Main.py,
+    and of importing plot_funcs (with matplotlib), every time in a new python process
+
+    Parameters:
+        repeat, integer representing the number of processes started per command, the best is kept
+
+    Returns: a list of dictionaries like benchmark_pipeline, with size 0x0, the command as stage and no peak memory
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, MPLBACKEND="Agg") #no display needed
+    results = []
+    for name, arguments in COLD_START_COMMANDS.items():
+        run = lambda: subprocess.run([sys.executable] + arguments, cwd=directory, env=environment, check=True, stdout=subprocess.DEVNULL)
+        results.append({"nr_celllines": 0, "nr_genes": 0, "stage": name, "seconds": time_call(run, repeat=repeat), "peak_bytes": None})
+    return results
+
+def _version():
+    """
+    Returns: the git commit of this repository, or "unknown" if git is not available
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def append_history(path, results):
+    """
+    Given the path of a JSON history file and the results of benchmark_pipeline,
+    append the results to the history, together with the version of the code and of python and numpy
+
+    Parameters:
+        path, string containing the path of the history file, which is created if it does not exist
+        results, list of dictionaries returned by benchmark_pipeline
+
+    Returns: the list of all runs in the history, the new run last
+    """
+    history = []
+    if os.path.exists(path):
+        with open(path) as file: history = json.load(file)
+    history.append({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "version": _version(), "python": platform.python_version(),
+                    "numpy": np.__version__, "machine": platform.machine(), "results": results})
+    with open(path, "w") as file: json.dump(history, file, indent=1)
+    return history
+
+def find_regressions(history, tolerance=1.25, min_seconds=0.001):
+    """
+    Given a history of runs,
+    find the stages of the last run that are more than tolerance times slower, or use more than tolerance times the memory,
+    than the same stage and size in the previous run
+
+    Parameters:
+        history, list of runs as returned by append_history
+        tolerance, number representing the allowed ratio between the last and previous run
+        min_seconds, number representing the wall time below which differences are considered noise
+
+    Returns: a list of strings describing the regressions
+    """
+    if len(history) < 2: return []
+    key = lambda result: (result["nr_celllines"], result["nr_genes"], result["stage"])
+    previous = {key(result): result for result in history[-2]["results"]}
+    regressions = []
+    for result in history[-1]["results"]:
+        before = previous.get(key(result))
+        if before is None: continue
+        for measure in ("seconds", "peak_bytes"):
+            if measure == "seconds" and (result[measure] or 0) < min_seconds: continue
+            if result[measure] and before[measure] and result[measure] > tolerance * before[measure]:
+                regressions.append(f"{result['stage']} at {result['nr_celllines']}x{result['nr_genes']}: "
+                                   f"{measure} {before[measure]:.4g} -> {result[measure]:.4g}")
+    return regressions
+
+def _size(text):
+    nr_celllines, nr_genes = text.lower().split("x")
+    return int(nr_celllines), int(nr_genes)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the PCA pipeline on synthetic GDSC-shaped data")
+    parser.add_argument("--sizes", nargs="+", type=_size, default=[(148, 244), (1000, 2000)],
+                        help="sizes as MxN, with M cell lines and N genes, e.g. 148x244 10000x20000")
+    parser.add_argument("--stages", nargs="+", help="names of the stages to run, by default all of them")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per stage, the best is kept")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the peak memory of the stages")
+    parser.add_argument("--history", default="benchmark_history.json", help="JSON file to append the results to, ignored by git")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="ratio with the previous run above which a stage is a regression")
+    parser.add_argument("--loaders", action="store_true", help="only compare the row-by-row and bulk loaders at 100, 1k and 10k cell lines")
+    parser.add_argument("--lean", action="store_true", help="only compare the float64 PCA with the float32 in-place PCA at the given sizes")
+    parser.add_argument("--neighbours", action="store_true", help="only compare the methods of NeighbourIndex at 1k, 10k and 50k cell lines")
+    parser.add_argument("--no-cold-start", action="store_true", help="do not measure the start up time of Main.py")
+    arguments = parser.parse_args()
+
+    if arguments.loaders:
+        for result in benchmark_loaders(repeat=arguments.repeat):
+            print(f"{result['nr_celllines']:>6} cell lines: row-by-row {result['rowwise']:8.4f} s, "
+                  f"bulk {result['bulk']:8.4f} s, speedup {result['rowwise'] / result['bulk']:6.1f}x")
+    elif arguments.lean:
+        for nr_celllines, nr_genes in arguments.sizes:
+            result = benchmark_lean(nr_celllines, nr_genes, repeat=arguments.repeat)
+            print(f"{nr_celllines}x{nr_genes}: float64 {result['float64_seconds']:.4f} s {result['float64_peak_bytes'] / 2**20:.1f} MiB, "
+                  f"float32 in place {result['float32_seconds']:.4f} s {result['float32_peak_bytes'] / 2**20:.1f} MiB, "
+                  f"eigenvalue error {result['eigenvalue_error']:.1e}, component cosine {result['component_cosine']:.6f}")
+    elif arguments.neighbours:
+        for result in benchmark_neighbours(repeat=arguments.repeat):
+            print(f"{result['nr_celllines']:>6} cell lines, {result['nr_components']:>3} PCs, {result['method']:<6}: "
+                  f"single {result['single'] * 1e6:10.1f} us/query, batched {result['batched'] * 1e6:10.1f} us/query")
+    else:
+        results = benchmark_pipeline(arguments.sizes, arguments.stages, arguments.repeat, not arguments.no_memory)
+        if not arguments.no_cold_start: results += benchmark_cold_start(arguments.repeat)
+        for result in results:
+            size = f"{result['nr_celllines']}x{result['nr_genes']}"
+            if result["seconds"] is None: print(f"{size:>12} {result['stage']:<32} skipped")
+            else: print(f"{size:>12} {result['stage']:<32} {result['seconds']:10.4f} s {(result['peak_bytes'] or 0) / 2**20:10.1f} MiB")
+        history = append_history(arguments.history, results)
+        for regression in find_regressions(history, arguments.tolerance): print("REGRESSION", regression)
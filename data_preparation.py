@@ -0,0 +1,301 @@
+"""
+This module contains the methods used to read the RMA expression data from the GDSC tsv file
+An example on how to use them can be found in the Main.py module
+
+The tsv file holds one gene per row and one cell line per column, so reading it whole and transposing it
+copies the complete dataset several times. The methods in this module read it in chunks of genes instead,
+and write every chunk directly into a preallocated cell-line-major array.
+
+The methods in this module:
+    count_data_lines: counts the number of lines after the header of a text file, without parsing it
+    read_RMAExp_tsv_ids: reads the cell line ids from the header of the RMA expression tsv file
+    read_RMAExp_tsv_chunked: reads the RMA expression tsv file in chunks into a MxN array, dropping genes with nan values on the fly
+    read_RMAExp_tsv_dataframe: the same as read_RMAExp_tsv_chunked, but returns a dataframe indexed by the cell line ids
+    read_RMAExp_tsv_transposed: reads the RMA expression tsv file whole and transposes it, the original way
+    prepare_metadata: removes duplicated, unclassified and unmeasured cell lines from the metadata
+    prepare_dataset: reads, filters, aligns and normalizes the metadata and RMA expression, ready for PCA
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from AssignmentPCA import align_RMAExp, load_RMAExp_to_CellLines_bulk, gather_rows_inplace, normalize_matrix_inplace
+from feature_selection import gene_statistics, gene_statistics_tsv, select_genes, select_columns_inplace
+from instrumentation import instrumented
+
+def _strip_prefix(columns, prefix):
+    """
+    Given the column names of the cell lines, remove the prefix from the start of every name which has it
+
+    Parameters:
+        columns, list of strings containing the column names
+        prefix, string containing the prefix, or None
+
+    Returns: a list of strings containing the cell line ids
+    """
+    return [column[len(prefix):] if prefix and column.startswith(prefix) else column for column in columns]
+
+def count_data_lines(path, block_size=1 << 20):
+    """
+    Given the path of a text file with a header line,
+    count the number of lines after the header, by counting newlines in blocks of bytes
+
+    Parameters:
+        path, string containing the path of the file
+        block_size, integer representing the number of bytes read at once
+
+    Returns: the number of lines after the header
+    """
+    nr_lines, last = 0, b"\n"
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            nr_lines += block.count(b"\n")
+            last = block[-1:]
+    if last != b"\n": nr_lines += 1 #the last line has no newline
+    return nr_lines - 1 #do not count the header
+
+def _compact_columns(rma_exp_matrix, nr_columns):
+    """
+    Given a MxK C-contiguous numpy array which owns its data, of which only the first N columns are used,
+    move these columns to the start of its buffer and shrink the buffer to them, so it becomes a contiguous MxN array
+
+    Parameters:
+        rma_exp_matrix, a MxK numpy array which owns its data
+        nr_columns, integer N, the number of used columns
+
+    Returns: the same numpy array, now of shape MxN
+    """
+    nr_rows, nr_allocated = rma_exp_matrix.shape
+    flat = rma_exp_matrix.reshape(-1) #a view of the buffer
+    for row in range(1, nr_rows): #row i moves from offset i*K to i*N, before any of the rows after it, so no unmoved value is overwritten
+        flat[row*nr_columns:(row+1)*nr_columns] = flat[row*nr_allocated:row*nr_allocated+nr_columns]
+    del flat #resize requires that no view of the buffer is used anymore
+    rma_exp_matrix.resize((nr_rows, nr_columns), refcheck=False) #reallocate the buffer to its first MxN values, in place
+    return rma_exp_matrix
+
+def _copy_columns_to_file(rma_exp_matrix, nr_columns, filename, block_size=256):
+    """
+    Given a MxK numpy array of which only the first N columns are used,
+    write these columns as a contiguous MxN array to a .npy file, in blocks of rows
+
+    Parameters:
+        rma_exp_matrix, a MxK numpy array
+        nr_columns, integer N, the number of used columns
+        filename, path of the .npy file
+        block_size, integer representing the number of rows copied at once
+
+    Returns: a MxN numpy memmap of the file
+    """
+    nr_rows = rma_exp_matrix.shape[0]
+    compact = np.lib.format.open_memmap(filename, mode='w+', dtype=rma_exp_matrix.dtype, shape=(nr_rows, nr_columns))
+    for start in range(0, nr_rows, block_size): #iterate over the blocks of rows
+        compact[start:start+block_size] = rma_exp_matrix[start:start+block_size, :nr_columns]
+    compact.flush()
+    return compact
+
+def read_RMAExp_tsv_ids(path, gene_column="GENE_SYMBOLS", skip_columns=("GENE_title",), id_prefix="DATA."):
+    """
+    Given the path of a tsv file with the RMA expression of the genes (rows) of every cell line (columns),
+    read the cell line ids from its header, in the order of the rows of read_RMAExp_tsv_chunked
+
+    Parameters:
+        path, string containing the path of the tsv file
+        gene_column, string containing the name of the column with the gene names
+        skip_columns, list of strings containing the names of other columns that do not hold cell lines
+        id_prefix, string which is removed from the start of the cell line column names
+
+    Returns: a list of the cell line ids
+    """
+    header = pd.read_csv(path, sep='\t', nrows=0).columns #only parse the header
+    return _strip_prefix([column for column in header if column != gene_column and column not in skip_columns], id_prefix)
+
+@instrumented
+def read_RMAExp_tsv_chunked(path, chunksize=2000, gene_column="GENE_SYMBOLS", skip_columns=("GENE_title",), id_prefix="DATA.", dtype=float, filename=None, gene_rows=None):
+    """
+    Given the path of a tsv file with the RMA expression of the genes (rows) of every cell line (columns),
+    read it in chunks of genes, drop the genes with nan values, and write the values in a MxN array,
+    with M the number of cell lines (rows) and N the number of genes without nan values (columns)
+
+    Like read_RMAExp_tsv_transposed, a gene is dropped when any of its columns is nan, including its name and the skip_columns.
+    The array is allocated once, for all genes in the file. When genes are dropped, the kept columns are moved to
+    the start of the buffer and the buffer is shrunk, so the returned array is contiguous and holds only the kept genes.
+    With filename, the array is first written to filename + ".partial", and the kept columns are copied to filename.
+
+    Parameters:
+        path, string containing the path of the tsv file
+        chunksize, integer representing the number of genes parsed at once
+        gene_column, string containing the name of the column with the gene names
+        skip_columns, list of strings containing the names of other columns that do not hold cell lines
+        id_prefix, string which is removed from the start of the cell line column names, e.g. 'DATA.906826' becomes '906826'
+        dtype, the numpy float type of the array
+        filename, optional path of a .npy file to which the array is written as a memory map, instead of keeping it in memory
+        gene_rows, optional sorted list of the positions of the genes (rows after the header) to read, the other genes are skipped
+                   without parsing them, e.g. the genes selected with feature_selection.gene_statistics_tsv
+
+    Returns: a tuple of three elements:
+             the MxN numpy array (or numpy memmap if filename is given) containing the RMA expression values,
+             a list of the N gene names,
+             a list of the M cell line ids
+    """
+    header = pd.read_csv(path, sep='\t', nrows=0).columns #only parse the header
+    cellline_columns = [column for column in header if column != gene_column and column not in skip_columns]
+    other_columns = [gene_column] + [column for column in skip_columns if column in header] #the columns which are checked for nan values too
+    ids = _strip_prefix(cellline_columns, id_prefix)
+
+    selected = None if gene_rows is None else set(int(row) for row in gene_rows)
+    nr_celllines, max_genes = len(cellline_columns), count_data_lines(path) if selected is None else len(selected)
+    if filename is None: rma_exp_matrix = np.empty((nr_celllines, max_genes), dtype=dtype) #Initialize empty numpy array to prevent reallocation of memory
+    else: rma_exp_matrix = np.lib.format.open_memmap(filename + ".partial", mode='w+', dtype=dtype, shape=(nr_celllines, max_genes)) #write the array to disk instead
+
+    genes = []
+    nr_genes = 0 #the number of genes written so far
+    skip = None if selected is None else (lambda line: line > 0 and line - 1 not in selected) #line 0 is the header
+    chunks = pd.read_csv(path, sep='\t', usecols=other_columns + cellline_columns, chunksize=chunksize, skiprows=skip,
+                         dtype={column: dtype for column in cellline_columns})
+    for chunk in chunks: #iterate over the chunks of genes
+        values = chunk[cellline_columns].to_numpy(dtype=dtype) #the values of the genes in this chunk, one gene per row
+        symbols = chunk[gene_column]
+        keep = ~np.isnan(values).any(axis=1) & chunk[other_columns].notna().all(axis=1).to_numpy() #drop genes with nan values, without a name or title
+        nr_kept = int(keep.sum())
+        rma_exp_matrix[:, nr_genes:nr_genes+nr_kept] = values[keep].T #write the kept genes as columns of the cell-line-major array
+        genes.extend(symbols[keep].astype(str))
+        nr_genes += nr_kept
+
+    if filename is not None:
+        compact = _copy_columns_to_file(rma_exp_matrix, nr_genes, filename)
+        del rma_exp_matrix #close the memory map of the partial file before removing it
+        os.remove(filename + ".partial")
+        return compact, genes, ids
+    if nr_genes < max_genes: rma_exp_matrix = _compact_columns(rma_exp_matrix, nr_genes)
+    return rma_exp_matrix, genes, ids
+
+def read_RMAExp_tsv_dataframe(path, **kwargs):
+    """
+    Given the path of a tsv file with the RMA expression of the genes (rows) of every cell line (columns),
+    read it with read_RMAExp_tsv_chunked into a dataframe with the genes as columns and the cell line ids as index,
+    without copying the array
+
+    Parameters:
+        path, string containing the path of the tsv file
+        kwargs, the other parameters of read_RMAExp_tsv_chunked
+
+    Returns: a MxN pandas dataframe containing the RMA expression values of the M cell lines (rows) and N genes (columns)
+    """
+    rma_exp_matrix, genes, ids = read_RMAExp_tsv_chunked(path, **kwargs)
+    return pd.DataFrame(rma_exp_matrix, index=pd.Index(ids), columns=pd.Index(genes), copy=False)
+
+@instrumented
+def read_RMAExp_tsv_transposed(path, gene_column="GENE_SYMBOLS", skip_columns=("GENE_title",), id_prefix="DATA.", dtype=float):
+    """
+    Given the path of a tsv file with the RMA expression of the genes (rows) of every cell line (columns),
+    read it whole, transpose it and drop the genes with nan values
+
+    The rows of the gene_column and skip_columns are removed after dropping the genes,
+    and the prefix of the cell line ids is removed, so the result matches read_RMAExp_tsv_dataframe.
+
+    Parameters:
+        path, string containing the path of the tsv file
+        gene_column, string containing the name of the column with the gene names
+        skip_columns, list of strings containing the names of other columns that do not hold cell lines
+        id_prefix, string which is removed from the start of the cell line column names, e.g. 'DATA.906826' becomes '906826'
+        dtype, the numpy float type of the dataframe
+
+    Returns: a pandas dataframe containing the RMA expression values of the cell lines (rows) and genes (columns)
+    """
+    rma_expr = pd.read_csv(path, sep='\t')
+    rma_expr = rma_expr.T #transform the data so that the columns represent the features and the rows the instances
+    rma_expr.columns = rma_expr.loc[gene_column] #set the names of the features as the column names
+    rma_expr.dropna(axis=1, inplace=True) #drop all genes with nan values in the data
+    rma_expr = rma_expr.drop(index=[gene_column] + [column for column in skip_columns if column in rma_expr.index]).astype(dtype) #keep only the cell lines
+    rma_expr.index = pd.Index(_strip_prefix(rma_expr.index, id_prefix))
+    rma_expr.columns = rma_expr.columns.astype(str)
+    return rma_expr
+
+@instrumented
+def prepare_metadata(metadata, rma_expr_index, id_column="COSMIC_ID", label_column="Tissue sub-type", exclude_labels=("UNCLASSIFIED",)):
+    """
+    Given the metadata of the cell lines and the index of the RMA expression dataframe,
+    index the metadata by cell line id, and remove duplicated cell lines, cell lines with an excluded label,
+    cell lines without RMA expression and cell lines with nan values
+
+    Parameters:
+        metadata, non-empty pandas dataframe containing the information (columns) of the cell lines (rows)
+        rma_expr_index, the index of the RMA expression dataframe, containing the cell line ids as strings
+        id_column, string containing the name of the column in metadata with the cell line ids
+        label_column, string containing the name of the column in metadata with the labels of the cell lines
+        exclude_labels, list of strings containing the labels of the cell lines to remove
+
+    Returns: the filtered metadata dataframe, indexed by the cell line ids as strings
+    """
+    metadata.index = metadata[id_column].astype(str) #set the cosmic_id of the cell lines as the index
+    metadata = metadata[~metadata.index.duplicated(keep='first')] #remove duplicated notations of the same cell line
+    metadata = metadata[~metadata[label_column].isin(exclude_labels)] #remove cell lines which are unclassified
+    metadata = metadata[metadata.index.isin(rma_expr_index)] #remove cell lines of which no RMA_expression data is present in rma_expr
+    return metadata.dropna(axis=0) #drop all cell lines with nan values in the data
+
+@instrumented
+def prepare_dataset(metadata_path, expression_path, metadata_labels=("Name", "COSMIC_ID", "Tissue sub-type"), lookup_variable="cosmic_id",
+                    exclude_labels=("UNCLASSIFIED",), use_chunked_reader=True, chunksize=2000, dtype="float64", top_genes=None, min_variance=None):
+    """
+    Given the paths of the metadata and RMA expression tsv files,
+    read them, filter the cell lines with prepare_metadata, align them with align_RMAExp, optionally keep only the genes
+    with the highest variance, and z-score normalize the RMA expression per gene
+
+    With the chunked reader, the RMA expression is kept in the one array it is read into: the aligned cell lines are
+    moved to its first rows with gather_rows_inplace, and it is normalized in place with normalize_matrix_inplace.
+    With dtype "float32" this array takes half the memory. With top_genes or min_variance, the genes are selected first in a streaming
+    pass over the tsv file with gene_statistics_tsv, over the aligned cell lines, and only the selected genes are read.
+    With the transposed reader, the selected genes are moved to the first columns of the matrix with select_columns_inplace.
+
+    Parameters:
+        metadata_path, string containing the path of the metadata tsv file
+        expression_path, string containing the path of the RMA expression tsv file
+        metadata_labels, list of three strings, representing the names of the columns in metadata with the name,
+                         cosmid_ID and label information (in that order)
+        lookup_variable, string containing one of: "name", "cosmic_id", "tcga_label",
+                         representing the variable to which to match metadata and rma_expr
+        exclude_labels, list of strings containing the labels of the cell lines to remove
+        use_chunked_reader, boolean, if True the RMA expression is read with read_RMAExp_tsv_chunked,
+                            if False with read_RMAExp_tsv_transposed
+        chunksize, integer representing the number of genes parsed at once by the chunked reader
+        dtype, string containing the numpy float type of the RMA expression, e.g. "float64" or "float32"
+        top_genes, optional integer representing the number of genes with the highest variance to keep, see feature_selection.select_genes
+        min_variance, optional number representing the lowest variance of the genes to keep
+
+    Returns: a dictionary of numpy arrays with the keys
+             "matrix", the MxN normalized RMA expression of the M cell lines and N genes,
+             "mean" and "std", the mean and standard deviation of every gene before normalization,
+             "genes", the N gene names,
+             "names", "cosmic_ids" and "labels", the name, cosmic ID and label of every cell line,
+             "nr_candidate_genes", the number of genes without nan values, of which the N genes are selected
+    """
+    metadata_labels = list(metadata_labels)
+    metadata = pd.read_csv(metadata_path, sep='\t')
+    if use_chunked_reader:
+        ids = read_RMAExp_tsv_ids(expression_path) #align the cell lines before reading the RMA expression
+        metadata = prepare_metadata(metadata, pd.Index(ids), metadata_labels[1], metadata_labels[2], exclude_labels)
+        positions, metadata_values, report = align_RMAExp(metadata, ids, metadata_labels=metadata_labels, lookup_variable=lookup_variable)
+        gene_rows = nr_candidate_genes = None
+        if top_genes is not None or min_variance is not None: #select the genes in a streaming pass, so only the selected genes are read
+            statistics = gene_statistics_tsv(expression_path, chunksize=chunksize, cell_lines=positions) #the variance of every gene over the aligned cell lines
+            gene_rows = select_genes(statistics["variance"], statistics["nan_count"], top_genes, min_variance)
+            nr_candidate_genes = int(np.sum(statistics["nan_count"] == 0)) #the genes kept by the reader without selection
+        rma_exp_matrix, genes, _ = read_RMAExp_tsv_chunked(expression_path, chunksize=chunksize, dtype=dtype, gene_rows=gene_rows) #read the genes in chunks, dropping all genes with nan values on the fly
+        data_matrix = gather_rows_inplace(rma_exp_matrix, positions) #align the rows in the array itself, instead of gathering them into a copy
+        if nr_candidate_genes is None: nr_candidate_genes = data_matrix.shape[1]
+    else:
+        rma_expr = read_RMAExp_tsv_transposed(expression_path)
+        metadata = prepare_metadata(metadata, rma_expr.index, metadata_labels[1], metadata_labels[2], exclude_labels)
+        data, data_matrix, report = load_RMAExp_to_CellLines_bulk(metadata, rma_expr, metadata_labels=metadata_labels, lookup_variable=lookup_variable, dtype=dtype)
+        genes = rma_expr.columns
+        metadata_values = np.array([[instance.CellLineName, instance.CosmicID, instance.CancerType] for instance in data], dtype=object).reshape(-1, 3)
+        nr_candidate_genes = data_matrix.shape[1]
+        if top_genes is not None or min_variance is not None: #select the genes before the normalization and the expensive PCA steps
+            statistics = gene_statistics(data_matrix) #the variance of every gene, in one pass over the cell lines
+            columns = select_genes(statistics["variance"], statistics["nan_count"], top_genes, min_variance)
+            data_matrix = select_columns_inplace(data_matrix, columns)
+            genes = [genes[column] for column in columns]
+    mean, std = normalize_matrix_inplace(data_matrix) #the statistics of every gene, like normalize_list, and the normalization in place
+
+    return {"matrix": data_matrix, "mean": mean, "std": std, "genes": np.asarray(genes, dtype=str), "nr_candidate_genes": np.asarray(nr_candidate_genes),
+            "names": metadata_values[:, 0].astype(str), "cosmic_ids": metadata_values[:, 1].astype(str), "labels": metadata_values[:, 2].astype(str)}
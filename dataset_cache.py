@@ -0,0 +1,190 @@
+"""
+This module holds the DatasetCache class, used to store prepared datasets on disk, so the data preparation
+only has to run once for the same input files and options
+An example on how to use it can be found in the Main.py module
+
+Every cache entry is a directory with one .npy file per array of the dataset, so loading an entry only maps the
+files into memory. The key of an entry combines the sha256 hashes of the input files with the options of the preparation.
+When the entries together exceed max_bytes, the least recently used entries are removed.
+Entries are written to a staging directory first; staging directories left behind by an interrupted write are removed
+when they are older than STAGING_TIMEOUT seconds.
+
+The methods in this module:
+    hash_file: calculates the sha256 hash of the content of a file
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from instrumentation import instrumented
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Given the path of a file,
+    calculate the sha256 hash of its content, reading it in blocks
+
+    Parameters:
+        path, string containing the path of the file
+        block_size, integer representing the number of bytes read at once
+
+    Returns: a string containing the hexadecimal hash
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+class DatasetCache:
+    """
+    Class used to store datasets, dictionaries of numpy arrays, in a cache directory on disk.
+    """
+    HASHES_FILE = "file_hashes.json"
+    STAGING_PREFIX = ".staging-" #the prefix of the directories to which entries are written before they are complete
+    STAGING_TIMEOUT = 24 * 3600 #the age in seconds after which a staging directory is considered left behind
+
+    def __init__(self, directory=".dataset_cache", max_bytes=4 << 30):
+        """
+        Initiate an instance of class DatasetCache
+
+        Parameters:
+            directory, string containing the path of the cache directory, which is created if it does not exist
+            max_bytes, integer representing the maximum total size of all entries in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_hash(self, path):
+        """
+        Given the path of a file, return the hash of its content.
+        Hashes are remembered by path, size and modification time, so unchanged files are not read again.
+        When a new hash is remembered, the records of files that no longer exist and older records of the same file are removed.
+        """
+        hashes_path = os.path.join(self.directory, self.HASHES_FILE)
+        try:
+            with open(hashes_path) as file: hashes = json.load(file)
+        except (OSError, ValueError):
+            hashes = {}
+        stat = os.stat(path)
+        signature = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        if signature not in hashes:
+            hashes = {old: digest for old, digest in hashes.items() #prune the records of removed and changed files
+                      if old.split("|")[0] != os.path.abspath(path) and os.path.exists(old.split("|")[0])}
+            hashes[signature] = hash_file(path)
+            with open(hashes_path, "w") as file: json.dump(hashes, file)
+        return hashes[signature]
+
+    def key(self, paths, options=None):
+        """
+        Given the paths of the input files and the options of the preparation,
+        calculate the key of the cache entry
+
+        Parameters:
+            paths, list of strings containing the paths of the input files
+            options, dictionary of json serializable options
+
+        Returns: a string containing the key
+        """
+        description = {"files": [self._file_hash(path) for path in paths], "options": options or {}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=list).encode()).hexdigest()[:32]
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    @instrumented
+    def load(self, key, mmap_mode='r'):
+        """
+        Given the key of an entry, load its arrays as read-only memory maps
+
+        Parameters:
+            key, string containing the key of the entry
+            mmap_mode, 'r' for read-only memory maps, or 'c' for copy-on-write memory maps, which can be changed in place
+                       without changing the files, e.g. by PCA with copy=False
+
+        Returns: a dictionary of numpy arrays, or None if the entry is not in the cache
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry): return None
+        os.utime(entry) #mark the entry as recently used
+        return {name[:-4]: np.load(os.path.join(entry, name), mmap_mode=mmap_mode) for name in os.listdir(entry) if name.endswith(".npy")}
+
+    @instrumented
+    def store(self, key, dataset):
+        """
+        Given a key and a dataset, write the dataset to the cache and remove the least recently used entries
+        when the cache has become too large
+
+        Parameters:
+            key, string containing the key of the entry
+            dataset, dictionary of numpy arrays with string keys
+        """
+        temporary = tempfile.mkdtemp(prefix=self.STAGING_PREFIX, dir=self.directory) #write to a temporary directory first, so a failed write leaves no broken entry
+        for name, array in dataset.items():
+            np.save(os.path.join(temporary, name + ".npy"), np.asarray(array), allow_pickle=False)
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+        os.replace(temporary, self._entry(key))
+        self.evict()
+
+    def _entries(self):
+        """
+        Returns: a list of tuples of the last use time, size in bytes and key of every entry
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            if not os.path.isdir(entry) or key.startswith(self.STAGING_PREFIX): continue #skip the entries that are still written
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries till the total size of the entries is at most max_bytes.
+        The most recently used entry is always kept.
+        Staging directories older than STAGING_TIMEOUT seconds are removed too.
+        """
+        for name in os.listdir(self.directory):
+            staging = os.path.join(self.directory, name)
+            if name.startswith(self.STAGING_PREFIX) and time.time() - os.path.getmtime(staging) > self.STAGING_TIMEOUT:
+                shutil.rmtree(staging, ignore_errors=True) #left behind by an interrupted store
+        entries = sorted(self._entries(), reverse=True) #most recently used first
+        total = 0
+        for i, (_, size, key) in enumerate(entries):
+            total += size
+            if total > self.max_bytes and i > 0: self.invalidate(key)
+
+    def invalidate(self, key=None):
+        """
+        Remove the entry with the given key from the cache, or all entries if no key is given
+
+        Parameters:
+            key, string containing the key of the entry, or None
+        """
+        keys = [key] if key is not None else [key for _, _, key in self._entries()]
+        for key in keys:
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def get_or_prepare(self, prepare, paths, mmap_mode='r', **options):
+        """
+        Given a preparation function, the paths of its input files and its options,
+        load the prepared dataset from the cache, or prepare it and store it in the cache
+
+        Parameters:
+            prepare, function taking the paths and options as arguments and returning a dictionary of numpy arrays
+            paths, list of strings containing the paths of the input files
+            mmap_mode, the mode of the memory maps, see load
+            options, the json serializable keyword arguments of prepare
+
+        Returns: a dictionary of numpy arrays, memory mapped from the cache
+        """
+        key = self.key(paths, dict(options, prepare=prepare.__name__))
+        dataset = self.load(key, mmap_mode)
+        if dataset is None:
+            self.store(key, prepare(*paths, **options))
+            dataset = self.load(key, mmap_mode)
+        return dataset
@@ -0,0 +1,161 @@
+"""
+This module contains the methods used to select the genes with the most variance before the PCA
+An example on how to use them can be found in the data_preparation.py and Main.py modules
+
+Most of the variance of the RMA expression sits in a small fraction of the genes, so keeping only the genes with the
+highest variance makes the covariance and eigen steps much cheaper. The statistics of the genes are calculated in one
+streaming pass, over chunks of the expression file or over blocks of cell lines of a matrix, and the selected columns
+of a matrix are moved to its first columns in place.
+
+The methods in this module:
+    gene_statistics: calculates the mean, variance and number of nan values of every gene of a matrix, in blocks of cell lines
+    gene_statistics_tsv: the same as gene_statistics, but in chunks of genes of the RMA expression tsv file, without storing the values,
+                         used to select the genes before the RMA expression is read
+    select_genes: selects the columns of the genes with the highest variance, or a variance above a threshold
+    select_columns_inplace: moves the given columns of a matrix to its first columns, in place
+
+The classes in this module:
+    GeneStatistics: keeps the mean, variance and number of nan values of every variable up to date while batches of instances arrive
+"""
+
+import numpy as np
+import pandas as pd
+from AssignmentPCA import RunningStats, top_k_indexes
+
+class GeneStatistics(RunningStats):
+    """
+    Class used to keep the mean and variance of every variable up to date while batches of instances arrive, like RunningStats,
+    ignoring nan values. Every variable has its own count of values, and the nan values of every variable are counted.
+    """
+
+    def __init__(self):
+        """
+        Initiate an empty instance of class GeneStatistics
+        """
+        super().__init__()
+        self.nan_count = None #the number of nan values of every variable
+
+    def update(self, batch):
+        """
+        Given a BxN numpy array, batch, merge its values that are not nan into the statistics
+
+        Parameters:
+            batch, a non-empty BxN numpy array of numbers, with B instances of the N variables
+
+        Returns: a tuple of the difference between the batch mean and the previous mean, and the previous count of every variable,
+                 like RunningStats.update
+        """
+        batch = np.asarray(batch, dtype=float)
+        valid = ~np.isnan(batch)
+        batch_count = valid.sum(axis=0) #the number of values of every variable in this batch
+        batch_mean = np.divide(np.where(valid, batch, 0).sum(axis=0), batch_count, out=np.zeros(batch.shape[1]), where=batch_count > 0)
+        batch_m2 = (np.where(valid, batch - batch_mean, 0)**2).sum(axis=0)
+        previous_count = self.count
+        if self.mean is None:
+            self.count, self.mean, self.m2 = batch_count, batch_mean, batch_m2
+            self.nan_count = len(batch) - batch_count
+            return np.zeros_like(batch_mean), previous_count
+
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        weight = np.divide(batch_count, count, out=np.zeros(len(count)), where=count > 0) #the share of this batch in the merged values
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + batch_m2 + delta**2 * self.count * weight #Chan's merge of two groups of values, per variable
+        self.count = count
+        self.nan_count = self.nan_count + len(batch) - batch_count
+        return delta, previous_count
+
+    def variance(self, ddof=0):
+        """
+        Returns: a numpy array with the variance of every variable, dividing by its count - ddof, or nan if it has too few values
+        """
+        return np.divide(self.m2, self.count - ddof, out=np.full(len(self.m2), np.nan), where=self.count > ddof)
+
+def gene_statistics(data_matrix, block_size=1024):
+    """
+    Given a MxN numpy array,
+    calculate the statistics of every column in one pass over blocks of rows, ignoring nan values
+
+    Parameters:
+        data_matrix, a non-empty MxN numpy array of numbers, with M cell lines and N genes
+        block_size, integer representing the number of rows per block
+
+    Returns: a dictionary with numpy arrays of length N with the keys "mean", "variance", "nan_count" and "count"
+    """
+    stats = GeneStatistics()
+    for start in range(0, len(data_matrix), block_size): stats.update(data_matrix[start:start+block_size])
+    return {"mean": stats.mean, "variance": stats.variance(), "nan_count": stats.nan_count, "count": stats.count}
+
+def gene_statistics_tsv(path, chunksize=2000, gene_column="GENE_SYMBOLS", skip_columns=("GENE_title",), cell_lines=None):
+    """
+    Given the path of a tsv file with the RMA expression of the genes (rows) of every cell line (columns),
+    calculate the statistics of every gene in one pass over chunks of genes, ignoring nan values, without storing the values
+
+    The nan values are counted over all cell lines, and a gene without a name or without a value in one of the skip_columns
+    counts one more nan value, so the genes without nan values are the genes kept by data_preparation.read_RMAExp_tsv_chunked.
+
+    Parameters:
+        path, string containing the path of the tsv file
+        chunksize, integer representing the number of genes parsed at once
+        gene_column, string containing the name of the column with the gene names
+        skip_columns, list of strings containing the names of other columns that do not hold cell lines
+        cell_lines, optional list of the positions of the cell line columns of which the mean and variance are calculated,
+                    by default all cell lines
+
+    Returns: a dictionary with the keys "genes", a list of the gene names, and "mean", "variance", "nan_count" and "count",
+             numpy arrays with the statistics of every gene (row) in the file
+    """
+    header = pd.read_csv(path, sep='\t', nrows=0).columns #only parse the header
+    cellline_columns = [column for column in header if column != gene_column and column not in skip_columns]
+    other_columns = [gene_column] + [column for column in skip_columns if column in header]
+    genes, statistics = [], {"mean": [], "variance": [], "nan_count": [], "count": []}
+    for chunk in pd.read_csv(path, sep='\t', usecols=other_columns + cellline_columns, chunksize=chunksize):
+        values = chunk[cellline_columns].to_numpy(dtype=float).T #the cell lines as instances and the genes of the chunk as variables
+        stats = GeneStatistics()
+        stats.update(values if cell_lines is None else values[cell_lines]) #every gene of the chunk is complete, so one update per chunk
+        nan_count = np.isnan(values).sum(axis=0) + chunk[other_columns].isna().any(axis=1).to_numpy() #the nan values of all cell lines, and a missing name
+        genes.extend(chunk[gene_column].astype(str))
+        for key, value in zip(statistics, (stats.mean, stats.variance(), nan_count, stats.count)): statistics[key].append(value)
+    return {"genes": genes, **{key: np.concatenate(values) for key, values in statistics.items()}}
+
+def select_genes(variance, nan_count=None, top_n=None, min_variance=None, max_nan=0):
+    """
+    Given the variance and the number of nan values of every gene,
+    select the genes with at most max_nan nan values, and of those the top_n genes with the highest variance,
+    and/or the genes with a variance of at least min_variance
+
+    Parameters:
+        variance, a numpy array of length N with the variance of every gene
+        nan_count, optional numpy array of length N with the number of nan values of every gene
+        top_n, optional integer representing the number of genes to keep
+        min_variance, optional number representing the lowest variance of the genes to keep
+        max_nan, integer representing the largest number of nan values of the genes to keep
+
+    Returns: a sorted numpy array with the columns of the selected genes, so the genes keep their order
+    """
+    variance = np.asarray(variance, dtype=float)
+    candidates = ~np.isnan(variance)
+    if nan_count is not None: candidates &= np.asarray(nan_count) <= max_nan
+    if min_variance is not None: candidates &= variance >= min_variance
+    columns = np.flatnonzero(candidates)
+    if top_n is not None and top_n < len(columns):
+        columns = columns[top_k_indexes(variance[columns], top_n)] #the columns of the top_n highest variances
+    return np.sort(columns)
+
+def select_columns_inplace(data_matrix, columns, block_size=256):
+    """
+    Given a MxN numpy array and K sorted column positions,
+    move the given columns to the first K columns of the array, in place, in blocks of rows
+
+    Parameters:
+        data_matrix, a writeable MxN numpy array
+        columns, a sorted list of K distinct integers between 0 and N
+        block_size, integer representing the number of rows per block, so the temporary memory stays at block_size rows of K values
+
+    Returns: a MxK numpy view of the first K columns of data_matrix, holding the selected columns
+    """
+    columns = np.asarray(columns, dtype=np.intp)
+    nr_columns = len(columns)
+    for start in range(0, len(data_matrix), block_size):
+        data_matrix[start:start+block_size, :nr_columns] = data_matrix[start:start+block_size, columns] #the right side is gathered first
+    return data_matrix[:, :nr_columns]
@@ -0,0 +1,270 @@
+"""
+This module contains the instrumentation of the PCA analysis: timers, call counts, result bytes and array shapes per stage
+An example on how to use it can be found in the Main.py module
+
+The methods of AssignmentPCA.py and data_preparation.py report into it with the instrumented decorator, and Main.py reports
+its stages with the stage context manager. Nothing is recorded until enable is called, and while disabled the only cost
+of an instrumented call is one check of a flag.
+
+The result bytes of a stage are the bytes of the numpy arrays it returns that own their memory, so views and memory maps
+are not counted, and neither are the temporaries the stage allocated and freed. The allocations of a stage are measured
+with tracemalloc by profile_stage.
+
+Every finished stage is passed as an event (a dictionary) to the enabled sinks:
+    LogSink: writes one log line per stage
+    JSONTraceSink: writes all events to a JSON file when it is closed
+    ChromeTraceSink: writes all events as a Chrome trace file, to be opened in chrome://tracing or https://ui.perfetto.dev
+
+The methods in this module:
+    enable: starts recording, passing the events to the given sinks
+    disable: stops recording, and closes the sinks
+    stage: context manager recording one stage
+    instrumented: decorator recording every call of a function as a stage
+    profile_stage: captures a cProfile and/or tracemalloc profile of the next run of one named stage
+    summary: returns the call count, total time and result bytes per stage
+    peak_resident_bytes: returns the peak memory footprint of the process, as reported by the operating system
+"""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+_enabled = False #checked by every instrumented call, so disabled instrumentation costs almost nothing
+_sinks = []
+_summary = {} #per stage name: the number of calls, the total seconds and the total result bytes
+_profiles = {} #per stage name: the profile options of profile_stage
+_lock = threading.Lock()
+_start = time.perf_counter() #the time origin of the events
+
+class LogSink:
+    """
+    Class used to write one log line per finished stage
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        Parameters:
+            logger, the logging.Logger to write to, by default the logger of this module
+            level, the logging level of the lines
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def emit(self, event):
+        shapes = ", ".join(f"{name}={shape}" for name, shape in event["shapes"].items())
+        self.logger.log(self.level, f"{event['name']}: {event['seconds']*1000:.2f} ms, {event['result_bytes']} result bytes" + (f", {shapes}" if shapes else ""))
+
+    def close(self):
+        pass
+
+class JSONTraceSink:
+    """
+    Class used to collect all finished stages, and write them to a JSON file as a list of events when it is closed
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path, string containing the path of the JSON file
+        """
+        self.path = path
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def close(self):
+        with open(self.path, "w") as file: json.dump(self.events, file, indent=1, default=str)
+
+class ChromeTraceSink(JSONTraceSink):
+    """
+    Class used to collect all finished stages, and write them to a file in the Chrome trace event format when it is closed
+    """
+
+    def close(self):
+        trace = [{"name": event["name"], "ph": "X", "ts": event["start"] * 1e6, "dur": event["seconds"] * 1e6,
+                  "pid": os.getpid(), "tid": event["thread"],
+                  "args": {"result_bytes": event["result_bytes"], **{name: str(shape) for name, shape in event["shapes"].items()}}}
+                 for event in self.events]
+        with open(self.path, "w") as file: json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, file)
+
+def enable(*sinks):
+    """
+    Given any number of sinks, start recording the stages and pass every finished stage to the sinks
+
+    Parameters:
+        sinks, instances of LogSink, JSONTraceSink, ChromeTraceSink or any object with emit(event) and close() methods
+    """
+    global _enabled
+    _sinks.extend(sinks)
+    _enabled = True
+
+def disable():
+    """
+    Stop recording the stages, and close and remove all sinks, so trace files are written
+    """
+    global _enabled
+    _enabled = False
+    while _sinks: _sinks.pop().close()
+
+def is_enabled():
+    """
+    Returns: True if the stages are recorded
+    """
+    return _enabled
+
+def _shapes(values):
+    """
+    Given a dictionary of values, return the shapes of the numpy arrays and dataframes, and the lengths of the lists of objects among them
+    """
+    shapes = {}
+    for name, value in values.items():
+        shape = getattr(value, "shape", None)
+        if isinstance(shape, tuple): shapes[name] = shape
+        elif isinstance(value, (list, tuple)) and value and not isinstance(value[0], (str, int, float)): shapes[name] = (len(value),)
+    return shapes
+
+def _result_bytes(value):
+    """
+    Given a returned value, return the number of bytes of the numpy arrays in it that own their memory,
+    so views of other arrays and memory maps of files are not counted
+    """
+    if isinstance(value, np.ndarray): return value.nbytes if value.flags.owndata and not isinstance(value, np.memmap) else 0
+    if isinstance(value, (tuple, list)) and len(value) < 16: return sum(_result_bytes(element) for element in value)
+    return 0
+
+@contextmanager
+def stage(name, **shapes):
+    """
+    Context manager recording the wall time of the code in it as stage name, together with the given array shapes.
+    The yielded dictionary can be used to add the result, whose result bytes are recorded (see _result_bytes), and more shapes.
+
+    Parameters:
+        name, string containing the name of the stage
+        shapes, numpy arrays or tuples, of which the shapes are recorded
+
+    Example:
+        with stage("covariance", data=data_matrix) as record:
+            record["result"] = covariance_matrix(data_matrix)
+    """
+    if not _enabled:
+        yield {}
+        return
+    record = {"shapes": {name: value if isinstance(value, tuple) else getattr(value, "shape", value) for name, value in shapes.items()}}
+    profile = _profiles.pop(name, None)
+    if profile is not None: profiler = _start_profile(profile)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        event = {"name": name, "start": start - _start, "seconds": seconds, "thread": threading.get_ident(),
+                 "result_bytes": _result_bytes(record.get("result")), "shapes": record["shapes"]}
+        if profile is not None: event["profile"] = _stop_profile(profile, profiler)
+        with _lock:
+            calls, total_seconds, total_bytes = _summary.get(name, (0, 0.0, 0))
+            _summary[name] = (calls + 1, total_seconds + seconds, total_bytes + event["result_bytes"])
+            for sink in _sinks: sink.emit(event)
+
+def instrumented(function=None, name=None):
+    """
+    Decorator recording every call of a function as a stage, with the shapes of its array arguments and the result bytes of its result.
+    While the instrumentation is disabled, the function is called directly.
+
+    Parameters:
+        function, the function to decorate
+        name, string containing the name of the stage, by default the qualified name of the function
+    """
+    if function is None: return functools.partial(instrumented, name=name)
+    stage_name = name or function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled: return function(*args, **kwargs)
+        with stage(stage_name, **_shapes({**{f"arg{i}": arg for i, arg in enumerate(args)}, **kwargs})) as record:
+            record["result"] = function(*args, **kwargs)
+        return record["result"]
+    return wrapper
+
+def profile_stage(name, cprofile=True, memory=True, path=None, top=20):
+    """
+    Capture a profile of the next run of the stage with the given name, which is added to its event under "profile"
+
+    Parameters:
+        name, string containing the name of the stage
+        cprofile, boolean, if True the stage is profiled with cProfile
+        memory, boolean, if True the allocations of the stage are traced with tracemalloc, and its peak above the memory
+                traced at its start is reported as "peak_bytes"
+        path, optional string containing the path to which the cProfile statistics are dumped, for e.g. snakeviz
+        top, integer representing the number of functions and allocation sites in the profile
+    """
+    _profiles[name] = {"cprofile": cprofile, "memory": memory, "path": path, "top": top}
+
+def _start_profile(profile):
+    """
+    Start the profilers of a profile of profile_stage, and return the cProfile profiler or None
+    """
+    if profile["memory"]:
+        profile["started_tracemalloc"] = not tracemalloc.is_tracing()
+        if profile["started_tracemalloc"]: tracemalloc.start()
+        profile["snapshot"] = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak() #so the peak belongs to this stage
+        profile["start_bytes"] = tracemalloc.get_traced_memory()[0]
+    if not profile["cprofile"]: return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _stop_profile(profile, profiler):
+    """
+    Stop the profilers of a profile of profile_stage, and return the profile as a dictionary of texts and numbers
+    """
+    result = {}
+    if profiler is not None:
+        profiler.disable()
+        if profile["path"]: profiler.dump_stats(profile["path"])
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(profile["top"])
+        result["cprofile"] = text.getvalue()
+    if profile["memory"]:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1] - profile.pop("start_bytes") #the peak of this stage, above the memory traced before it
+        differences = tracemalloc.take_snapshot().compare_to(profile.pop("snapshot"), "lineno")
+        result["allocations"] = [str(difference) for difference in differences[:profile["top"]]]
+        if profile["started_tracemalloc"]: tracemalloc.stop()
+    return result
+
+def summary():
+    """
+    Returns: a dictionary with per stage name a dictionary with its number of calls, total seconds and total result bytes
+    """
+    with _lock:
+        return {name: {"calls": calls, "seconds": seconds, "result_bytes": nbytes} for name, (calls, seconds, nbytes) in _summary.items()}
+
+def peak_resident_bytes():
+    """
+    Returns: the peak resident memory of this process in bytes, as reported by the operating system, or None if it is unknown
+    """
+    try:
+        import resource
+    except ImportError: #not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 #macOS reports bytes, Linux kilobytes
+
+def reset():
+    """
+    Forget the recorded summary and pending profiles
+    """
+    with _lock:
+        _summary.clear()
+        _profiles.clear()
@@ -0,0 +1,334 @@
+"""
+This module holds the NeighbourIndex class, used to find the cell lines that are most similar to other cell lines,
+by their distance in the subspace of the first principal components
+An example on how to use it can be found in the Main.py module
+
+For a few principal components the coordinates are indexed in a KD-tree (scipy.spatial.cKDTree), which finds the
+neighbours of a cell line without visiting most of the cell lines. With more principal components a KD-tree has to visit
+almost all of its leaves, so instead the squared distances of a batch of queries to all cell lines are calculated with
+one matrix product (|q|^2 + |p|^2 - 2 q.p), and the nearest are selected by partial selection (numpy.argpartition).
+The distances of the selected neighbours are calculated again exactly. Cell lines are looked up by name or cosmic ID
+in a hash index.
+
+An index is saved to an uncompressed .npz snapshot with its coordinates and metadata, and loaded again without the
+RMA expression or the PCA model. The KD-tree is rebuilt from the coordinates when the snapshot is loaded.
+
+The methods in this module:
+    squared_distances: calculates the squared euclidean distances between two sets of points with one matrix product
+
+The classes in this module:
+    NeighbourIndex: finds the nearest cell lines, or the cell lines within a radius, of cell lines or new points
+"""
+
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+
+KDTREE_MAX_DIMENSIONS = 16 #above this number of principal components, the batched distances are faster than a KD-tree
+
+def squared_distances(queries, points, point_norms=None):
+    """
+    Given a QxK and a MxK numpy array,
+    calculate the squared euclidean distance between every query and every point, with one matrix product
+
+    Parameters:
+        queries, a QxK numpy array of numbers
+        points, a MxK numpy array of numbers
+        point_norms, optional numpy array of length M with the squared norms of the points, so they are not calculated again
+
+    Returns: a QxM numpy array of squared distances, with rounding errors below zero clipped to zero
+    """
+    if point_norms is None: point_norms = np.einsum('ij,ij->i', points, points)
+    distances = queries @ points.T #the matrix product does almost all of the work
+    distances *= -2
+    distances += np.einsum('ij,ij->i', queries, queries)[:, None]
+    distances += point_norms
+    return np.maximum(distances, 0, out=distances)
+
+def _kdtree(coordinates, leafsize):
+    """
+    Given a MxK numpy array, return a scipy.spatial.cKDTree of its rows
+    """
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError as error:
+        raise ImportError("the 'kdtree' method of NeighbourIndex requires scipy, install it or use the 'brute' method") from error
+    return cKDTree(coordinates, leafsize=leafsize)
+
+class NeighbourIndex:
+    """
+    Class used to find the nearest cell lines of cell lines, or of new points, in the subspace of the first principal components.
+    Queries take a cell line name or cosmic ID, or a list of them to query many cell lines at once.
+    """
+
+    def __init__(self, coordinates, names=None, cosmic_ids=None, labels=None, method="auto", leafsize=16, block_bytes=1 << 26):
+        """
+        Initiate an instance of class NeighbourIndex, and index the coordinates
+
+        Parameters:
+            coordinates, a MxK numpy array with the coordinates of the M cell lines on the first K principal components,
+                         e.g. returned by PCA.transform
+            names, cosmic_ids, labels, optional lists of M strings containing the name, cosmic ID and label of every cell line,
+                                       by default the names are the positions of the cell lines
+            method, string containing one of:
+                "auto" uses a KD-tree for at most KDTREE_MAX_DIMENSIONS principal components if scipy is installed, else "brute"
+                "kdtree" uses a KD-tree of scipy.spatial.cKDTree
+                "brute" calculates the distances to all cell lines for a batch of queries at once, with one matrix product
+            leafsize, integer representing the number of cell lines in a leaf of the KD-tree
+            block_bytes, integer representing the size in bytes of the distances of one batch of queries with the "brute" method
+        """
+        self.leafsize = leafsize
+        self.block_bytes = block_bytes
+        self.requested_method = method
+        self._build(coordinates, names, cosmic_ids, labels)
+
+    def _build(self, coordinates, names, cosmic_ids, labels):
+        """
+        Given the coordinates and metadata of the cell lines, build the lookup of the cell lines and the KD-tree or the norms
+        """
+        self.coordinates = np.ascontiguousarray(coordinates, dtype=float)
+        if self.coordinates.ndim != 2: raise ValueError("coordinates should be a MxK array, with one row per cell line")
+        nr_celllines = len(self.coordinates)
+        self.names = np.asarray(names if names is not None else np.arange(nr_celllines), dtype=str)
+        self.cosmic_ids = np.asarray(cosmic_ids if cosmic_ids is not None else [""] * nr_celllines, dtype=str)
+        self.labels = np.asarray(labels if labels is not None else [""] * nr_celllines, dtype=str)
+        if not len(self.names) == len(self.cosmic_ids) == len(self.labels) == nr_celllines:
+            raise ValueError("names, cosmic_ids and labels should have one value per row of coordinates")
+
+        self.lookup = {}
+        for keys in (self.cosmic_ids, self.names): #a name wins from an equal cosmic ID
+            self.lookup.update((key, i) for i, key in reversed(list(enumerate(keys.tolist()))) if key) #the first cell line with a key wins
+
+        method = self.requested_method
+        if method not in ("auto", "kdtree", "brute"): raise ValueError(f"method should be 'auto', 'kdtree' or 'brute', not {method!r}")
+        self.tree, self.norms = None, None
+        if method != "brute" and (method == "kdtree" or self.coordinates.shape[1] <= KDTREE_MAX_DIMENSIONS):
+            try:
+                self.tree = _kdtree(self.coordinates, self.leafsize)
+            except ImportError:
+                if method == "kdtree": raise
+        self.method = "kdtree" if self.tree is not None else "brute"
+        if self.tree is None: self.norms = np.einsum('ij,ij->i', self.coordinates, self.coordinates) #the squared norms, used by every batch
+        self.batch_size = max(1, self.block_bytes // (8 * max(1, nr_celllines))) #the number of queries per matrix product
+
+    @classmethod
+    def from_pca(cls, pca, data_matrix, cell_lines, n_components=10, **kwargs):
+        """
+        Given a fitted PCA model, the data it was fitted on and the collection of the cell lines,
+        project the cell lines on the first principal components and index them
+
+        Parameters:
+            pca, a fitted instance of class PCA
+            data_matrix, a MxN numpy array with the RMA expression of the M cell lines
+            cell_lines, a CellLineCollection of the M cell lines, in the order of the rows of data_matrix
+            n_components, integer representing the number of principal components of the subspace
+            kwargs, the other parameters of NeighbourIndex
+
+        Returns: an instance of class NeighbourIndex
+        """
+        coordinates = pca.transform(data_matrix, n_components)
+        return cls(coordinates, cell_lines.values("name"), cell_lines.values("cosmic_id"), cell_lines.values("tcga_label"), **kwargs)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def extend(self, coordinates, names=None, cosmic_ids=None, labels=None):
+        """
+        Given the coordinates and metadata of new cell lines, e.g. projected with PCAProjector, add them to the index
+
+        Parameters:
+            coordinates, a BxK numpy array with the coordinates of the B new cell lines
+            names, cosmic_ids, labels, optional lists of B strings, see NeighbourIndex
+
+        Returns: this instance of class NeighbourIndex
+        """
+        coordinates = np.atleast_2d(np.asarray(coordinates, dtype=float))
+        if coordinates.shape[1] != self.coordinates.shape[1]:
+            raise ValueError(f"the new cell lines should have {self.coordinates.shape[1]} coordinates, not {coordinates.shape[1]}")
+        nr_new = len(coordinates)
+        names = np.arange(len(self), len(self) + nr_new) if names is None else names
+        fill = lambda values: [""] * nr_new if values is None else values
+        self._build(np.concatenate([self.coordinates, coordinates]), np.concatenate([self.names, np.asarray(names, dtype=str)]),
+                    np.concatenate([self.cosmic_ids, np.asarray(fill(cosmic_ids), dtype=str)]),
+                    np.concatenate([self.labels, np.asarray(fill(labels), dtype=str)]))
+        return self
+
+    def rows(self, keys):
+        """
+        Given cell line names or cosmic IDs, find the rows of the cell lines in the index
+
+        Parameters:
+            keys, a name or cosmic ID, or a list of them
+
+        Returns: a numpy array of integers with the row of every key
+        """
+        if isinstance(keys, (str, int, np.integer)): keys = [keys]
+        try:
+            return np.fromiter((self.lookup[str(key)] for key in keys), dtype=np.intp, count=len(keys))
+        except KeyError as error:
+            raise KeyError(f"cell line {error.args[0]!r} is not in this index, by name or cosmic ID") from None
+
+    def _points(self, points):
+        """
+        Given one point or a QxK array of points, return them as a QxK numpy array of floats
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        if points.shape[1] != self.coordinates.shape[1]:
+            raise ValueError(f"the points should have {self.coordinates.shape[1]} coordinates, not {points.shape[1]}")
+        return points
+
+    def _exact(self, point, rows, radius=None):
+        """
+        Given a point and rows of the index, return the rows and their exact distances to the point, nearest first,
+        keeping only the rows within radius if it is given
+        """
+        distances = np.sqrt(((self.coordinates[rows] - point)**2).sum(axis=1))
+        if radius is not None: rows, distances = rows[distances <= radius], distances[distances <= radius]
+        order = np.argsort(distances, kind='stable')
+        return rows[order], distances[order]
+
+    @instrumented
+    def knn_points(self, points, k=5):
+        """
+        Given one point or a QxK array of points in the subspace,
+        find the k nearest cell lines of every point
+
+        Parameters:
+            points, a numpy array of K coordinates, or a QxK numpy array, e.g. new cell lines projected with PCAProjector
+            k, integer representing the number of neighbours, at most the number of cell lines
+
+        Returns: a tuple of two Qxk numpy arrays, the rows of the neighbours and their distances, nearest first
+        """
+        points = self._points(points)
+        if not 0 < k <= len(self): raise ValueError(f"k should be between 1 and the number of cell lines, {len(self)}")
+        if self.tree is not None:
+            distances, rows = self.tree.query(points, k=np.arange(1, k+1)) #a list of k, so the arrays are always Qxk
+            return rows.astype(np.intp), distances
+
+        rows, distances = np.empty((len(points), k), dtype=np.intp), np.empty((len(points), k))
+        for start in range(0, len(points), self.batch_size):
+            batch = points[start:start+self.batch_size]
+            nearest = np.argpartition(squared_distances(batch, self.coordinates, self.norms), k-1, axis=1)[:, :k] #the k smallest distances, by partial selection
+            exact = np.sqrt(((self.coordinates[nearest] - batch[:, None, :])**2).sum(axis=2)) #without the rounding errors of the matrix product
+            order = np.argsort(exact, axis=1, kind='stable')
+            rows[start:start+len(batch)], distances[start:start+len(batch)] = np.take_along_axis(nearest, order, axis=1), np.take_along_axis(exact, order, axis=1)
+        return rows, distances
+
+    @instrumented
+    def radius_points(self, points, radius):
+        """
+        Given one point or a QxK array of points in the subspace,
+        find the cell lines within radius of every point
+
+        Parameters:
+            points, a numpy array of K coordinates, or a QxK numpy array
+            radius, number representing the largest distance of the neighbours
+
+        Returns: a list with per point a tuple of two numpy arrays, the rows of the neighbours and their distances, nearest first
+        """
+        points = self._points(points)
+        if self.tree is not None:
+            return [self._exact(point, np.asarray(rows, dtype=np.intp)) for point, rows in zip(points, self.tree.query_ball_point(points, radius))]
+
+        result = []
+        for start in range(0, len(points), self.batch_size):
+            batch = points[start:start+self.batch_size]
+            squared = squared_distances(batch, self.coordinates, self.norms)
+            slack = 1e-9 * (np.einsum('ij,ij->i', batch, batch).max() + self.norms.max() + radius**2) #the rounding error of the matrix product
+            result.extend(self._exact(point, np.flatnonzero(row <= radius**2 + slack), radius) for point, row in zip(batch, squared))
+        return result
+
+    def knn_rows(self, rows, k=5, exclude_self=True):
+        """
+        Given rows of the index, find the k nearest cell lines of every row
+
+        Parameters:
+            rows, list of R integers representing rows of the index
+            k, integer representing the number of neighbours
+            exclude_self, boolean, if True a cell line is not its own neighbour
+
+        Returns: a tuple of two Rxk numpy arrays, the rows of the neighbours and their distances, nearest first
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        if exclude_self and not 0 < k <= len(self) - 1: raise ValueError(f"k should be between 1 and the number of other cell lines, {len(self) - 1}")
+        neighbours, distances = self.knn_points(self.coordinates[rows], k + bool(exclude_self))
+        if not exclude_self: return neighbours, distances
+        itself = neighbours == rows[:, None]
+        itself[~itself.any(axis=1), -1] = True #a duplicate at distance zero came before the cell line itself, drop the farthest instead
+        return neighbours[~itself].reshape(len(rows), k), distances[~itself].reshape(len(rows), k)
+
+    def knn(self, keys, k=5, exclude_self=True):
+        """
+        Given cell line names or cosmic IDs, find the k nearest cell lines of every cell line
+
+        Parameters:
+            keys, a name or cosmic ID, or a list of them
+            k, integer representing the number of neighbours
+            exclude_self, boolean, if True a cell line is not its own neighbour
+
+        Returns: a tuple of the rows of the neighbours and their distances, nearest first,
+                 as numpy arrays of length k for one key, or Rxk numpy arrays for a list of R keys
+        """
+        neighbours, distances = self.knn_rows(self.rows(keys), k, exclude_self)
+        if isinstance(keys, (str, int, np.integer)): return neighbours[0], distances[0]
+        return neighbours, distances
+
+    def radius(self, keys, radius, exclude_self=True):
+        """
+        Given cell line names or cosmic IDs, find the cell lines within radius of every cell line
+
+        Parameters:
+            keys, a name or cosmic ID, or a list of them
+            radius, number representing the largest distance of the neighbours
+            exclude_self, boolean, if True a cell line is not its own neighbour
+
+        Returns: a tuple of two numpy arrays, the rows of the neighbours and their distances, nearest first,
+                 for one key, or a list of these tuples for a list of keys
+        """
+        rows = self.rows(keys)
+        result = self.radius_points(self.coordinates[rows], radius)
+        if exclude_self: result = [(neighbours[neighbours != row], distances[neighbours != row]) for row, (neighbours, distances) in zip(rows, result)]
+        if isinstance(keys, (str, int, np.integer)): return result[0]
+        return result
+
+    def similar(self, keys, k=5, exclude_self=True):
+        """
+        Given cell line names or cosmic IDs, make a table of the k nearest cell lines of every cell line
+
+        Parameters:
+            keys, a name or cosmic ID, or a list of them
+            k, integer representing the number of neighbours
+            exclude_self, boolean, if True a cell line is not its own neighbour
+
+        Returns: a pandas dataframe with per neighbour the query, its rank, and the name, cosmic ID, label and distance of the neighbour
+        """
+        rows = self.rows(keys)
+        neighbours, distances = self.knn_rows(rows, k, exclude_self)
+        return pd.DataFrame({"query": np.repeat(self.names[rows], k), "rank": np.tile(np.arange(1, k+1), len(rows)),
+                             "name": self.names[neighbours.ravel()], "cosmic_id": self.cosmic_ids[neighbours.ravel()],
+                             "label": self.labels[neighbours.ravel()], "distance": distances.ravel()})
+
+    def save(self, path):
+        """
+        Save the index to an uncompressed .npz snapshot, which can be loaded with NeighbourIndex.load
+
+        Parameters:
+            path, string containing the path of the file
+        """
+        np.savez(path, coordinates=self.coordinates, names=self.names, cosmic_ids=self.cosmic_ids, labels=self.labels,
+                 method=self.requested_method, leafsize=self.leafsize, block_bytes=self.block_bytes)
+
+    @classmethod
+    def load(cls, path, method=None):
+        """
+        Load an index saved with NeighbourIndex.save
+
+        Parameters:
+            path, string containing the path of the file
+            method, optional string containing the method of the index, see NeighbourIndex, by default the saved method
+
+        Returns: an instance of class NeighbourIndex
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(arrays["coordinates"], arrays["names"], arrays["cosmic_ids"], arrays["labels"], method=method or str(arrays["method"]),
+                       leafsize=int(arrays["leafsize"]), block_bytes=int(arrays["block_bytes"]))
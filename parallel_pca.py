@@ -0,0 +1,310 @@
+"""
+This module contains the methods used to fit many PCA models of the same data in parallel worker processes
+An example on how to use them can be found in the Main.py module
+
+The data matrix is copied once into a block of shared memory, to which every worker process attaches by name,
+so the matrix is not pickled and sent to the workers with every task. The tasks only receive their settings,
+and return small arrays.
+
+The methods in this module:
+    attach_matrix: attaches to a matrix in shared memory, in another process
+    min_permutations: the smallest number of permutations with which a principal component can be significant
+    stability_analysis: estimates the stability of the principal components by bootstrap resampling of the instances,
+                        and the number of significant principal components by permuting every variable
+    compare_components: compares the leading principal components of several PCA models
+    grouped_pca: fits a PCA model on the instances of every label (e.g. cancer type), largest groups first
+
+The classes in this module:
+    SharedMatrix: copies a matrix into shared memory, and removes it again when it is closed
+"""
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+import numpy as np
+from AssignmentPCA import PCA, top_k_indexes_batched
+from CellLineRMAExpressionModule import group_indexes
+
+_block, _matrix = None, None #the shared memory block and matrix of this worker process
+
+class SharedMatrix:
+    """
+    Class used to copy a numpy array into a block of shared memory, which other processes can attach to with attach_matrix.
+    Use it as a context manager, or call close, to remove the block again.
+    """
+
+    def __init__(self, matrix):
+        """
+        Initiate an instance of class SharedMatrix, copying matrix into shared memory
+
+        Parameters:
+            matrix, a numpy array (or numpy memmap) of numbers
+        """
+        matrix = np.asarray(matrix)
+        self.block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        self.matrix = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=self.block.buf)
+        self.matrix[...] = matrix #the only copy of the data
+        self.description = (self.block.name, matrix.shape, matrix.dtype.str) #all other processes need to attach to it
+
+    def close(self):
+        """
+        Remove the shared memory block. The matrix attribute can not be used anymore afterwards.
+        """
+        self.matrix = None #release the view on the block, so it can be closed
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def attach_matrix(description):
+    """
+    Given the description of a SharedMatrix, attach to its block of shared memory
+
+    Parameters:
+        description, the tuple of the name of the block, the shape and the dtype string of the matrix
+
+    Returns: a tuple of the shared memory block, which should be kept as long as the matrix is used, and the numpy array in it
+    """
+    name, shape, dtype = description
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _attach_worker(description):
+    """
+    Initializer of the worker processes: attach to the shared matrix once, for all tasks of the worker
+    """
+    global _block, _matrix
+    _block, _matrix = attach_matrix(description)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1) #one BLAS thread per worker process, the worker processes already use all processors
+    except ImportError:
+        pass
+
+def _run_tasks(matrix, tasks, processes=None):
+    """
+    Given a matrix and a list of tasks, functions which take the matrix as only argument,
+    run the tasks in a pool of worker processes sharing the matrix, or in this process if processes is 1
+
+    Returns: a list of the results of the tasks, in the order of the tasks
+    """
+    if processes == 1 or len(tasks) <= 1: return [task(matrix) for task in tasks]
+    with SharedMatrix(matrix) as shared, ProcessPoolExecutor(processes, initializer=_attach_worker, initargs=(shared.description,)) as pool:
+        futures = [pool.submit(_call_with_shared_matrix, task) for task in tasks]
+        return [future.result() for future in futures]
+
+def _call_with_shared_matrix(task):
+    return task(_matrix)
+
+def _split(nr_items, nr_parts):
+    """
+    Given a number of items and a number of parts, return a list of ranges dividing the items over at most nr_parts equal parts
+    """
+    bounds = np.linspace(0, nr_items, min(nr_items, nr_parts) + 1).astype(int)
+    return [range(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def _bootstrap_task(matrix, resamples, reference, settings, nr_genes, seed):
+    """
+    Given the data matrix, a range of resample numbers and the reference components as a KxN numpy array,
+    fit a PCA model on a bootstrap resample of the instances for every resample number
+
+    Returns: a tuple of the explained variances and the absolute cosine with the reference of the components (two RxK numpy arrays),
+             the sum and the sum of squares of the loadings (two KxN numpy arrays),
+             and how often every gene was one of the nr_genes genes with the highest absolute loading (a KxN numpy array)
+    """
+    nr_instances = len(matrix)
+    nr_components, nr_variables = reference.shape
+    explained_variance = np.empty((len(resamples), nr_components))
+    similarity = np.empty((len(resamples), nr_components))
+    loading_sum, loading_squares = np.zeros((nr_components, nr_variables)), np.zeros((nr_components, nr_variables))
+    top_counts = np.zeros((nr_components, nr_variables), dtype=np.int64)
+    for row, resample in enumerate(resamples):
+        rng = np.random.default_rng([seed, 0, resample]) #the same resample, whichever worker runs it
+        pca = PCA(nr_components, **settings).fit(matrix[rng.integers(0, nr_instances, nr_instances)])
+        cosines = np.einsum('ij,ij->i', pca.components, reference) #the components and the reference are unit vectors
+        signs = np.where(cosines < 0, -1.0, 1.0) #flip the components which point the other way than the reference
+        loadings = pca.loadings() * signs[:, None]
+        explained_variance[row], similarity[row] = pca.explained_variance(), np.abs(cosines)
+        loading_sum += loadings
+        loading_squares += loadings**2
+        idxs = top_k_indexes_batched(np.abs(loadings), nr_genes) #the genes PCA_plot_loadings would show
+        top_counts[np.arange(nr_components)[:, None], idxs] += 1
+    return explained_variance, similarity, loading_sum, loading_squares, top_counts
+
+def _permutation_task(matrix, permutations, nr_components, settings, seed):
+    """
+    Given the data matrix and a range of permutation numbers,
+    fit a PCA model on the matrix with every variable permuted independently for every permutation number,
+    which removes the correlation between the variables but keeps their distributions
+
+    Returns: a RxK numpy array with the explained variances of the components of every permutation
+    """
+    explained_variance = np.empty((len(permutations), nr_components))
+    for row, permutation in enumerate(permutations):
+        rng = np.random.default_rng([seed, 1, permutation])
+        pca = PCA(nr_components, **settings).fit(rng.permuted(matrix, axis=0)) #shuffle every column independently
+        explained_variance[row] = pca.explained_variance()
+    return explained_variance
+
+def min_permutations(alpha=0.05):
+    """
+    Given a significance level alpha,
+    calculate the smallest number of permutations n of stability_analysis for which the smallest p-value, 1/(n+1), is at most alpha.
+    With fewer permutations no principal component can be significant.
+
+    Parameters:
+        alpha, float between 0 and 1, the significance level
+
+    Returns: the smallest number of permutations
+    """
+    return math.ceil(1 / alpha) - 1
+
+def stability_analysis(data_matrix, n_components=10, n_bootstraps=200, n_permutations=100, alpha=0.05, nr_genes=50,
+                       solver="auto", normalize=True, processes=None, tasks_per_process=4, seed=0):
+    """
+    Given a MxN numpy array, data_matrix,
+    fit a PCA model on it, and estimate how stable its principal components are by fitting n_bootstraps models on
+    resamples of the instances (with replacement), and how many of them are significant by fitting n_permutations
+    models on the data with every variable permuted independently. All models are fitted in parallel worker processes,
+    which share one copy of data_matrix.
+
+    A principal component counts as significant when its explained variance is higher than that of the same component
+    of the permuted data with probability 1-alpha. The leading significant components are counted, like in parallel analysis.
+
+    Parameters:
+        data_matrix, a non-empty MxN numpy array of numbers, with M instances and N variables
+        n_components, integer representing the number of principal components to analyse
+        n_bootstraps, integer representing the number of bootstrap resamples, 0 to skip them
+        n_permutations, integer representing the number of permutations, 0 to skip them
+        alpha, float between 0 and 1, the significance level and one minus the coverage of the confidence intervals
+        nr_genes, integer representing the number of genes with the highest absolute loading that are counted per component
+        solver, string containing the solver of the PCA models, see the PCA class
+        normalize, boolean, if True every resample is z-score normalized per variable, if False only centered
+        processes, integer representing the number of worker processes, None for the number of processors, 1 to run in this process
+        tasks_per_process, integer representing the number of tasks per worker process the resamples are divided over
+        seed, integer used to seed the random generators, so the results do not depend on the number of processes
+
+    Returns: a dictionary with the keys
+             "model", the PCA model fitted on data_matrix,
+             "explained_variance", a numpy array with the explained variance of the K components of the model,
+             and, when n_bootstraps > 0:
+             "bootstrap_explained_variance", a n_bootstrapsxK numpy array with the explained variance of every resample,
+             "ci_low" and "ci_high", numpy arrays with the confidence interval of the explained variance of every component,
+             "cumulative_ci_low" and "cumulative_ci_high", the same for the cumulative explained variance,
+             "component_similarity", a numpy array with the mean absolute cosine between the components of the resamples and the model,
+             "loading_mean" and "loading_std", KxN numpy arrays with the mean and standard deviation of the loadings over the resamples,
+             "top_gene_frequency", a KxN numpy array with the fraction of the resamples in which a gene was one of the nr_genes
+                                   genes with the highest absolute loading of a component,
+             and, when n_permutations > 0:
+             "null_explained_variance", a n_permutationsxK numpy array with the explained variance of every permutation,
+             "null_threshold", a numpy array with the 1-alpha quantile of the explained variance of the permutations per component,
+             "p_values", a numpy array with the permutation p-value of every component,
+             "nr_significant", the number of leading components with a p-value of at most alpha
+    """
+    data_matrix = np.asarray(data_matrix)
+    settings = dict(solver=solver, normalize=normalize, seed=seed)
+    model = PCA(n_components, **settings).fit(data_matrix)
+    nr_components = len(model.components)
+    nr_genes = min(nr_genes, data_matrix.shape[1])
+    explained_variance = model.explained_variance()
+    result = {"model": model, "explained_variance": explained_variance}
+
+    nr_tasks = (processes or os.cpu_count() or 1) * tasks_per_process
+    bootstrap_tasks = [partial(_bootstrap_task, resamples=resamples, reference=model.components, settings=settings, nr_genes=nr_genes, seed=seed)
+                       for resamples in _split(n_bootstraps, nr_tasks)]
+    permutation_tasks = [partial(_permutation_task, permutations=permutations, nr_components=nr_components, settings=settings, seed=seed)
+                         for permutations in _split(n_permutations, nr_tasks)]
+    results = _run_tasks(data_matrix, bootstrap_tasks + permutation_tasks, processes) #one pool, and one shared copy, for both analyses
+    bootstrap_results, permutation_results = results[:len(bootstrap_tasks)], results[len(bootstrap_tasks):]
+
+    if bootstrap_results:
+        bootstrap_explained_variance = np.concatenate([explained for explained, *_ in bootstrap_results])
+        quantiles = [alpha / 2, 1 - alpha / 2]
+        result["bootstrap_explained_variance"] = bootstrap_explained_variance
+        result["ci_low"], result["ci_high"] = np.quantile(bootstrap_explained_variance, quantiles, axis=0)
+        result["cumulative_ci_low"], result["cumulative_ci_high"] = np.quantile(np.cumsum(bootstrap_explained_variance, axis=1), quantiles, axis=0)
+        result["component_similarity"] = np.concatenate([similarity for _, similarity, *_ in bootstrap_results]).mean(axis=0)
+        loading_mean = sum(loading_sum for *_, loading_sum, _, _ in bootstrap_results) / n_bootstraps
+        loading_squares = sum(loading_squares for *_, loading_squares, _ in bootstrap_results) / n_bootstraps
+        result["loading_mean"] = loading_mean
+        result["loading_std"] = np.sqrt(np.maximum(loading_squares - loading_mean**2, 0)) #rounding can make the variance slightly negative
+        result["top_gene_frequency"] = sum(top_counts for *_, top_counts in bootstrap_results) / n_bootstraps
+
+    if permutation_results:
+        null_explained_variance = np.concatenate(permutation_results)
+        p_values = (1 + (null_explained_variance >= explained_variance).sum(axis=0)) / (n_permutations + 1)
+        significant = p_values <= alpha
+        result["null_explained_variance"] = null_explained_variance
+        result["null_threshold"] = np.quantile(null_explained_variance, 1 - alpha, axis=0)
+        result["p_values"] = p_values
+        result["nr_significant"] = int(significant.argmin()) if not significant.all() else nr_components #the leading significant components
+    return result
+
+def _group_task(matrix, indexes, n_components, settings):
+    """
+    Given the data matrix and the indexes of the instances of one group, fit a PCA model on the instances of the group
+    """
+    return PCA(n_components, **settings).fit(matrix[indexes])
+
+def compare_components(models, n_components=3):
+    """
+    Given a dictionary of fitted PCA models with the same variables,
+    compare their leading principal components
+
+    Parameters:
+        models, dictionary with per label (e.g. cancer type) a fitted PCA model
+        n_components, integer representing the number of leading principal components to compare
+
+    Returns: a dictionary with the keys
+             "labels", the list of the G labels of the models, in the order of the arrays,
+             "component_similarity", a KxGxG numpy array with the absolute cosine between principal component i of every two models,
+             "subspace_similarity", a GxG numpy array with the overlap of the subspaces of the first K principal components of every
+                                    two models, from 0 (perpendicular) to 1 (the same subspace), which does not depend on their order
+    """
+    labels = list(models)
+    n_components = min([n_components] + [len(models[label].components) for label in labels])
+    components = np.stack([models[label].components[:n_components] for label in labels]) #GxKxN
+    cosines = np.einsum('aiv,bjv->abij', components, components) #the cosines between all components of every two models
+    return {"labels": labels,
+            "component_similarity": np.abs(np.einsum('abii->iab', cosines)),
+            "subspace_similarity": (cosines**2).sum(axis=(2, 3)) / n_components} #the squared Frobenius norm of the product of the bases
+
+def grouped_pca(data_matrix, labels, n_components=10, min_size=3, n_compare=3, solver="auto", normalize=True, processes=None, seed=0):
+    """
+    Given a MxN numpy array, data_matrix, and a list of M labels (e.g. cancer types),
+    fit a PCA model on the instances of every label, with every group normalized on its own. The groups are only index arrays
+    into data_matrix, which the worker processes share, and the largest groups are fitted first, so the worker processes
+    finish at about the same time.
+
+    Parameters:
+        data_matrix, a non-empty MxN numpy array of numbers, with M instances and N variables
+        labels, a list of M labels, the group of every instance
+        n_components, integer representing the number of principal components to fit per group
+        min_size, integer representing the minimal number of instances of a group, smaller groups are left out
+        n_compare, integer representing the number of leading principal components compared by compare_components
+        solver, string containing the solver of the PCA models, see the PCA class
+        normalize, boolean, if True every group is z-score normalized per variable, if False only centered
+        processes, integer representing the number of worker processes, None for the number of processors, 1 to run in this process
+        seed, integer used to seed the random generator of the "randomized" solver
+
+    Returns: a dictionary with the keys
+             "models", a dictionary with per label the PCA model fitted on its instances,
+             "indexes", a dictionary with per label the numpy array of the indexes of its instances in data_matrix,
+             and the keys of compare_components for the fitted models
+    """
+    data_matrix = np.asarray(data_matrix)
+    groups = group_indexes(labels, min_size)
+    nr_variables = data_matrix.shape[1]
+    cost = lambda label: len(groups[label]) * nr_variables * min(len(groups[label]), nr_variables) #the number of steps of the decomposition
+    order = sorted(groups, key=cost, reverse=True) #largest groups first
+    settings = dict(solver=solver, normalize=normalize, seed=seed)
+    tasks = [partial(_group_task, indexes=groups[label], n_components=n_components, settings=settings) for label in order]
+    fitted = dict(zip(order, _run_tasks(data_matrix, tasks, processes)))
+    models = {label: fitted[label] for label in groups} #in order of appearance of the labels
+    return {"models": models, "indexes": groups, **compare_components(models, n_compare)}
@@ -2,37 +2,118 @@
 This module contains the plot methods used in the PCA analysis
 An example on how to use them can be found in the Main.py module
 
+Every plot method shows its figure, or, when a filename is given, writes it to that file and closes it without showing it.
+With use_headless_backend the figures are rendered without a display.
+
 The methods in this module: 
+    use_headless_backend: switches matplotlib to the non-interactive Agg backend, for rendering to files without a display
+    group_by_label: groups the indexes of the data points per label at once
+    aggregate_points: aggregates data points into the occupied cells of a regular grid, with their counts
     PCA_plot_2d: creating a 2d plot of the first two principal components
     PCA_plot_3d: creating a 3d plot of the first three principal components
+    PCA_plot_loading: creating the loading plot of one principal component
     PCA_plot_loadings: creating loading plots of the selected principal components
     cumulative: support method for PCA_plot_cumulative_explained_variance, returning the cumulative of a list
     PCA_plot_cumulative_explained_variance: creating a bar plot of the explained variances per principal component,
                                             and a line plot of the cumulative explained variance
     PCA_plot_scree: creating a scree plot of the explained variance                    
+    render_PCA_plots: writing all plots to files, rendering them in parallel worker processes
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from AssignmentPCA import getMaxIdxs
-from CellLineRMAExpressionModule import CellLineRMAExpression
+from AssignmentPCA import top_k_indexes_batched
+from CellLineRMAExpressionModule import CellLineRMAExpression, group_indexes
     
-def PCA_plot_2d(labels, targets, subspace):
+DENSITY_THRESHOLD = 20000 #above this number of data points, the 2d and 3d plots show aggregated points instead of every point
+DENSITY_BINS = 100 #the number of grid cells per axis of the aggregated plots
+
+def use_headless_backend():
+    """
+    Switch matplotlib to the non-interactive Agg backend, so figures can be written to files without a display
+    """
+    plt.switch_backend("Agg")
+
+def _finish(filename=None):
+    """
+    Given an optional filename, write the current figure to that file and close it, or show it if no filename is given
+    """
+    if filename is None:
+        plt.show()
+    else:
+        plt.savefig(filename, bbox_inches="tight")
+        plt.close()
+
+def group_by_label(labels, targets=None):
+    """
+    Given a list of M labels and a list of target labels,
+    find the indexes of the data points of every target label, with one sort of all labels instead of one scan per target
+
+    Parameters: 
+        labels, a non-empty list of strings of length M, containing the labels of the data points
+        targets, a list of strings, the labels to find the data points of, by default all unique labels
+
+    Returns: a dictionary with as keys the target labels and as values numpy arrays with the indexes of their data points
+    """
+    groups = group_indexes(labels)
+    if targets is None: return groups
+    return {target: groups.get(target, np.empty(0, dtype=np.intp)) for target in targets}
+
+def aggregate_points(points, bins=DENSITY_BINS, limits=None):
+    """
+    Given a MxD matrix of numbers, points,
+    aggregate the points into the occupied cells of a regular grid of bins cells per dimension
+
+    Parameters: 
+        points, a MxD numpy array of numbers, containing the coordinates of the data points
+        bins, integer representing the number of grid cells per dimension
+        limits, optional tuple of two arrays of length D with the lowest and highest coordinates of the grid
+
+    Returns: a tuple of a CxD numpy array with the centres of the C occupied cells, and a numpy array with the number of points per cell
+    """
+    points = np.asarray(points, dtype=float)
+    lowest, highest = limits if limits is not None else (points.min(axis=0), points.max(axis=0))
+    width = np.where(highest > lowest, (highest - lowest) / bins, 1.0)
+    cells = np.clip(((points - lowest) // width).astype(np.int64), 0, bins - 1) #the grid cell of every point
+    occupied, counts = np.unique(cells, axis=0, return_counts=True)
+    return lowest + (occupied + 0.5) * width, counts
+
+def _sizes(counts):
+    """
+    Given the number of points per cell, return marker sizes that grow with the logarithm of the counts
+    """
+    return 10 + 20 * np.log1p(counts)
+
+def PCA_plot_2d(labels, targets, subspace, filename=None, density_threshold=DENSITY_THRESHOLD):
     """
     Given a list of M labels, a list of target labels and a Mx2 matrix of numbers, subspace,
     Create a 2d scatter plot with M datapoints in the 2d coordinates given in the subspace columns, coloured by their corresponding labels
     from labels present in the target labels 
         
+    Above density_threshold datapoints, the datapoints of every label are aggregated in a grid,
+    and every occupied grid cell is plotted once, with a size growing with its number of datapoints.
+
     Parameters: 
         labels, a non-empty list of strings of length M, containing the labels of the data points
         targets, a non-empty list of strings, the values to which the labels should correspond
         subspace, a Mx2 matrix of numbers, containing the coordinates of the data points in the new subspace
+        filename, optional string containing the path of the file to write the plot to, instead of showing it
+        density_threshold, integer representing the number of datapoints above which they are aggregated
     """
+    subspace = np.asarray(subspace)
+    aggregate = len(subspace) > density_threshold
+    limits = (subspace[:, :2].min(axis=0), subspace[:, :2].max(axis=0)) #one grid for all labels
     
     plt.figure(figsize=(12, 10))
-    for target in targets: #check the datapoints for each target label
-        indicesToKeep = [i for i, label in enumerate(labels) if label == target] #check which data point belongs to the specific target label
-        plt.scatter(subspace[indicesToKeep,0], subspace[indicesToKeep,1], s = 50, label=target) #plot the data points belonging to the target label
+    for target, indicesToKeep in group_by_label(labels, targets).items(): #check the datapoints for each target label
+        if aggregate:
+            centres, counts = aggregate_points(subspace[indicesToKeep, :2], limits=limits)
+            plt.scatter(centres[:,0], centres[:,1], s = _sizes(counts), alpha=0.6, label=target) #plot the occupied grid cells of the target label
+        else:
+            plt.scatter(subspace[indicesToKeep,0], subspace[indicesToKeep,1], s = 50, label=target) #plot the data points belonging to the target label
         
     #make a ylabel, xlabel and title.
     plt.xlabel("Principal Component 1")
@@ -41,26 +122,39 @@ def PCA_plot_2d(labels, targets, subspace):
     
     #make a legend with the the labels.
     plt.legend()
-    plt.show()
+    _finish(filename)
 
-def PCA_plot_3d(labels, targets, subspace):
+def PCA_plot_3d(labels, targets, subspace, filename=None, density_threshold=DENSITY_THRESHOLD):
     """
     Given a list of M labels, a list of target labels and a Mx3 matrix of numbers, subspace,
     Create a 3d scatter plot with M datapoints in the 3d coordinates given in the subspace columns, coloured by their corresponding labels
     from labels present in the target labels 
         
+    Above density_threshold datapoints, the datapoints are aggregated like in PCA_plot_2d.
+
     Parameters: 
         labels, a list of strings of length M, containing the labels of the data points
         targets, a list of strings, the values to which the labels should correspond
         subspace, a Mx3 matrix of numbers, containing the coordinates of the data points in the new subspace
+        filename, optional string containing the path of the file to write the plot to, instead of showing it
+        density_threshold, integer representing the number of datapoints above which they are aggregated
     """
+    subspace = np.asarray(subspace)
+    aggregate = len(subspace) > density_threshold
+    limits = (subspace[:, :3].min(axis=0), subspace[:, :3].max(axis=0)) #one grid for all labels
+
+    from mpl_toolkits.mplot3d import Axes3D #registers the 3d projection on old matplotlib versions, only needed by this plot
+
     #initialize the 3d figure 
     fig = plt.figure(figsize=(10,10))
-    ax = Axes3D(fig)
+    ax = fig.add_subplot(projection='3d')
     
-    for target in targets: #check the datapoints for each target label
-        indicesToKeep = [i for i, label in enumerate(labels) if label == target] #check which data point belongs to the specific target label
-        ax.scatter(subspace[indicesToKeep,0], subspace[indicesToKeep,1], subspace[indicesToKeep,2], s = 50, label=target) #plot the data points belonging to the target label
+    for target, indicesToKeep in group_by_label(labels, targets).items(): #check the datapoints for each target label
+        if aggregate:
+            centres, counts = aggregate_points(subspace[indicesToKeep, :3], bins=DENSITY_BINS // 4, limits=limits)
+            ax.scatter(centres[:,0], centres[:,1], centres[:,2], s = _sizes(counts), alpha=0.6, label=target) #plot the occupied grid cells of the target label
+        else:
+            ax.scatter(subspace[indicesToKeep,0], subspace[indicesToKeep,1], subspace[indicesToKeep,2], s = 50, label=target) #plot the data points belonging to the target label
         
     #make a ylabel, xlabel, zlabel and title.
     ax.set_xlabel("Principal Component 1")
@@ -70,9 +164,36 @@ def PCA_plot_3d(labels, targets, subspace):
     
     #make a legend with the the labels.
     plt.legend()
-    plt.show()
+    _finish(filename)
     
-def PCA_plot_loadings(loadings, nr_genes=None):
+def PCA_plot_loading(loading, idxs, genes, pc_number, filename=None):
+    """
+    Given the loadings of one principal component and the indexes of the genes to plot,
+    Create a loading plot of those genes
+
+    Parameters: 
+        loading, a numpy array of N numbers, containing the loadings of the principal component
+        idxs, a list of indexes of the genes to plot, in the order to plot them
+        genes, a list of the N gene names
+        pc_number, integer representing the number of the principal component, used in the title
+        filename, optional string containing the path of the file to write the plot to, instead of showing it
+    """
+    loading = np.asarray(loading)
+    ticks = [genes[idx] for idx in idxs] #set the x labels to the correct gene names
+    heights = np.abs(loading[idxs]) #set the heights of the loadings per gene
+    colours = np.array(['red', 'blue']) #set the colours for the negative and positive loadings
+    colourmap = colours[(loading[idxs] > 0).astype(int)] #assign the correct colours to the plotted genes
+
+    plt.figure(figsize=(10,3)) #create a new figure
+    plt.bar(ticks, heights, color=colourmap) #plot the results
+    plt.xticks(rotation=90) #allign the x labels vertically
+
+    #add title and ylabel
+    plt.title(f"Loading plot for PC{pc_number}")
+    plt.ylabel("value")
+    _finish(filename)
+
+def PCA_plot_loadings(loadings, nr_genes=None, genes=None, filename=None):
     """
     Given a non empty MxN matrix of numbers, loadings, and an integer, nr_genes,
     Create M loading plots, showing the loadings of the nr_genes maximal variables    
@@ -80,25 +201,18 @@ def PCA_plot_loadings(loadings, nr_genes=None):
     Parameters: 
         loadings, a MxN matrix of numbers, containing the loadings of the principal components 
         nr_genes, an integer specifying how many genes should be plotted
+        genes, a list of the N gene names, by default CellLineRMAExpression.allparskeys
+        filename, optional string containing the path of the files to write the plots to, with {pc} replaced by the number
+                  of the principal component, e.g. "loadings_PC{pc}.png"
     """
     if nr_genes is None: nr_genes = len(loadings[0]) #check how many genes to plot, if not specified plot all
+    if genes is None: genes = CellLineRMAExpression.allparskeys
     
-    for i in range(len(loadings)): #loop over each principal component
-        absolute = abs(loadings[i])
-        idxs = getMaxIdxs(absolute, nr_genes) #get the indexes of the genes with the highest loading 
-        ticks = [CellLineRMAExpression.allparskeys[i] for i in idxs] #set the x labels to the correct gene names
-        heights = absolute[idxs] #set the heights of the loadings per gene
-        colours = ['red', 'blue'] #set the colours for the negative and positive loadings
-        colourmap = [colours[int(value>0)] for value in loadings[i]] #assign the correct colours to the correct indexes
+    loadings = np.asarray(loadings).real
+    all_idxs = top_k_indexes_batched(np.abs(loadings), nr_genes) #get the indexes of the genes with the highest loading, for all principal components at once
         
-        plt.figure(figsize=(10,3)) #create a new figure
-        plt.bar(ticks, heights, color=colourmap) #plot the results
-        plt.xticks(rotation=90) #allign the x labels vertically
-
-        #add title and ylabel
-        plt.title(f"Loading plot for PC{i+1}")
-        plt.ylabel("value")
-        plt.show()
+    for i, idxs in enumerate(all_idxs): #loop over each principal component
+        PCA_plot_loading(loadings[i], idxs, genes, i+1, None if filename is None else filename.format(pc=i+1))
 
 def cumulative(l=[1]):
     """
@@ -114,7 +228,7 @@ def cumulative(l=[1]):
     for i in range(len(l)): result[i+1] = result[i] + l[i] #fill the list with the cumulative of list l
     return result
     
-def PCA_plot_cumulative_explained_variance(explained_variance, nr_pcs):
+def PCA_plot_cumulative_explained_variance(explained_variance, nr_pcs, filename=None, ci=None):
     """
     Given a non empty list of numbers, explained_variance, and an integer, nr_pcs,
     Create a plot of the explained variance per principle component and the cumulative     
@@ -122,14 +236,20 @@ def PCA_plot_cumulative_explained_variance(explained_variance, nr_pcs):
     Parameters: 
         explained_variance, a list of numbers, containing the explained variance of the principal components 
         nr_pcs, an integer specifying how many principal components should be plotted
+        filename, optional string containing the path of the file to write the plot to, instead of showing it
+        ci, optional tuple of two lists of numbers, the lower and upper bounds of the cumulative explained variance of the
+            first principal components, e.g. "cumulative_ci_low" and "cumulative_ci_high" of parallel_pca.stability_analysis
     """
     cum_exp_var = cumulative(explained_variance) #calculate the cumulative explained variance
     
+    plt.figure() #create a new figure
     end_idx = len(explained_variance) + 1
     plt.bar(range(1, end_idx), explained_variance, alpha=0.5, label='Per PC') #make a bar graph 
     
     plt.plot(range(end_idx), cum_exp_var, '-o', label='Cumulative') #make a line plot for the cumulative explained variance 
     plt.plot(range(end_idx), [0.7]*len(cum_exp_var), label='70% Threshold') #make a line plot for the 70% threshold
+    if ci is not None: #shade the confidence interval of the cumulative explained variance
+        plt.fill_between(range(1, len(ci[0])+1), ci[0], ci[1], alpha=0.3, label='Cumulative confidence interval')
 
     #make an appropriate ylabel and xlabel
     plt.xlabel(f'N of {nr_pcs} principal components')
@@ -137,17 +257,27 @@ def PCA_plot_cumulative_explained_variance(explained_variance, nr_pcs):
     
     #make a legend
     plt.legend()
-    plt.show()
+    _finish(filename)
 
-def PCA_plot_scree(explained_variance):  
+def PCA_plot_scree(explained_variance, filename=None, ci=None, null=None):
     """
     Given a non empty list of numbers, explained_variance, 
     Create a scree plot   
         
     Parameters: 
         explained_variance, a list of numbers, containing the explained variance of the principal components 
+        filename, optional string containing the path of the file to write the plot to, instead of showing it
+        ci, optional tuple of two lists of numbers, the lower and upper bounds of the explained variance of the first
+            principal components, e.g. "ci_low" and "ci_high" of parallel_pca.stability_analysis
+        null, optional list of numbers, the explained variance of the first principal components that is not significant,
+              e.g. "null_threshold" of parallel_pca.stability_analysis
     """
+    plt.figure() #create a new figure
     plt.plot(range(1, len(explained_variance)+1), explained_variance, 'o-', linewidth=2, label='PC number') #create scree plot
+    if ci is not None: #shade the confidence interval of the explained variance
+        plt.fill_between(range(1, len(ci[0])+1), ci[0], ci[1], alpha=0.3, label='Confidence interval')
+    if null is not None: #plot the explained variance of the permuted data
+        plt.plot(range(1, len(null)+1), null, '--', label='Permutation threshold')
     
     #make an appropriate ylabel and xlabel
     plt.xlabel("Number of PC's")
@@ -155,5 +285,56 @@ def PCA_plot_scree(explained_variance):
     
     #make a legend
     plt.legend()
-    plt.show()
+    _finish(filename)
     
+def render_PCA_plots(directory, labels=None, subspace=None, loadings=None, nr_genes=50, genes=None,
+                     explained_variance=None, nr_pcs=None, processes=None, image_format="png", stability=None):
+    """
+    Write all given PCA plots to files in directory, with a non-interactive backend.
+    Every plot (the 2d and 3d plots, the loading plot of every principal component, the explained variance and scree plots)
+    is rendered by its own task in a pool of worker processes.
+
+    Parameters: 
+        directory, string containing the path of the directory to write the plots to, which is created if it does not exist
+        labels, optional list of M labels of the data points, required for the 2d and 3d plots
+        subspace, optional Mx2 or Mx3 (or wider) matrix of numbers, the coordinates of the data points for the 2d and 3d plots
+        loadings, optional KxN matrix of numbers, the loadings of the principal components for the loading plots
+        nr_genes, an integer specifying how many genes should be plotted per loading plot
+        genes, a list of the N gene names, by default CellLineRMAExpression.allparskeys
+        explained_variance, optional list of numbers, the explained variance of the principal components for the variance plots
+        nr_pcs, an integer used in the label of the cumulative explained variance plot, by default the length of explained_variance
+        processes, integer representing the number of worker processes, or None for the number of processors
+        image_format, string containing the file extension, and thereby the format, of the plots
+        stability, optional dictionary returned by parallel_pca.stability_analysis, whose confidence intervals and permutation
+                   threshold are added to the explained variance and scree plots
+
+    Returns: a list of the paths of the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = lambda name: os.path.join(directory, f"{name}.{image_format}")
+    tasks = [] #tuples of a plot method, its arguments and the path of its file
+
+    if subspace is not None:
+        subspace = np.asarray(subspace)
+        targets = list(dict.fromkeys(labels)) #the unique labels, in order of appearance
+        tasks.append((PCA_plot_2d, (list(labels), targets, subspace[:, :2]), path("PCA_2d")))
+        if subspace.shape[1] >= 3: tasks.append((PCA_plot_3d, (list(labels), targets, subspace[:, :3]), path("PCA_3d")))
+    if loadings is not None:
+        if genes is None: genes = CellLineRMAExpression.allparskeys
+        loadings = np.asarray(loadings).real
+        all_idxs = top_k_indexes_batched(np.abs(loadings), min(nr_genes, loadings.shape[1])) #select the genes of all principal components at once
+        genes = list(genes)
+        for i, idxs in enumerate(all_idxs):
+            tasks.append((PCA_plot_loading, (loadings[i, idxs], np.arange(len(idxs)), [genes[idx] for idx in idxs], i+1), path(f"loadings_PC{i+1}"))) #send only the plotted genes to the worker
+    if explained_variance is not None:
+        explained_variance = np.asarray(explained_variance).real
+        stability = stability or {}
+        cumulative_ci = (stability["cumulative_ci_low"], stability["cumulative_ci_high"]) if "cumulative_ci_low" in stability else None
+        ci = (stability["ci_low"], stability["ci_high"]) if "ci_low" in stability else None
+        tasks.append((partial(PCA_plot_cumulative_explained_variance, ci=cumulative_ci), (explained_variance, nr_pcs or len(explained_variance)), path("explained_variance")))
+        tasks.append((partial(PCA_plot_scree, ci=ci, null=stability.get("null_threshold")), (explained_variance,), path("scree")))
+
+    with ProcessPoolExecutor(processes, initializer=use_headless_backend) as pool: #every worker renders without a display
+        futures = [pool.submit(method, *arguments, filename=filename) for method, arguments, filename in tasks]
+        for future in futures: future.result() #raise the errors of the workers, if any
+    return [filename for _, _, filename in tasks]
@@ -0,0 +1,78 @@
+"""
+This module contains the tests of the PCA classes of AssignmentPCA.py
+Run them with 'python -m pytest' from this directory
+"""
+
+import numpy as np
+import pytest
+from AssignmentPCA import PCA, IncrementalPCA, PCAProjector
+
+def _data(nr_instances=120, nr_variables=30, seed=0):
+    """
+    Returns: a MxN numpy array of correlated random data, with a few dominant principal components, and its N gene names
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((nr_instances, 5)) @ rng.standard_normal((5, nr_variables)) * 3 + rng.standard_normal((nr_instances, nr_variables))
+    return data + rng.uniform(0, 10, nr_variables), [f"G{i}" for i in range(nr_variables)]
+
+@pytest.mark.parametrize("mode", ["covariance", "sketch"])
+def test_incremental_pca_save_load_project(tmp_path, mode):
+    data, genes = _data()
+    model = IncrementalPCA(n_components=5, mode=mode).fit(data, genes, batch_size=32)
+    assert model.genes == genes
+
+    path = tmp_path / "model.npz"
+    model.save(path)
+    loaded = IncrementalPCA.load(path)
+    assert isinstance(loaded, IncrementalPCA)
+    assert loaded.genes == genes
+    np.testing.assert_allclose(loaded.components, model.components)
+    np.testing.assert_allclose(loaded.eigenvalues, model.eigenvalues)
+
+    expected = model.transform(data)
+    np.testing.assert_allclose(PCAProjector(model).project(data), expected, atol=1e-10)
+    np.testing.assert_allclose(PCAProjector(str(path)).project(data[:, ::-1], genes=genes[::-1]), expected, atol=1e-10) #reordered by gene name
+
+def test_incremental_pca_without_genes_can_be_saved(tmp_path):
+    data, _ = _data()
+    model = IncrementalPCA(n_components=3).fit(data)
+    assert model.genes is None
+    model.save(tmp_path / "model.npz")
+    np.testing.assert_allclose(PCAProjector(model).project(data), model.transform(data), atol=1e-10)
+
+@pytest.mark.parametrize("solver", ["eigh", "svd", "randomized"])
+def test_float32_inplace_matches_float64(solver):
+    data, _ = _data(nr_instances=400, nr_variables=120)
+    default = PCA(n_components=5, solver=solver).fit(data)
+    lean_matrix = data.astype(np.float32)
+    lean = PCA(n_components=5, solver=solver, copy=False).fit(lean_matrix)
+
+    assert lean_matrix.dtype == np.float32
+    np.testing.assert_allclose(lean_matrix.mean(axis=0), 0, atol=1e-5) #normalized in place
+    np.testing.assert_allclose(lean.eigenvalues, default.eigenvalues, rtol=1e-4)
+    np.testing.assert_allclose(lean.total_variance, default.total_variance, rtol=1e-4)
+    cosines = np.abs(np.einsum('ij,ij->i', lean.components, default.components))
+    assert cosines.min() > 1 - 1e-4
+
+def test_normalized_data_is_not_written():
+    data, _ = _data()
+    default = PCA(n_components=5, solver="eigh").fit(data)
+    normalized = ((data - data.mean(axis=0)) / data.std(axis=0)).astype(np.float32)
+    normalized.flags.writeable = False #e.g. a read-only memory map of the dataset cache
+    lean = PCA(n_components=5, solver="eigh", copy=False, normalize=False, center=False).fit(normalized)
+    np.testing.assert_allclose(lean.eigenvalues, default.eigenvalues, rtol=1e-4)
+    np.testing.assert_allclose(lean.transform(normalized), default.transform(data), atol=1e-3)
+
+def test_float32_wide_matrix_keeps_all_components():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((100, 1)) @ rng.standard_normal((1, 20000)) * 10 + rng.standard_normal((100, 20000)) #M much smaller than N, one dominant factor
+    default = PCA(solver="eigh").fit(data)
+    lean = PCA(solver="eigh", copy=False).fit(data.astype(np.float32)) #the Gram matrix path, in float32
+    assert len(lean.eigenvalues) == len(default.eigenvalues) == 99 #centering removes one dimension
+    np.testing.assert_allclose(lean.eigenvalues, default.eigenvalues, rtol=1e-3)
+
+def test_auto_matches_eigh_at_main_settings():
+    data, _ = _data(nr_instances=1000, nr_variables=1200) #200 of 1000 components, few by count but not by the products of the randomized solver
+    exact = PCA(n_components=200, solver="eigh").fit(data) #Main.py calculates 200 components by default
+    auto = PCA(n_components=200).fit(data)
+    np.testing.assert_allclose(auto.eigenvalues, exact.eigenvalues, rtol=1e-8)
@@ -0,0 +1,51 @@
+"""
+This module contains the tests of the RMA expression readers of data_preparation.py
+Run them with 'python -m pytest' from this directory
+"""
+
+import numpy as np
+import pytest
+from data_preparation import read_RMAExp_tsv_chunked, read_RMAExp_tsv_transposed
+from feature_selection import gene_statistics, gene_statistics_tsv, select_genes
+
+def _write_tsv(path):
+    """
+    Returns: the path of a small RMA expression tsv file with a nan value, a nan gene title and a nan gene symbol
+    """
+    rng = np.random.default_rng(0)
+    rows = ["GENE_SYMBOLS\tGENE_title\tDATA.1\tDATA.2\tDATA.3"]
+    for gene in range(12):
+        values = [f"{value:.4f}" for value in rng.normal(5, 1, 3)]
+        if gene == 2: values[1] = "" #a nan value
+        title = "" if gene == 5 else f"title {gene}"
+        symbol = "" if gene == 8 else f"G{gene}"
+        rows.append("\t".join([symbol, title] + values))
+    path.write_text("\n".join(rows) + "\n")
+    return str(path)
+
+@pytest.mark.parametrize("filename", [None, "matrix.npy"])
+def test_readers_drop_the_same_genes(tmp_path, filename):
+    path = _write_tsv(tmp_path / "expression.tsv")
+    transposed = read_RMAExp_tsv_transposed(path)
+    matrix, genes, ids = read_RMAExp_tsv_chunked(path, chunksize=5, filename=None if filename is None else str(tmp_path / filename))
+
+    assert genes == [f"G{gene}" for gene in range(12) if gene not in (2, 5, 8)]
+    assert ids == ["1", "2", "3"]
+    assert list(transposed.columns) == genes and list(transposed.index) == ids
+    assert matrix.shape == (3, 9) and matrix.flags.c_contiguous
+    np.testing.assert_allclose(matrix, transposed.to_numpy())
+    if filename is not None:
+        assert np.load(tmp_path / filename).shape == (3, 9) #the file holds only the kept genes
+
+def test_genes_selected_before_reading(tmp_path):
+    path = _write_tsv(tmp_path / "expression.tsv")
+    matrix, genes, _ = read_RMAExp_tsv_chunked(path)
+    cell_lines = [2, 0]
+    statistics = gene_statistics_tsv(path, chunksize=5, cell_lines=cell_lines)
+    assert list(np.flatnonzero(statistics["nan_count"] > 0)) == [2, 5, 8] #the genes dropped by the readers
+
+    rows = select_genes(statistics["variance"], statistics["nan_count"], top_n=4)
+    selected, selected_genes, _ = read_RMAExp_tsv_chunked(path, chunksize=5, gene_rows=rows)
+    columns = select_genes(gene_statistics(matrix[cell_lines])["variance"], top_n=4)
+    assert selected_genes == [genes[column] for column in columns]
+    np.testing.assert_allclose(selected, matrix[:, columns])